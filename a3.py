@@ -2,17 +2,27 @@
 Defines the GUI for the messaging system, leveraging the server
 and client connection.
 """
+import queue
+import threading
+import traceback
 import tkinter as tk
 from pathlib import Path
 from time import time
 from tkinter import ttk, simpledialog, messagebox
+from typing import Callable, List, Tuple
 from ds_messenger import DirectMessenger
 from notebook import (DirectMessage,
-                      Conversation,
+                      ColumnarConversation,
+                      NotebookFileError,
                       Notebook,
                       IncorrectNotebookError,
                       DirectMessageError)
 
+# Newest messages drawn when a conversation is opened, the rest are drawn
+# in chunks of LOAD_MORE_MESSAGES when the view is scrolled to the top
+MESSAGE_WINDOW = 100
+LOAD_MORE_MESSAGES = 100
+
 
 class Body(tk.Frame):
     """
@@ -37,6 +47,10 @@ class Body(tk.Frame):
         self.root = root
         self._contacts = []
         self._select_callback = recipient_selected_callback
+        # Messages of the open conversation that are not drawn yet
+        self._load_messages = None
+        self._first_shown = 0
+        self._loading = False
         self._draw()
 
     def node_select(self, event):
@@ -70,6 +84,73 @@ class Body(tk.Frame):
         Clear all messages from the message display area.
         """
         self.entry_editor.delete('1.0', tk.END)
+        self._load_messages = None
+        self._first_shown = 0
+
+    def show_messages(self,
+                      count: int,
+                      load: Callable[[int, int], List[Tuple[str, bool]]]):
+        """
+        Replace the displayed messages with a conversation. Only the
+        newest MESSAGE_WINDOW messages are drawn, older ones are drawn
+        when the view is scrolled to the top.
+
+        Arguments:
+        count: The number of messages in the conversation
+        load: Function returning the (text, sent by the user) pairs of
+        the messages between two positions, oldest first
+        """
+        self.clear_messages()
+        self._load_messages = load
+        self._first_shown = max(0, count - MESSAGE_WINDOW)
+        self._insert_messages(tk.END, load(self._first_shown, count))
+        self.entry_editor.see(tk.END)
+
+    def _insert_messages(self, index: str, messages: List[Tuple[str, bool]]):
+        """
+        Draw messages with a single insert into the message display.
+
+        Arguments:
+        index: The text index to insert the messages at
+        messages: The (text, sent by the user) pairs to draw
+        """
+        chunks = []
+        for text, from_user in messages:
+            tag = 'entry-right' if from_user else 'entry-left'
+            chunks += [text + '\n', tag]
+        if chunks:
+            self.entry_editor.insert(index, *chunks)
+
+    def _on_scroll(self, first: str, last: str):
+        """
+        Update the scrollbar and draw older messages once the view
+        reaches the top.
+
+        Arguments:
+        first: The fraction of the text above the view
+        last: The fraction of the text above the bottom of the view
+        """
+        self.entry_editor_scrollbar.set(first, last)
+        if (float(first) <= 0.0 and self._first_shown > 0
+                and self._load_messages and not self._loading):
+            self._loading = True
+            self.after_idle(self._load_older_messages)
+
+    def _load_older_messages(self):
+        """
+        Draw the next chunk of older messages above the drawn ones,
+        keeping the view on the message that was at the top.
+        """
+        self._loading = False
+        if not self._load_messages or self._first_shown <= 0:
+            return
+        start = max(0, self._first_shown - LOAD_MORE_MESSAGES)
+        lines = int(self.entry_editor.index(tk.END).split('.')[0])
+        self._insert_messages('1.0',
+                              self._load_messages(start, self._first_shown))
+        added = int(self.entry_editor.index(tk.END).split('.')[0]) - lines
+        self._first_shown = start
+        self.entry_editor.yview(f'{added + 1}.0')
 
     def insert_contact(self, contact: str):
         """
@@ -184,11 +265,11 @@ class Body(tk.Frame):
         self.entry_editor.pack(fill=tk.BOTH, side=tk.LEFT,
                                expand=True, padx=0, pady=0)
 
-        entry_editor_scrollbar = tk.Scrollbar(master=scroll_frame,
-                                              command=self.entry_editor.yview)
-        self.entry_editor['yscrollcommand'] = entry_editor_scrollbar.set
-        entry_editor_scrollbar.pack(fill=tk.Y, side=tk.LEFT,
-                                    expand=False, padx=0, pady=0)
+        self.entry_editor_scrollbar = tk.Scrollbar(
+            master=scroll_frame, command=self.entry_editor.yview)
+        self.entry_editor['yscrollcommand'] = self._on_scroll
+        self.entry_editor_scrollbar.pack(fill=tk.Y, side=tk.LEFT,
+                                         expand=False, padx=0, pady=0)
 
 
 class Footer(tk.Frame):
@@ -200,7 +281,8 @@ class Footer(tk.Frame):
     and managing contacts.
     """
 
-    def __init__(self, root, send_callback=None, add_user_callback=None):
+    def __init__(self, root, send_callback=None, add_user_callback=None,
+                 search_callback=None):
         """
         Initialize the Footer frame which contains action buttons.
 
@@ -208,11 +290,14 @@ class Footer(tk.Frame):
         root: The parent tkinter widget
         send_callback: Callback function for sending messages
         add_user_callback: Callback function for adding new users
+        search_callback: Callback function for searching messages
         """
         tk.Frame.__init__(self, root)
         self.root = root
         self._send_callback = send_callback
         self._add_user_callback = add_user_callback
+        self._search_callback = search_callback
+        self.search_entry = None
         self._draw()
 
     def send_click(self):
@@ -229,6 +314,22 @@ class Footer(tk.Frame):
         if self._add_user_callback is not None:
             self._add_user_callback()
 
+    def search_click(self, event=None):
+        """
+        Handle the search button click event.
+        """
+        if self._search_callback is not None:
+            self._search_callback()
+
+    def get_search_query(self) -> str:
+        """
+        Get the text typed in the search box.
+
+        Returns:
+        str: The search query
+        """
+        return self.search_entry.get()
+
     def _draw(self):
         """
         Create and layout the footer buttons.
@@ -241,6 +342,14 @@ class Footer(tk.Frame):
             master=self, text="Add User", command=self.add_user_click)
         add_user_button.pack(fill=tk.BOTH, side=tk.LEFT, padx=(125, 5), pady=5)
 
+        search_button = tk.Button(
+            master=self, text="Search", command=self.search_click)
+        search_button.pack(fill=tk.BOTH, side=tk.RIGHT, padx=5, pady=5)
+
+        self.search_entry = tk.Entry(master=self, width=20)
+        self.search_entry.bind('<Return>', self.search_click)
+        self.search_entry.pack(fill=tk.X, side=tk.RIGHT, padx=5, pady=5)
+
 
 class NewContactDialog(tk.simpledialog.Dialog):
     """
@@ -321,6 +430,82 @@ class NewContactDialog(tk.simpledialog.Dialog):
         self.password = self.password_entry.get()
 
 
+class NetworkWorker:
+    """
+    Runs blocking network calls on a background thread, so a slow server
+    never freezes the interface. Tasks run one at a time in the order
+    they were submitted, so the DirectMessenger they share is only used
+    by one thread. Results are passed back through a queue that the Tk
+    thread drains with after, so callbacks can safely update widgets.
+    """
+
+    # Milliseconds between checks for finished tasks
+    POLL_INTERVAL = 50
+
+    def __init__(self, root):
+        """
+        Start the worker thread.
+
+        Arguments:
+        root: The root tkinter window the results are delivered on
+        """
+        self.root = root
+        self._tasks = queue.Queue()
+        self._results = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        self._deliver_results()
+
+    def submit(self, task, on_done=None, on_error=None):
+        """
+        Queue a task for the worker thread.
+
+        Arguments:
+        task: Function doing the blocking work
+        on_done: Function called on the Tk thread with the task's result
+        on_error: Function called on the Tk thread with the error raised
+        """
+        self._tasks.put((task, on_done, on_error))
+
+    def stop(self):
+        """
+        Stop the worker thread once the queued tasks are done.
+        """
+        self._tasks.put(None)
+
+    def _run(self):
+        """
+        Run queued tasks until stopped.
+        """
+        while True:
+            item = self._tasks.get()
+            if item is None:
+                return
+            task, on_done, on_error = item
+            try:
+                self._results.put((on_done, task()))
+            except Exception as error:  # pylint: disable=broad-except
+                self._results.put((on_error, error))
+
+    def _deliver_results(self):
+        """
+        Call the callbacks of finished tasks on the Tk thread.
+        """
+        while True:
+            try:
+                callback, value = self._results.get_nowait()
+            except queue.Empty:
+                break
+            if callback is None:
+                continue
+            try:
+                callback(value)
+            except Exception:  # pylint: disable=broad-except
+                # Keep delivering the results of later tasks
+                traceback.print_exc()
+        self.root.after(self.POLL_INTERVAL, self._deliver_results)
+
+
 class MainApp(tk.Frame):
     """
     The MainApp class represents the primary interface
@@ -349,8 +534,15 @@ class MainApp(tk.Frame):
         self.notebook = None
         self.recipient = ''
         self.all_messages = None
+        self.pushed_messages = queue.Queue()
         self.body = None
         self.footer = None
+        self.network = NetworkWorker(root)
+        # Incremented on every log in, so results of an old session's
+        # network tasks are ignored
+        self._session = 0
+        self._polling = False
+        self._check_job = None
 
         self._draw()
         self.configure_server()
@@ -366,7 +558,9 @@ class MainApp(tk.Frame):
 
     def send_message(self):
         """
-        Send a message to the currently selected recipient.
+        Send a message to the currently selected recipient. The message
+        is sent by the network worker and shown once the server has
+        accepted it.
         """
         message = self.body.get_text_entry()
         recipient = self.recipient
@@ -374,26 +568,59 @@ class MainApp(tk.Frame):
         if not recipient:
             messagebox.showerror("Error", "No recipient selected!")
             return
-
-        success = self.publish(message)
-        if not success:
+        if not self.direct_messenger:
             messagebox.showerror(
                 "Error", "Message not sent - failed to reach server")
             return
 
-        self.body.insert_user_message(message)
-        direct_message = DirectMessage(
-            message, self.username, self.recipient, time())
+        self.body.set_text_entry("")
+        sent_at = time()
+        self._submit(lambda: self.publish(message, recipient),
+                     lambda sent: self._message_sent(sent, message,
+                                                     recipient, sent_at),
+                     lambda error: self._message_failed(error, message))
 
-        if recipient in self.notebook.conversations:
-            self.notebook.conversations[recipient].add_message(direct_message)
-        else:
-            conv = Conversation(recipient)
-            conv.add_message(direct_message)
-            self.notebook.conversations[recipient] = conv
+    def _message_failed(self, error: Exception, message: str):
+        """
+        Report a message the network worker failed to send, and put its
+        text back in the entry so it is not lost.
 
+        Arguments:
+        error: The error raised while sending
+        message: The message text
+        """
+        messagebox.showerror(
+            "Error", f"Message not sent. Error: {error}")
+        if not self.body.get_text_entry():
+            self.body.set_text_entry(message)
+
+    def _message_sent(self,
+                      sent: bool,
+                      message: str,
+                      recipient: str,
+                      sent_at: float):
+        """
+        Record a message once the network worker has tried to send it.
+
+        Arguments:
+        sent: Whether the server accepted the message
+        message: The message text
+        recipient: The user the message was sent to
+        sent_at: The time the message was sent
+        """
+        if not sent:
+            messagebox.showerror(
+                "Error", "Message not sent - failed to reach server")
+            if not self.body.get_text_entry():
+                self.body.set_text_entry(message)
+            return
+
+        direct_message = DirectMessage(
+            message, self.username, recipient, sent_at)
+        self.notebook.add_message(recipient, direct_message)
         self.notebook.save(self.notebook.path)
-        self.body.set_text_entry("")
+        if self.recipient == recipient:
+            self.body.insert_user_message(message)
 
     def add_contact(self):
         """
@@ -413,29 +640,69 @@ class MainApp(tk.Frame):
         """
         self.recipient = recipient
 
-        self.body.entry_editor.delete('1.0', tk.END)
+        if (recipient not in self.notebook.conversations
+                and self.direct_messenger):
+            self._load_conversation(recipient)
 
-        if recipient in self.notebook.conversations:
-            conversation = self.notebook.conversations[recipient]
-            for message in conversation.get_message():
-                if message['sender'] == self.username:
-                    self.body.insert_user_message(message['entry'])
-                else:
-                    self.body.insert_contact_message(message['entry'])
+        self._show_conversation(recipient)
+
+    def _show_conversation(self, recipient: str):
+        """
+        Display the conversation with a recipient from the notebook.
+
+        Arguments:
+        recipient: The contact whose conversation to display
+        """
+        self.body.clear_messages()
+        if recipient not in self.notebook.conversations:
+            return
+        conversation = self.notebook.conversations[recipient]
+
+        def load(start, stop):
+            return [(message['entry'],
+                     message.get('sender') == self.username)
+                    for message in conversation.message_range(start, stop)]
+
+        self.body.show_messages(len(conversation), load)
+
+    def _load_conversation(self, recipient: str):
+        """
+        Fetch one conversation the notebook does not have from the server,
+        without transferring the rest of the mailbox.
+
+        Arguments:
+        recipient: The contact whose conversation to load
+        """
+        direct_messenger = self.direct_messenger
+        self._submit(
+            lambda: direct_messenger.retrieve_conversation(recipient),
+            lambda messages: self._conversation_loaded(recipient, messages))
+
+    def _conversation_loaded(self, recipient: str, messages: list):
+        """
+        Add a conversation fetched by the network worker to the notebook.
+
+        Arguments:
+        recipient: The contact the conversation is with
+        messages: The DirectMessage objects of the conversation
+        """
+        for msg in messages:
+            direct_message = DirectMessage(
+                msg.message, msg.sender, msg.recipient, msg.timestamp)
+            self.notebook.add_unique_message(recipient, direct_message)
+        if messages:
+            self.notebook.save(self.notebook.path)
+            if self.recipient == recipient:
+                self._show_conversation(recipient)
 
     def configure_server(self):
         """
         Configure server connection and initialize user session.
         """
+        self._session += 1
         self.prompt_login()
         self.clear_gui()
-        dm_created = self.create_dm()
-
-        if dm_created:
-            self.setup_notebook(dm_created)
-
-        if dm_created:
-            self.check_new()
+        self.create_dm()
 
     def prompt_login(self):
         """
@@ -450,27 +717,44 @@ class MainApp(tk.Frame):
         self.password = dialog.password
         self.path = dialog.path
 
+        if self.direct_messenger:
+            self.direct_messenger.close()
         self.direct_messenger = None
         self.notebook = None
 
-    def create_dm(self) -> bool:
+    def create_dm(self):
+        """
+        Create the DirectMessenger connection to the server on the network
+        worker. The notebook is set up once the connection is made.
         """
-        Create DirectMessenger connection to the server.
+        self._polling = False
+        server, username, password = self.server, self.username, self.password
+        # The server may be given as host:port
+        host, _, port = (server or '').partition(':')
+        port = int(port) if port.isdigit() else 3001
+        self._submit(
+            lambda: DirectMessenger(host, username, password, port=port),
+            self._dm_created, self._dm_failed)
 
-        Returns:
-        bool: True if connection successful, False otherwise
+    def _dm_created(self, direct_messenger: DirectMessenger):
         """
-        try:
-            self.direct_messenger = DirectMessenger(
-                self.server,
-                self.username,
-                self.password)
-
-            self.all_messages = self.direct_messenger.retrieve_all()
-            return True
-        except DirectMessageError:
-            messagebox.showerror("Failed to create DM")
-            return False
+        Start the session once the network worker has connected.
+
+        Arguments:
+        direct_messenger: The connected DirectMessenger
+        """
+        self.direct_messenger = direct_messenger
+        self.setup_notebook(True)
+        self.check_new()
+
+    def _dm_failed(self, error: Exception):
+        """
+        Report a failed connection to the server.
+
+        Arguments:
+        error: The error raised while connecting
+        """
+        messagebox.showerror("Error", f"Failed to create DM: {error}")
 
     def setup_notebook(self, dm_created: bool):
         """
@@ -484,7 +768,9 @@ class MainApp(tk.Frame):
             self.notebook = Notebook(username=self.username,
                                      password=self.password,
                                      host=self.server,
-                                     path=self.path)
+                                     path=self.path,
+                                     journal=True,
+                                     conversation_type=ColumnarConversation)
 
             if not self.notebook:
                 return
@@ -501,6 +787,15 @@ class MainApp(tk.Frame):
 
                 if dm_created and self.direct_messenger:
                     self.sync_server_messages()
+                    # Subscribe only after syncing, so nothing synced is
+                    # pushed again. check_new falls back to polling if
+                    # the server does not support push.
+                    self.pushed_messages = queue.Queue()
+                    direct_messenger = self.direct_messenger
+                    pushed_messages = self.pushed_messages
+                    self._submit(
+                        lambda: direct_messenger.subscribe(
+                            pushed_messages.put))
                 else:
                     messagebox.showerror(
                         "Error", "Offline: no server connection!")
@@ -512,73 +807,213 @@ class MainApp(tk.Frame):
         """
         Load existing notebook and populate contacts.
         """
-        self.notebook.load(self.notebook.path)
+        self.notebook.load(self.notebook.path, lazy=True)
         for contact in self.notebook.conversations:
             if contact and contact.strip().lower() != "null":
                 self.body.insert_contact(contact)
 
     def sync_server_messages(self):
         """
-        Retrieve and sync all messages from the server.
+        Retrieve and sync the messages the notebook has not seen yet
+        from the server, starting at the notebook's cursor.
         """
-        try:
-            for msg in self.all_messages:
+        direct_messenger = self.direct_messenger
+        cursor = self.notebook.cursor
+        self._submit(lambda: direct_messenger.retrieve_since(cursor),
+                     self._messages_synced, self._sync_failed)
+
+    def _messages_synced(self, messages: list):
+        """
+        Add the messages synced by the network worker to the notebook.
+
+        Arguments:
+        messages: The DirectMessage objects received
+        """
+        self.all_messages = messages
+        self.notebook.set_cursor(self.direct_messenger.cursor)
+        for msg in self.all_messages:
+            if msg.sender is None:
+                # Sent by this user, possibly from another session
+                contact = msg.recipient
                 direct_message = DirectMessage(
-                    msg.message, msg.sender, self.username, msg.timestamp)
+                    msg.message, self.username, contact, msg.timestamp)
+            else:
+                contact = msg.sender
+                direct_message = DirectMessage(
+                    msg.message, contact, self.username, msg.timestamp)
+            if not contact:
+                continue
+
+            if self.notebook.add_unique_message(contact, direct_message):
+                current_contacts = self.body.get_contacts()
+                if contact not in current_contacts:
+                    self.body.insert_contact(contact)
+        self.notebook.save(self.notebook.path)
 
-                if self.notebook.add_unique_message(msg.sender,
-                                                    direct_message):
-                    current_contacts = self.body.get_contacts()
-                    if msg.sender not in current_contacts:
-                        self.body.insert_contact(msg.sender)
-            self.notebook.save(self.notebook.path)
-        except (DirectMessageError, ConnectionError) as error:
-            messagebox.showerror(f"Unable to sync messages. Error: {error}")
+    def _sync_failed(self, error: Exception):
+        """
+        Report a failed sync with the server.
 
-    def publish(self, message: str) -> bool:
+        Arguments:
+        error: The error raised while syncing
         """
-        Send a message to the server.
+        messagebox.showerror(
+            "Error", f"Unable to sync messages. Error: {error}")
+
+    def publish(self, message: str, recipient: str) -> bool:
+        """
+        Send a message to the server. Runs on the network worker, so it
+        must not touch any widget.
 
         Arguments:
         message: The message text to send
+        recipient: The user to send the message to
 
         Returns:
         bool: True if message sent successfully, False otherwise
         """
-        if not self.direct_messenger and self.recipient:
+        if not self.direct_messenger or not recipient:
             return False
         try:
-            self.direct_messenger.send(message, self.recipient)
-            return True
-        except DirectMessageError:
-            messagebox.showerror("Unable to publish.")
+            return self.direct_messenger.send(message, recipient)
+        except (DirectMessageError, OSError):
             return False
 
     def check_new(self):
         """
         Check for new messages from the server and update the interface.
+        Messages pushed by the server are picked up from the push queue,
+        otherwise the network worker polls the server.
+        """
+        if self._check_job is not None:
+            # Only one check loop runs, however often this is called
+            self.root.after_cancel(self._check_job)
+
+        if self.direct_messenger and self.notebook:
+            if self.direct_messenger.subscribed:
+                self._add_new_messages(self._take_pushed_messages())
+            elif not self._polling:
+                self._polling = True
+                self._submit(self.direct_messenger.retrieve_new,
+                             self._polled, self._poll_failed)
+
+        self._check_job = self.root.after(1000, self.check_new)
+
+    def _polled(self, messages: list):
+        """
+        Add the messages polled by the network worker.
+
+        Arguments:
+        messages: The new DirectMessage objects
+        """
+        self._polling = False
+        self._add_new_messages(messages)
+
+    def _poll_failed(self, _error: Exception):
+        """
+        Let the next check poll again after a failed poll.
+        """
+        self._polling = False
+
+    def _add_new_messages(self, new_messages: list):
+        """
+        Add new messages to the notebook and the interface.
+
+        Arguments:
+        new_messages: The new DirectMessage objects
+        """
+        for msg in new_messages:
+            direct_message = DirectMessage(
+                msg.message, msg.sender, self.username, msg.timestamp)
+
+            if msg.sender not in self.notebook.conversations:
+                self.body.insert_contact(msg.sender)
+            self.notebook.add_message(msg.sender, direct_message)
+
+            if self.recipient == msg.sender:
+                self.body.insert_contact_message(msg.message)
+
+        # Only writes when something changed since the last save
+        self.notebook.save(self.notebook.path)
+
+    def _submit(self, task, on_done=None, on_error=None):
+        """
+        Run a blocking network task on the network worker. The callbacks
+        run on the Tk thread, and are dropped if the user has logged in
+        again since the task was submitted.
+
+        Arguments:
+        task: Function doing the network call
+        on_done: Function called with the result of the task
+        on_error: Function called with the error raised by the task
+        """
+        session = self._session
+
+        def deliver(callback):
+            def run(value):
+                if callback is not None and session == self._session:
+                    callback(value)
+            return run
+
+        self.network.submit(task, deliver(on_done), deliver(on_error))
+
+    def close(self):
         """
+        Fold the notebook journal into the notebook file and close the
+        application window.
+        """
+        self.network.stop()
         if self.direct_messenger:
-            new_messages = self.direct_messenger.retrieve_new()
-            for msg in new_messages:
-                direct_message = DirectMessage(
-                    msg.message, msg.sender, self.username, msg.timestamp)
+            self.direct_messenger.close()
+        if self.notebook and self.notebook.path:
+            try:
+                self.notebook.compact()
+                self.notebook.writer.close()
+            except (NotebookFileError, OSError):
+                pass
+        self.root.destroy()
+
+    def search_messages(self):
+        """
+        Search the notebook for the words in the search box and list the
+        matching messages, newest first. Double-clicking a result opens
+        its conversation.
+        """
+        query = self.footer.get_search_query().strip()
+        if not query or not self.notebook:
+            return
 
-                if msg.sender in self.notebook.conversations:
-                    self.notebook.conversations[msg.sender].add_message(
-                        direct_message)
-                else:
-                    new_convo = Conversation(msg.sender)
-                    new_convo.add_message(direct_message)
-                    self.notebook.conversations[msg.sender] = new_convo
-                    self.body.insert_contact(msg.sender)
+        results = self.notebook.search(query)
+        window = tk.Toplevel(self.root)
+        window.title(f"Search: {query}")
+        listbox = tk.Listbox(window, width=80, height=15)
+        listbox.pack(fill=tk.BOTH, expand=True)
+        if not results:
+            listbox.insert(tk.END, "No messages found")
+        for recipient, message in results:
+            listbox.insert(tk.END, f"{recipient} | {message.get('sender')}: "
+                                   f"{message['entry']}")
 
-                if self.recipient == msg.sender:
-                    self.body.insert_contact_message(msg.message)
+        def open_result(_event):
+            selection = listbox.curselection()
+            if selection and selection[0] < len(results):
+                self.recipient_selected(results[selection[0]][0])
 
-            self.notebook.save(self.notebook.path)
+        listbox.bind('<Double-Button-1>', open_result)
 
-        self.root.after(1000, self.check_new)
+    def _take_pushed_messages(self) -> list:
+        """
+        Take every message pushed by the server since the last check.
+
+        Returns:
+        list: DirectMessage objects received from the push listener
+        """
+        messages = []
+        while True:
+            try:
+                messages.append(self.pushed_messages.get_nowait())
+            except queue.Empty:
+                return messages
 
     def _draw(self):
         """
@@ -609,7 +1044,8 @@ class MainApp(tk.Frame):
         self.footer = Footer(
             self.root,
             send_callback=self.send_message,
-            add_user_callback=self.add_contact)
+            add_user_callback=self.add_contact,
+            search_callback=self.search_messages)
         self.footer.pack(fill=tk.BOTH, side=tk.BOTTOM)
 
 
@@ -634,6 +1070,7 @@ if __name__ == "__main__":
     # subclass Tk.Frame, since our root frame is main, we initialize
     # the class with it.
     app = MainApp(main)
+    main.protocol("WM_DELETE_WINDOW", app.close)
 
     # When update is called, we finalize the states of all widgets that
     # have been configured within the root frame. Here, update ensures that
@@ -8,18 +8,52 @@ Direct messaging module for DSU server communication.
 
 This module provides classes for handling direct messages
 and messaging operations with a DSU server, including authentication,
-sending messages, and retrieving messages.
+sending messages, and retrieving messages. DirectMessenger is the
+blocking client and AsyncDirectMessenger its asyncio counterpart;
+DirectMessengerPool keeps DirectMessenger connections open for reuse.
 """
 
+import asyncio
+import json
+import queue
+import random
 import socket
+import threading
 import time
+import uuid
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from typing import AsyncIterator, Callable, Iterator, Optional, Tuple
 from ds_protocol import (
     authenticate_request,
+    broadcast_request,
     direct_message_request,
     fetch_request,
+    search_request,
+    subscribe_request,
     extract_json,
+    extract_push,
+    DSPPush,
     DSPResponse
 )
+from notebook import DirectMessageError
+
+# Largest number of pipelined requests waiting for a response
+PIPELINE_WINDOW = 64
+
+# Reconnect attempts after a dropped connection, and the backoff between
+# them in seconds: the delay doubles after every failed attempt
+RECONNECT_ATTEMPTS = 6
+RECONNECT_DELAY = 0.5
+RECONNECT_MAX_DELAY = 30
+
+# Default size and idle timeout (in seconds) of a DirectMessengerPool
+POOL_MAX_CONNECTIONS = 32
+POOL_IDLE_TIMEOUT = 300
+
+# Longest response line (in bytes) AsyncDirectMessenger can read, an
+# "all" fetch of a long history can be large
+READ_LIMIT = 64 * 1024 * 1024
 
 
 class DirectMessage:
@@ -32,7 +66,8 @@ class DirectMessage:
                  recipient: str = None,
                  message: str = None,
                  sender: str = None,
-                 timestamp: float = None) -> None:
+                 timestamp: float = None,
+                 message_id: int = None) -> None:
         """
         Initialize a DirectMessage object.
 
@@ -41,17 +76,19 @@ class DirectMessage:
         message: the content of the message
         sender: the username of the message sender
         timestamp: the timestamp when the message was sent
+        message_id: the server's sequence number for the message
         """
         self.recipient = recipient
         self.message = message
         self.sender = sender
         self.timestamp = timestamp
+        self.message_id = message_id
 
 
-class DirectMessenger:
+class _BaseMessenger:
     """
-    Handles direct messaging functionality including authentication,
-    sending messages, and retrieving messages from a DSU server.
+    State and response handling shared by DirectMessenger and
+    AsyncDirectMessenger.
     """
 
     def __init__(self,
@@ -59,8 +96,7 @@ class DirectMessenger:
                  username: str = None,
                  password: str = None) -> None:
         """
-        Initialize DirectMessenger and establish connection
-        to DSU server with authentication.
+        Initialize the state of a messenger.
 
         Arguments:
         dsuserver: the hostname or IP address of the DSU server
@@ -72,13 +108,141 @@ class DirectMessenger:
         self.password = password
         self.timestamp = None
         self.token = None
+        self.cursor = 0
+
+    def _track_cursor(self,
+                      messages: list[DirectMessage]) -> list[DirectMessage]:
+        """
+        Advance self.cursor past the messages of an "all" fetch.
+        Unread fetches and pushes skip messages sent by this user, so
+        only "all" fetches may move the cursor.
+
+        Arguments:
+        messages: the messages returned by the fetch
+
+        Returns:
+        list: the same messages
+        """
+        for dm in messages:
+            if dm.message_id is not None:
+                self.cursor = max(self.cursor, dm.message_id)
+        return messages
+
+    def _to_direct_messages(self,
+                            parsed: DSPResponse,
+                            recipient: str = None) -> list[DirectMessage]:
+        """
+        Convert the messages of a fetch response into DirectMessage objects.
+        Messages the user sent keep the recipient the server gives them
+        and have no sender.
+
+        Arguments:
+        parsed: the parsed fetch response
+        recipient: the recipient to record on received messages, if any
+
+        Returns:
+        list: A list of DirectMessage objects
+        """
+        messages = []
+
+        if parsed.type == 'ok' and parsed.messages:
+            for msg in parsed.messages:
+                dm = DirectMessage(
+                    sender=msg.get('from', None),
+                    recipient=msg.get('recipient', recipient),
+                    message=msg.get('message', None),
+                    timestamp=msg.get('timestamp', None),
+                    message_id=msg.get('id', None)
+                )
+                messages.append(dm)
+        return messages
+
+    def _to_conversation_messages(self,
+                                  parsed: DSPResponse) -> list[DirectMessage]:
+        """
+        Convert the messages of a response holding both received and sent
+        messages into DirectMessage objects with sender and recipient set.
+
+        Arguments:
+        parsed: the parsed response
+
+        Returns:
+        list: A list of DirectMessage objects
+        """
+        messages = []
+        if parsed.type == 'ok' and parsed.messages:
+            for msg in parsed.messages:
+                messages.append(DirectMessage(
+                    sender=msg.get('from', self.username),
+                    recipient=msg.get('recipient', self.username),
+                    message=msg.get('message', None),
+                    timestamp=msg.get('timestamp', None),
+                    message_id=msg.get('id', None)))
+        return messages
+
+
+class DirectMessenger(_BaseMessenger):
+    """
+    Handles direct messaging functionality including authentication,
+    sending messages, and retrieving messages from a DSU server.
+    """
+
+    def __init__(self,
+                 dsuserver: str = None,
+                 username: str = None,
+                 password: str = None,
+                 port: int = 3001,
+                 reconnect_attempts: int = RECONNECT_ATTEMPTS) -> None:
+        """
+        Initialize DirectMessenger and establish connection
+        to DSU server with authentication.
+
+        Arguments:
+        dsuserver: the hostname or IP address of the DSU server
+        username: the username for authentication
+        password: the password for authentication
+        port: the port of the DSU server
+        reconnect_attempts: how many times to try reconnecting after the
+        connection drops before giving up, 0 to never reconnect
+        """
+        super().__init__(dsuserver, username, password)
+        self.port = port
+        self.reconnect_attempts = reconnect_attempts
+        self.socket = None
+        self._listener = None
+        self._responses = queue.Queue()
+        self._pushed = queue.Queue()
+        self._push_callback = None
+        self._push_wanted = False
+        # Id of the newest message pushed or fetched as unread, where a
+        # new connection catches up from
+        self._push_cursor = 0
+        self._closed = False
+        # Bumped by every new connection, so threads that saw the same
+        # connection drop only reconnect once
+        self._generation = 0
+        # Held from writing a request until its response is read, and
+        # while reconnecting, so a reconnect made by the push listener
+        # and requests made by the caller never share the connection
+        self._request_lock = threading.RLock()
+        self._connect()
+
+    def _connect(self) -> None:
+        """
+        Open a new connection to the server, authenticate and, if this
+        messenger was subscribed, subscribe again. Messages that arrived
+        while disconnected stay unread on the server, so nothing is lost.
+
+        Raises DirectMessageError if the server rejects the credentials
+        """
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.socket.connect((self.dsuserver, 3001))
+        self.socket.connect((self.dsuserver, self.port))
 
         self.writer = self.socket.makefile('w')
         self.reader = self.socket.makefile('r')
+        self._generation += 1
 
-        auth_msg = authenticate_request(username, password)
+        auth_msg = authenticate_request(self.username, self.password)
         self.writer.write(auth_msg + "\r\n")
         self.writer.flush()
 
@@ -89,7 +253,142 @@ class DirectMessenger:
         if resp.type == 'ok':
             self.token = resp.token
         else:
-            raise Exception("Could not authenticate")
+            raise DirectMessageError("Could not authenticate")
+
+        if self._push_wanted:
+            self._catch_up()
+            self._responses = queue.Queue()
+            self._start_listener()
+            self._track_push_start(
+                self._exchange(subscribe_request(self.token)))
+
+    def _catch_up(self) -> None:
+        """
+        Pass the messages received since the last one seen to the
+        subscriber, before subscribing on a new connection. The server
+        counts a push as read once it is written, so pushes written to a
+        connection that had already dropped are only found this way.
+        Starts from the first message if none was seen and the server
+        did not say where its pushes start.
+        """
+        since = max(self.cursor, self._push_cursor)
+        with self._request_lock:
+            self.writer.write(fetch_request(self.token, "all", since=since)
+                              + "\r\n")
+            self.writer.flush()
+            parsed = extract_json(self.reader.readline())
+        for dm in self._track_push_cursor(self._to_direct_messages(parsed)):
+            # Messages this user sent have no sender
+            if dm.sender is not None:
+                self._deliver_push(dm)
+
+    def _track_push_cursor(self,
+                           messages: list[DirectMessage]
+                           ) -> list[DirectMessage]:
+        """
+        Advance self._push_cursor past pushed or unread messages.
+
+        Arguments:
+        messages: the messages received
+
+        Returns:
+        list: the same messages
+        """
+        for dm in messages:
+            if dm.message_id is not None:
+                self._push_cursor = max(self._push_cursor, dm.message_id)
+        return messages
+
+    def _track_push_start(self, parsed: DSPResponse) -> DSPResponse:
+        """
+        Advance self._push_cursor to where the pushes of a new
+        subscription start, so catching up after the connection drops
+        fetches every push that may have been lost, and nothing older.
+
+        Arguments:
+        parsed: the parsed response to the subscribe request
+
+        Returns:
+        DSPResponse: the same response
+        """
+        if parsed.type == 'ok' and parsed.next is not None:
+            self._push_cursor = max(self._push_cursor, parsed.next)
+        return parsed
+
+    def _reconnect(self, generation: int) -> None:
+        """
+        Replace a dropped connection, waiting exponentially longer
+        between failed attempts. Does nothing if another thread already
+        replaced the connection.
+
+        Arguments:
+        generation: the value of self._generation when the connection
+        was seen to drop
+
+        Raises ConnectionError if every attempt fails, DirectMessageError
+        if the server rejects the credentials
+        """
+        with self._request_lock:
+            if generation != self._generation:
+                return
+            if self._closed:
+                raise ConnectionError("Connection closed")
+            self._close_socket()
+
+            delay = RECONNECT_DELAY
+            for attempt in range(self.reconnect_attempts):
+                if self._closed:
+                    break
+                if attempt:
+                    # Jitter keeps clients dropped together from all
+                    # reconnecting at the same moment
+                    time.sleep(delay * random.uniform(0.5, 1))
+                    delay = min(delay * 2, RECONNECT_MAX_DELAY)
+                try:
+                    self._connect()
+                    return
+                except OSError:
+                    self._close_socket()
+                except DirectMessageError:
+                    # Trying again cannot fix rejected credentials
+                    self._close_socket()
+                    raise
+            raise ConnectionError("Could not reconnect to the server")
+
+    def _close_socket(self) -> None:
+        """
+        Close the current socket, if any, ignoring errors.
+        """
+        if self.socket is not None:
+            try:
+                self.socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.socket.close()
+
+    def close(self) -> None:
+        """
+        Close the connection for good. The messenger will not reconnect.
+        """
+        self._closed = True
+        self._close_socket()
+
+    def _with_current_token(self, request: str) -> str:
+        """
+        Put the token of the current connection in a request made before
+        a reconnect.
+
+        Arguments:
+        request: the formatted request string
+
+        Returns:
+        str: the request with the current token
+        """
+        command = json.loads(request)
+        if 'token' not in command:
+            return request
+        command['token'] = self.token
+        return json.dumps(command)
 
     def send(self,
              message: str,
@@ -108,7 +407,7 @@ class DirectMessenger:
             return False
 
         direct_message = direct_message_request(
-            self.token, message, recipient, time.time())
+            self.token, message, recipient, time.time(), uuid.uuid4().hex)
         parsed = self.parse_message(direct_message)
         print(f"Server response: {parsed}")
 
@@ -117,30 +416,71 @@ class DirectMessenger:
         print(f"Failed to send: {parsed.message}")
         return False
 
-    def retrieve_new(self) -> list[DirectMessage]:
+    def broadcast(self,
+                  message: str,
+                  recipients: list[str]) -> dict[str, bool]:
+        """
+        Send the same direct message to several recipients with a single
+        request, which the server stores in one transaction.
+
+        Arguments:
+        message: str, the content of the message to send
+        recipients: the usernames of the message recipients
+
+        Returns:
+        dict: recipient -> True if the message was sent to that recipient
+        """
+        if not self.token:
+            return {recipient: False for recipient in recipients}
+
+        parsed = self.parse_message(broadcast_request(
+            self.token, message, recipients, time.time(), uuid.uuid4().hex))
+        return _broadcast_results(parsed, recipients)
+
+    def send_many(self,
+                  messages: list[tuple[str, str]]) -> list[bool]:
+        """
+        Send several direct messages, pipelining the requests so the
+        whole batch costs about one round trip instead of one per message.
+
+        Arguments:
+        messages: list of (message, recipient) tuples to send
+
+        Returns:
+        list: one bool per message, True if it was sent successfully
+        """
+        if not self.token:
+            return [False] * len(messages)
+
+        requests = [direct_message_request(self.token, message,
+                                           recipient, time.time(),
+                                           uuid.uuid4().hex)
+                    for message, recipient in messages]
+        return [parsed.type == 'ok'
+                for parsed in self.parse_messages(requests)]
+
+    def retrieve_new(self,
+                     wait: Optional[float] = None) -> list[DirectMessage]:
         """
         Retrieve all new (unread) messages from the server.
 
+        Arguments:
+        wait: seconds the server may wait for a new message when none
+        are unread (long polling), None to return immediately
+
         Returns:
         list: A list of DirectMessage objects containing new messages
+
+        Raises ConnectionError if the connection drops before the
+        response arrives, as the server may already have marked the
+        messages read (retrieve_since still returns them)
         """
         if not self.token:
             return []
 
-        new_fetch_request = fetch_request(self.token, "unread")
+        new_fetch_request = fetch_request(self.token, "unread", wait)
         parsed = self.parse_message(new_fetch_request)
-
-        messages = []
-
-        if parsed.type == 'ok' and parsed.messages:
-            for msg in parsed.messages:
-                dm = DirectMessage(
-                    sender=msg.get('from', None),
-                    message=msg.get('message', None),
-                    timestamp=msg.get('timestamp', None)
-                )
-                messages.append(dm)
-        return messages
+        return self._track_push_cursor(self._to_direct_messages(parsed))
 
     def retrieve_all(self) -> list[DirectMessage]:
         """
@@ -154,22 +494,284 @@ class DirectMessenger:
 
         all_fetch_request = fetch_request(self.token, "all")
         parsed = self.parse_message(all_fetch_request)
-        messages = []
+        return self._track_cursor(
+            self._to_direct_messages(parsed, self.username))
 
-        if parsed.type == 'ok' and parsed.messages:
-            for msg in parsed.messages:
-                dm = DirectMessage(
-                    sender=msg.get('from', None),
-                    recipient=self.username,
-                    message=msg.get('message', None),
-                    timestamp=msg.get('timestamp', None)
-                )
-                messages.append(dm)
-        return messages
+    def retrieve_since(self, cursor: int) -> list[DirectMessage]:
+        """
+        Retrieve only the messages after a cursor returned by an earlier
+        retrieve_all or retrieve_since, so a re-login downloads just the
+        messages it has not seen. The new cursor is stored in self.cursor.
+
+        Arguments:
+        cursor: the message id of the last message already retrieved
+
+        Returns:
+        list: A list of DirectMessage objects newer than the cursor
+        """
+        if not self.token:
+            return []
+
+        since_fetch_request = fetch_request(self.token, "all", since=cursor)
+        parsed = self.parse_message(since_fetch_request)
+        self.cursor = max(self.cursor, cursor)
+        return self._track_cursor(
+            self._to_direct_messages(parsed, self.username))
+
+    def retrieve_conversation(self,
+                              peer: str,
+                              limit: Optional[int] = None,
+                              before: Optional[int] = None
+                              ) -> list[DirectMessage]:
+        """
+        Retrieve only the conversation with one user, oldest first.
+        With a limit, the newest limit messages (before the given id)
+        are returned, so older history can be loaded page by page.
+
+        Arguments:
+        peer: the username of the other side of the conversation
+        limit: the largest number of messages to return
+        before: only return messages with a smaller id
+
+        Returns:
+        list: DirectMessage objects with sender and recipient set
+        for both received and sent messages
+        """
+        if not self.token:
+            return []
+
+        request = fetch_request(self.token, "all", before=before,
+                                limit=limit, order='desc', peer=peer)
+        parsed = self.parse_message(request)
+        return self._to_conversation_messages(parsed)[::-1]
+
+    def search(self,
+               query: str,
+               peer: Optional[str] = None,
+               start: Optional[float] = None,
+               end: Optional[float] = None,
+               limit: Optional[int] = None) -> list[DirectMessage]:
+        """
+        Search the user's messages on the server, without downloading
+        the rest of the history. Every word of the query must appear in
+        a message, and a word ending in '*' matches any word starting
+        with it. Found messages are not marked as read.
+
+        Arguments:
+        query: the words to look for
+        peer: only search the conversation with this user
+        start: only return messages with a timestamp of at least start
+        end: only return messages with a timestamp before end
+        limit: the largest number of messages to return
+
+        Returns:
+        list: DirectMessage objects with sender and recipient set,
+        newest first
+        """
+        if not self.token:
+            return []
+
+        request = search_request(self.token, query, peer=peer, start=start,
+                                 end=end, limit=limit)
+        parsed = self.parse_message(request)
+        return self._to_conversation_messages(parsed)
+
+    def iter_all(self,
+                 page_size: int = 100,
+                 newest_first: bool = False) -> Iterator[DirectMessage]:
+        """
+        Lazily walk every message on the server one page at a time,
+        fetching the next page only when the previous one is used up.
+
+        Arguments:
+        page_size: number of messages requested per page
+        newest_first: walk from the newest message back to the oldest
+
+        Returns:
+        iterator: DirectMessage objects in timestamp order
+        (reversed if newest_first)
+        """
+        if not self.token:
+            return
+        order = 'desc' if newest_first else 'asc'
+        page = {}
+        while True:
+            request = fetch_request(self.token, "all", limit=page_size,
+                                    order=order, **page)
+            parsed = self.parse_message(request)
+            messages = self._to_direct_messages(parsed, self.username)
+            if not newest_first:
+                self._track_cursor(messages)
+            yield from messages
+            if parsed.type != 'ok' or parsed.next is None:
+                return
+            page = {'before' if newest_first else 'since': parsed.next}
+
+    def retrieve_many(self,
+                      fetch_types: list[str]) -> list[list[DirectMessage]]:
+        """
+        Send several fetch requests in one pipelined batch.
+
+        Arguments:
+        fetch_types: list of fetch types ("all" or "unread")
+
+        Returns:
+        list: one list of DirectMessage objects per fetch type
+        """
+        if not self.token:
+            return [[] for _ in fetch_types]
+
+        requests = [fetch_request(self.token, fetch_type)
+                    for fetch_type in fetch_types]
+        responses = self.parse_messages(requests)
+        results = []
+        for fetch_type, parsed in zip(fetch_types, responses):
+            if fetch_type == 'all':
+                results.append(self._track_cursor(
+                    self._to_direct_messages(parsed, self.username)))
+            else:
+                results.append(self._to_direct_messages(parsed))
+        return results
+
+    def subscribe(self,
+                  callback: Optional[Callable[[DirectMessage], None]] = None
+                  ) -> bool:
+        """
+        Ask the server to push new messages on this connection instead of
+        waiting for retrieve_new calls. Pushed messages are passed to the
+        callback, or queued for incoming() when no callback is given.
+        The callback runs on a background thread.
+
+        Arguments:
+        callback: function called with each pushed DirectMessage
+
+        Returns:
+        bool: True if the server accepted the subscription
+        """
+        if not self.token:
+            return False
+        if self.subscribed:
+            return True
+
+        self._push_callback = callback
+        self._push_wanted = True
+        self._start_listener()
+
+        parsed = self._track_push_start(
+            self.parse_message(subscribe_request(self.token)))
+        return parsed.type == 'ok'
+
+    def _start_listener(self) -> None:
+        """
+        Start the background thread that owns the reader from now on and
+        separates pushed messages from responses to requests.
+        """
+        self._listener = threading.Thread(
+            target=self._listen, args=(self.reader, self._generation),
+            daemon=True)
+        self._listener.start()
+
+    @property
+    def subscribed(self) -> bool:
+        """
+        Whether pushed messages are currently being received.
+
+        Returns:
+        bool: True while the push listener is running
+        """
+        return self._listener is not None and self._listener.is_alive()
+
+    def incoming(self,
+                 timeout: Optional[float] = None) -> Iterator[DirectMessage]:
+        """
+        Iterate over pushed messages, blocking until each one arrives.
+
+        Arguments:
+        timeout: seconds to wait for the next message before the
+        iteration stops, None to wait forever
+
+        Returns:
+        iterator: DirectMessage objects in the order they were pushed
+        """
+        while True:
+            try:
+                dm = self._pushed.get(timeout=timeout)
+            except queue.Empty:
+                return
+            if dm is None:
+                return
+            yield dm
+
+    def _listen(self, reader, generation: int) -> None:
+        """
+        Read every line sent by the server, dispatching pushes to the
+        subscriber and queueing responses for parse_message. When the
+        connection drops, reconnect so pushes keep coming.
+
+        Arguments:
+        reader: the reader of the connection to listen on
+        generation: the value of self._generation for that connection
+        """
+        responses = self._responses
+        try:
+            for line in reader:
+                push = extract_push(line)
+                if push is None:
+                    responses.put(line)
+                elif push.type == 'directmessage':
+                    self._deliver_push(self._track_push_cursor(
+                        self._to_direct_messages(DSPResponse(
+                            'ok', None, None, [push.message])))[0])
+        except (OSError, ValueError):
+            pass
+        finally:
+            # Connection closed, wake up anyone waiting on it
+            responses.put('')
+        if not self._closed and self.reconnect_attempts:
+            try:
+                self._reconnect(generation)
+                return
+            except Exception:  # pylint: disable=broad-except
+                pass
+        self._pushed.put(None)
+
+    def _deliver_push(self, dm: DirectMessage) -> None:
+        """
+        Pass a pushed message to the subscriber. An error raised by the
+        callback is printed, so it cannot stop the listener.
+
+        Arguments:
+        dm: the pushed message
+        """
+        if not self._push_callback:
+            self._pushed.put(dm)
+            return
+        try:
+            self._push_callback(dm)
+        except Exception as ex:  # pylint: disable=broad-except
+            print(f"Push callback failed: {ex}")
+
+    def _read_response(self) -> str:
+        """
+        Read the next response line, from the push listener if subscribed.
+
+        Returns:
+        str: the raw response line
+        """
+        if self._listener is None:
+            return self.reader.readline()
+        if self._listener.is_alive():
+            return self._responses.get()
+        try:
+            return self._responses.get_nowait()
+        except queue.Empty:
+            return ''
 
     def parse_message(self, request: str) -> DSPResponse:
         """
-        Send a fetch request to the server and parse the response.
+        Send a fetch request to the server and parse the response. If the
+        connection has dropped, reconnect and, if it is safe to, send the
+        request again (see parse_messages).
 
         Arguments:
         fetch_request: str, the formatted fetch request
@@ -178,9 +780,758 @@ class DirectMessenger:
         Returns:
         DSPResponse: The parsed response object from the server
         """
-        self.writer.write(request + '\r\n')
+        return self.parse_messages([request])[0]
 
-        self.writer.flush()
-        response = self.reader.readline()
-        parsed = extract_json(response)
-        return parsed
+    def parse_messages(self, requests: list[str]) -> list[DSPResponse]:
+        """
+        Pipeline several requests: write them back-to-back and then read
+        the responses, which the server sends in request order. At most
+        PIPELINE_WINDOW requests are left unanswered at a time so neither
+        side can block on a full socket buffer.
+
+        If the connection drops, reconnect and send the requests that
+        were not answered again. The server may already have applied a
+        request whose response was lost, so this is only done when every
+        one of them is safe to apply twice: direct messages carrying an
+        id, which the server stores once, and requests that change
+        nothing. Otherwise ConnectionError is raised.
+
+        Arguments:
+        requests: list of formatted request strings to send
+
+        Returns:
+        list: the parsed responses, in the same order as the requests
+        """
+        with self._request_lock:
+            generation = self._generation
+            # The push listener may have reconnected since the requests
+            # were made, which changes the token
+            requests = [request if self.token in request
+                        else self._with_current_token(request)
+                        for request in requests]
+            responses = self._pipeline(requests)
+            if len(responses) < len(requests) and self.reconnect_attempts:
+                self._reconnect(generation)
+                rest = requests[len(responses):]
+                if not all(_can_resend(request) for request in rest):
+                    raise ConnectionError(
+                        "Connection lost before the server answered")
+                responses += self._pipeline(
+                    [self._with_current_token(request) for request in rest])
+        # Still unanswered requests parse as an empty response, as
+        # before reconnecting existed
+        while len(responses) < len(requests):
+            responses.append(extract_json(''))
+        return responses
+
+    def _pipeline(self, requests: list[str]) -> list[DSPResponse]:
+        """
+        Write requests and read their responses, stopping at the first
+        sign of a dropped connection.
+
+        Arguments:
+        requests: list of formatted request strings to send
+
+        Returns:
+        list: the parsed responses received, in request order
+        """
+        responses = []
+        in_flight = 0
+        with self._request_lock:
+            try:
+                for request in requests:
+                    self.writer.write(request + '\r\n')
+                    in_flight += 1
+                    if in_flight == PIPELINE_WINDOW:
+                        self.writer.flush()
+                        response = self._read_response()
+                        if not response:
+                            return responses
+                        responses.append(extract_json(response))
+                        in_flight -= 1
+
+                self.writer.flush()
+                for _ in range(in_flight):
+                    response = self._read_response()
+                    if not response:
+                        return responses
+                    responses.append(extract_json(response))
+            except (OSError, ValueError):
+                pass
+        return responses
+
+    def _exchange(self, request: str) -> DSPResponse:
+        """
+        Send one request on the current connection without reconnecting.
+
+        Arguments:
+        request: the formatted request string
+
+        Returns:
+        DSPResponse: The parsed response object from the server
+        """
+        with self._request_lock:
+            self.writer.write(request + '\r\n')
+            self.writer.flush()
+            return extract_json(self._read_response())
+
+
+class DirectMessengerPool:
+    """
+    Keeps authenticated DirectMessenger connections open so sending on
+    behalf of many users does not pay for a new connection and an
+    authentication round trip every time. Connections are keyed by
+    (server, username), at most max_connections are open at once, idle
+    ones are closed least recently used first or after idle_timeout
+    seconds, and each is checked to still be open before it is reused.
+
+    A connection is used by one caller at a time, so the pool can be
+    shared by threads.
+
+    Example usage:
+
+    ```
+    pool = DirectMessengerPool(max_connections=64)
+    with pool.connection('localhost', 'bot1', 'pw') as dm:
+        dm.send('hi', 'user')
+    pool.close()
+    ```
+    """
+
+    def __init__(self,
+                 max_connections: int = POOL_MAX_CONNECTIONS,
+                 idle_timeout: float = POOL_IDLE_TIMEOUT,
+                 port: int = 3001) -> None:
+        """
+        Create an empty DirectMessengerPool.
+
+        Arguments:
+        max_connections: the largest number of open connections
+        idle_timeout: seconds an unused connection is kept open
+        port: the port of the DSU servers
+        """
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.port = port
+        # (server, username) -> [(messenger, time released)], with the
+        # least recently used key first
+        self._idle: OrderedDict[Tuple[str, str], list] = OrderedDict()
+        self._open = 0
+        self._condition = threading.Condition()
+        self._closed = False
+
+    def __len__(self) -> int:
+        return self._open
+
+    @contextmanager
+    def connection(self,
+                   dsuserver: str,
+                   username: str,
+                   password: str) -> Iterator[DirectMessenger]:
+        """
+        Borrow a connection for a user, giving it back to the pool when
+        done. A connection that raised an error is closed instead.
+
+        Arguments:
+        dsuserver: the hostname or IP address of the DSU server
+        username: the username for authentication
+        password: the password for authentication
+
+        Returns:
+        context manager: the authenticated DirectMessenger
+        """
+        dm = self.acquire(dsuserver, username, password)
+        failed = True
+        try:
+            yield dm
+            failed = False
+        finally:
+            self.release(dm, discard=failed)
+
+    def send(self,
+             dsuserver: str,
+             username: str,
+             password: str,
+             message: str,
+             recipient: str) -> bool:
+        """
+        Send a direct message on behalf of a user.
+
+        Arguments:
+        dsuserver: the hostname or IP address of the DSU server
+        username: the username of the sender
+        password: the password of the sender
+        message: str, the content of the message to send
+        recipient: str, the username of the message recipient
+
+        Returns:
+        bool: True if message was sent successfully, False otherwise
+        """
+        with self.connection(dsuserver, username, password) as dm:
+            return dm.send(message, recipient)
+
+    def acquire(self,
+                dsuserver: str,
+                username: str,
+                password: str) -> DirectMessenger:
+        """
+        Take a connection for a user out of the pool, opening a new one
+        if none is idle. Blocks while max_connections are in use.
+        Every acquired connection must be given back with release.
+
+        Arguments:
+        dsuserver: the hostname or IP address of the DSU server
+        username: the username for authentication
+        password: the password for authentication
+
+        Returns:
+        DirectMessenger: the authenticated DirectMessenger
+        """
+        key = (dsuserver, username)
+        with self._condition:
+            while True:
+                if self._closed:
+                    raise ConnectionError("Pool closed")
+                self._close_expired()
+                dm = self._take_idle(key, password)
+                if dm is not None:
+                    return dm
+                if self._open < self.max_connections:
+                    self._open += 1
+                    break
+                if not self._evict_one():
+                    self._condition.wait()
+
+        # Connect outside the lock so other callers are not held up
+        try:
+            return DirectMessenger(dsuserver, username, password,
+                                   port=self.port)
+        except BaseException:
+            with self._condition:
+                self._open -= 1
+                self._condition.notify()
+            raise
+
+    def release(self, dm: DirectMessenger, discard: bool = False) -> None:
+        """
+        Give a connection back to the pool.
+
+        Arguments:
+        dm: a DirectMessenger returned by acquire
+        discard: close the connection instead of keeping it
+        """
+        key = (dm.dsuserver, dm.username)
+        with self._condition:
+            if discard or self._closed:
+                self._close(dm)
+            else:
+                self._idle.setdefault(key, []).append(
+                    (dm, time.monotonic()))
+                self._idle.move_to_end(key)
+            self._condition.notify()
+
+    def close(self) -> None:
+        """
+        Close every idle connection. Connections in use are closed when
+        they are released.
+        """
+        with self._condition:
+            self._closed = True
+            for idle in self._idle.values():
+                for dm, _ in idle:
+                    self._close(dm)
+            self._idle.clear()
+            self._condition.notify_all()
+
+    def _take_idle(self,
+                   key: Tuple[str, str],
+                   password: str) -> Optional[DirectMessenger]:
+        """
+        Take the most recently used healthy idle connection of a key,
+        closing the ones found dead on the way.
+
+        Arguments:
+        key: the (server, username) of the connection
+        password: the password the caller authenticated with
+
+        Returns:
+        DirectMessenger: the connection, or None if there is none
+        """
+        idle = self._idle.get(key)
+        if not idle or idle[-1][0].password != password:
+            # A connection is only handed to callers who know the
+            # password it was opened with
+            return None
+        while idle:
+            dm, _ = idle.pop()
+            if _connection_alive(dm):
+                break
+            self._close(dm)
+            dm = None
+        if not idle:
+            del self._idle[key]
+        else:
+            self._idle.move_to_end(key)
+        return dm
+
+    def _evict_one(self) -> bool:
+        """
+        Close the least recently used idle connection.
+
+        Returns:
+        bool: False if no connection was idle
+        """
+        for key, idle in self._idle.items():
+            dm, _ = idle.pop(0)
+            if not idle:
+                del self._idle[key]
+            self._close(dm)
+            return True
+        return False
+
+    def _close_expired(self) -> None:
+        """
+        Close the connections idle for longer than idle_timeout.
+        """
+        oldest = time.monotonic() - self.idle_timeout
+        for key, idle in list(self._idle.items()):
+            while idle and idle[0][1] < oldest:
+                self._close(idle.pop(0)[0])
+            if not idle:
+                del self._idle[key]
+
+    def _close(self, dm: DirectMessenger) -> None:
+        """
+        Close a connection of the pool.
+
+        Arguments:
+        dm: the DirectMessenger to close
+        """
+        self._open -= 1
+        dm.close()
+
+
+def _broadcast_results(parsed: DSPResponse,
+                       recipients: list[str]) -> dict[str, bool]:
+    """
+    Read the per-recipient status of a broadcast response.
+
+    Arguments:
+    parsed: the response to the broadcast request
+    recipients: the usernames the message was sent to
+
+    Returns:
+    dict: recipient -> True if the message was sent to that recipient
+    """
+    results = parsed.results or {}
+    return {recipient: results.get(recipient) == 'ok'
+            for recipient in recipients}
+
+
+def _can_resend(request: str) -> bool:
+    """
+    Check whether a request does no harm if the server gets it twice, so
+    it can be sent again when its response was lost. A direct message is
+    only stored once if it carries an id, and an unread fetch marks its
+    messages read, so sent again it would not return them.
+
+    Arguments:
+    request: the formatted request string
+
+    Returns:
+    bool: True if the request can be sent again
+    """
+    command = json.loads(request)
+    if 'fetch' in command:
+        return command['fetch'] != 'unread'
+    if 'directmessage' in command:
+        args = command['directmessage']
+        if isinstance(args, dict):
+            return 'id' in args
+        return args != 'unread'
+    return True
+
+
+def _connection_alive(dm: DirectMessenger) -> bool:
+    """
+    Check without blocking that the server has not closed a connection.
+    An idle connection has nothing to read, so a peek that would block
+    means the connection is open, while end of file (or data nobody
+    asked for) means it cannot be reused.
+
+    Arguments:
+    dm: the DirectMessenger to check
+
+    Returns:
+    bool: True if the connection can be reused
+    """
+    if dm.subscribed:
+        # The push listener is reading, and stops once the server closes
+        return True
+    sock = dm.socket
+    if sock is None or sock.fileno() == -1:
+        return False
+    try:
+        sock.setblocking(False)
+        try:
+            sock.recv(1, socket.MSG_PEEK)
+        finally:
+            sock.setblocking(True)
+    except BlockingIOError:
+        return True
+    except OSError:
+        return False
+    return False
+
+
+class AsyncDirectMessenger(_BaseMessenger):
+    """
+    asyncio version of DirectMessenger. One instance holds one
+    authenticated connection, and any number of requests can be in
+    flight on it at once: each request is written as soon as it is made
+    and the server answers in request order, so a single reader task
+    matches every response line to the oldest waiting request. Pushed
+    messages are recognized and routed to the subscriber instead.
+    Thousands of instances can share one event loop, with no thread per
+    connection. Entering it with async with raises DirectMessageError
+    if the server rejects the credentials, like DirectMessenger.
+
+    Example usage:
+
+    ```
+    async with AsyncDirectMessenger('localhost', 'bot1', 'pw') as dm:
+        sent = await asyncio.gather(*(dm.send('hi', user)
+                                      for user in users))
+    ```
+    """
+
+    def __init__(self,
+                 dsuserver: str = None,
+                 username: str = None,
+                 password: str = None,
+                 port: int = 3001) -> None:
+        """
+        Initialize an AsyncDirectMessenger. Nothing is sent until
+        connect is awaited.
+
+        Arguments:
+        dsuserver: the hostname or IP address of the DSU server
+        username: the username for authentication
+        password: the password for authentication
+        port: the port of the DSU server
+        """
+        super().__init__(dsuserver, username, password)
+        self.port = port
+        self._reader = None
+        self._writer = None
+        self._reader_task = None
+        self._waiting = deque()
+        self._pushed = None
+        self._push_callback = None
+        self._subscribed = False
+
+    async def __aenter__(self) -> 'AsyncDirectMessenger':
+        if not await self.connect():
+            await self.close()
+            raise DirectMessageError("Could not authenticate")
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
+
+    async def connect(self) -> bool:
+        """
+        Open the connection to the server and authenticate.
+
+        Returns:
+        bool: True if the server accepted the username and password
+        """
+        self._reader, self._writer = await asyncio.open_connection(
+            self.dsuserver, self.port, limit=READ_LIMIT)
+        self._pushed = asyncio.Queue()
+        self._reader_task = asyncio.create_task(self._read_loop())
+
+        parsed = await self.request(
+            authenticate_request(self.username, self.password))
+        if parsed.type == 'ok':
+            self.token = parsed.token
+            return True
+        return False
+
+    async def close(self) -> None:
+        """
+        Close the connection. Requests still waiting for a response
+        fail with ConnectionError.
+        """
+        if self._writer is not None:
+            self._writer.close()
+            try:
+                await self._writer.wait_closed()
+            except OSError:
+                pass
+        if self._reader_task is not None:
+            await self._reader_task
+
+    async def request(self, request: str) -> DSPResponse:
+        """
+        Send a request and wait for its response. Other requests may be
+        sent while this one waits.
+
+        Arguments:
+        request: the formatted request string
+
+        Returns:
+        DSPResponse: the parsed response
+
+        Raises ConnectionError if the connection closes first
+        """
+        if (self._writer is None or self._writer.is_closing()
+                or self._reader_task.done()):
+            raise ConnectionError("Not connected")
+        response = asyncio.get_running_loop().create_future()
+        # No await between queueing the future and writing the request,
+        # so the order of self._waiting is the order on the wire
+        self._waiting.append(response)
+        self._writer.write((request + '\r\n').encode())
+        await self._writer.drain()
+        return await response
+
+    async def _read_loop(self) -> None:
+        """
+        Read every line sent by the server, resolving the oldest waiting
+        request with each response and dispatching pushes. However the
+        loop ends, every request still waiting fails with ConnectionError.
+        """
+        try:
+            while True:
+                line = await self._reader.readline()
+                if not line:
+                    break
+                line = line.decode()
+                push = extract_push(line)
+                if push is None:
+                    if self._waiting:
+                        response = self._waiting.popleft()
+                        if not response.done():
+                            response.set_result(extract_json(line))
+                elif push.type == 'directmessage':
+                    await self._dispatch_push(push)
+        except (OSError, ValueError, asyncio.IncompleteReadError):
+            pass
+        except Exception as ex:  # pylint: disable=broad-except
+            print(f"Reading from the server failed: {ex}")
+        finally:
+            # Connection closed, fail everyone still waiting on it
+            while self._waiting:
+                response = self._waiting.popleft()
+                if not response.done():
+                    response.set_exception(
+                        ConnectionError("Connection closed"))
+            self._subscribed = False
+            self._pushed.put_nowait(None)
+
+    async def _dispatch_push(self, push: DSPPush) -> None:
+        """
+        Pass a pushed message to the subscriber. An error raised by the
+        callback is printed, so it cannot stop the reader.
+
+        Arguments:
+        push: the pushed message
+        """
+        dm = self._to_direct_messages(
+            DSPResponse('ok', None, None, [push.message]))[0]
+        if self._push_callback is None:
+            self._pushed.put_nowait(dm)
+            return
+        try:
+            result = self._push_callback(dm)
+            if asyncio.iscoroutine(result):
+                await result
+        except Exception as ex:  # pylint: disable=broad-except
+            print(f"Push callback failed: {ex}")
+
+    async def send(self,
+                   message: str,
+                   recipient: str) -> bool:
+        """
+        Send a direct message to a specified recipient.
+
+        Arguments:
+        message: str, the content of the message to send
+        recipient: str, the username of the message recipient
+
+        Returns:
+        bool: True if message was sent successfully, False otherwise
+        """
+        if not self.token:
+            return False
+        parsed = await self.request(direct_message_request(
+            self.token, message, recipient, time.time()))
+        return parsed.type == 'ok'
+
+    async def broadcast(self,
+                        message: str,
+                        recipients: list[str]) -> dict[str, bool]:
+        """
+        Send the same direct message to several recipients with a single
+        request.
+
+        Arguments:
+        message: str, the content of the message to send
+        recipients: the usernames of the message recipients
+
+        Returns:
+        dict: recipient -> True if the message was sent to that recipient
+        """
+        if not self.token:
+            return {recipient: False for recipient in recipients}
+        parsed = await self.request(broadcast_request(
+            self.token, message, recipients, time.time()))
+        return _broadcast_results(parsed, recipients)
+
+    async def retrieve_new(self,
+                           wait: Optional[float] = None
+                           ) -> list[DirectMessage]:
+        """
+        Retrieve all new (unread) messages from the server.
+
+        Arguments:
+        wait: seconds the server may wait for a new message when none
+        are unread (long polling), None to return immediately
+
+        Returns:
+        list: A list of DirectMessage objects containing new messages
+        """
+        if not self.token:
+            return []
+        parsed = await self.request(
+            fetch_request(self.token, "unread", wait))
+        return self._to_direct_messages(parsed)
+
+    async def retrieve_all(self) -> list[DirectMessage]:
+        """
+        Retrieve all messages (both read and unread) from the server.
+
+        Returns:
+        list: A list of DirectMessage objects containing all messages
+        """
+        if not self.token:
+            return []
+        parsed = await self.request(fetch_request(self.token, "all"))
+        return self._track_cursor(
+            self._to_direct_messages(parsed, self.username))
+
+    async def retrieve_since(self, cursor: int) -> list[DirectMessage]:
+        """
+        Retrieve only the messages after a cursor returned by an earlier
+        retrieve_all or retrieve_since. The new cursor is stored in
+        self.cursor.
+
+        Arguments:
+        cursor: the message id of the last message already retrieved
+
+        Returns:
+        list: A list of DirectMessage objects newer than the cursor
+        """
+        if not self.token:
+            return []
+        parsed = await self.request(
+            fetch_request(self.token, "all", since=cursor))
+        self.cursor = max(self.cursor, cursor)
+        return self._track_cursor(
+            self._to_direct_messages(parsed, self.username))
+
+    async def retrieve_conversation(self,
+                                    peer: str,
+                                    limit: Optional[int] = None,
+                                    before: Optional[int] = None
+                                    ) -> list[DirectMessage]:
+        """
+        Retrieve only the conversation with one user, oldest first.
+
+        Arguments:
+        peer: the username of the other side of the conversation
+        limit: the largest number of messages to return
+        before: only return messages with a smaller id
+
+        Returns:
+        list: DirectMessage objects with sender and recipient set
+        """
+        if not self.token:
+            return []
+        parsed = await self.request(
+            fetch_request(self.token, "all", before=before, limit=limit,
+                          order='desc', peer=peer))
+        return self._to_conversation_messages(parsed)[::-1]
+
+    async def search(self,
+                     query: str,
+                     peer: Optional[str] = None,
+                     start: Optional[float] = None,
+                     end: Optional[float] = None,
+                     limit: Optional[int] = None) -> list[DirectMessage]:
+        """
+        Search the user's messages on the server, newest first.
+
+        Arguments:
+        query: the words to look for
+        peer: only search the conversation with this user
+        start: only return messages with a timestamp of at least start
+        end: only return messages with a timestamp before end
+        limit: the largest number of messages to return
+
+        Returns:
+        list: DirectMessage objects with sender and recipient set
+        """
+        if not self.token:
+            return []
+        parsed = await self.request(
+            search_request(self.token, query, peer=peer, start=start,
+                           end=end, limit=limit))
+        return self._to_conversation_messages(parsed)
+
+    async def subscribe(self,
+                        callback: Optional[Callable] = None) -> bool:
+        """
+        Ask the server to push new messages on this connection. Pushed
+        messages are passed to the callback (a function or a coroutine
+        function), or queued for incoming() when no callback is given.
+
+        Arguments:
+        callback: called with each pushed DirectMessage
+
+        Returns:
+        bool: True if the server accepted the subscription
+        """
+        if not self.token:
+            return False
+        if self.subscribed:
+            return True
+
+        self._push_callback = callback
+        parsed = await self.request(subscribe_request(self.token))
+        self._subscribed = parsed.type == 'ok'
+        return self._subscribed
+
+    @property
+    def subscribed(self) -> bool:
+        """
+        Whether pushed messages are currently being received.
+
+        Returns:
+        bool: True once subscribed, until the connection closes
+        """
+        return self._subscribed
+
+    async def incoming(self) -> AsyncIterator[DirectMessage]:
+        """
+        Iterate over pushed messages until the connection closes.
+
+        Returns:
+        async iterator: DirectMessage objects in the order they were pushed
+        """
+        while True:
+            dm = await self._pushed.get()
+            if dm is None:
+                return
+            yield dm
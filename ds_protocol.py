@@ -7,12 +7,17 @@ over the DirectSocket.
 """
 import json
 from collections import namedtuple
+from typing import Optional
 
 # Create a namedtuple to hold the values we expect to retrieve from json
 # messages.
 DSPResponse = namedtuple(
     'DSPResponse', [
-        'type', 'message', 'token', 'messages'])
+        'type', 'message', 'token', 'messages', 'next', 'results'],
+    defaults=[None, None])
+
+# Messages the server pushes to subscribed clients without a request.
+DSPPush = namedtuple('DSPPush', ['type', 'message'])
 
 
 def extract_json(json_msg: str) -> DSPResponse:
@@ -24,8 +29,8 @@ DSPResponse object.
     json_msg: the JSON string to parse and extract data from
 
     Returns:
-    DSPResponse: namedtuple containing type, message, token, and messages
-    from the JSON
+    DSPResponse: namedtuple containing type, message, token, messages,
+    the next page cursor and the per-recipient results from the JSON
     """
     try:
         json_obj = json.loads(json_msg)
@@ -34,13 +39,37 @@ DSPResponse object.
         message = response.get('message')
         token = response.get('token')
         messages = response.get('messages', [])
-        return DSPResponse(type_, message, token, messages)
+        next_page = response.get('next')
+        results = response.get('results')
+        return DSPResponse(type_, message, token, messages, next_page,
+                           results)
 
     except json.JSONDecodeError:  # do i need to test this error
         print("Json cannot be decoded.")
         return DSPResponse(None, None, None, [])
 
 
+def extract_push(json_msg: str) -> Optional[DSPPush]:
+    """
+    Convert a JSON string pushed by the server to a DSPPush object.
+
+    Arguments:
+    json_msg: the JSON string to parse and extract data from
+
+    Returns:
+    DSPPush: namedtuple containing the push type and message, or None
+    if the string is not a push (e.g. a response to a request)
+    """
+    try:
+        json_obj = json.loads(json_msg)
+    except json.JSONDecodeError:
+        return None
+    if not isinstance(json_obj, dict) or 'push' not in json_obj:
+        return None
+    push = json_obj['push']
+    return DSPPush(push.get('type'), push.get('message', {}))
+
+
 def authenticate_request(username: str,
                          password: str) -> str:
     """
@@ -62,7 +91,8 @@ def direct_message_request(
         token: str,
         message: str,
         recipient: str,
-        timestamp: float) -> str:
+        timestamp: float,
+        request_id: Optional[str] = None) -> str:
     """
     Create a JSON direct message request string with
     token, message content, recipient, and timestamp.
@@ -72,31 +102,133 @@ def direct_message_request(
     message: the message content to send
     recipient: the username of the message recipient
     timestamp: the timestamp when the message was created
+    request_id: a unique id for the message, so the server stores it
+    only once if the request is sent again
+
+    Returns:
+    str: JSON string containing the direct message request
+    """
+    args = {"entry": message,
+            "recipient": recipient,
+            "timestamp": str(timestamp)}
+    if request_id is not None:
+        args["id"] = request_id
+    return json.dumps({"token": token, "directmessage": args})
+
+
+def broadcast_request(
+        token: str,
+        message: str,
+        recipients: list[str],
+        timestamp: float,
+        request_id: Optional[str] = None) -> str:
+    """
+    Create a JSON direct message request string sending one message to
+    several recipients at once.
+
+    Arguments:
+    token: the authentication token for the request
+    message: the message content to send
+    recipients: the usernames of the message recipients
+    timestamp: the timestamp when the message was created
+    request_id: a unique id for the message, so the server stores it
+    only once if the request is sent again
 
     Returns:
     str: JSON string containing the direct message request
     """
-    return json.dumps({"token": token,
-                       "directmessage": {
-                           "entry": message,
-                           "recipient": recipient,
-                           "timestamp": str(timestamp)
-                       }})
+    args = {"entry": message,
+            "recipients": list(recipients),
+            "timestamp": str(timestamp)}
+    if request_id is not None:
+        args["id"] = request_id
+    return json.dumps({"token": token, "directmessage": args})
 
 
 def fetch_request(token: str,
-                  fetch_type: str) -> str:
+                  fetch_type: str,
+                  wait: Optional[float] = None,
+                  since: Optional[int] = None,
+                  before: Optional[int] = None,
+                  limit: Optional[int] = None,
+                  order: Optional[str] = None,
+                  peer: Optional[str] = None) -> str:
     """
     Create a JSON fetch request string to retrieve messages from the server.
 
     Arguments:
     token: the authentication token for the request
     fetch_type: the type of fetch request ("all" or "unread")
+    wait: for "unread" fetches, the number of seconds the server may hold
+    the request open until a new message arrives (long polling)
+    since: for "all" fetches, only return messages with a greater id
+    before: for "all" fetches, only return messages with a smaller id
+    limit: for "all" fetches, the page size
+    order: for "all" fetches, "asc" (oldest first) or "desc"
+    peer: for "all" fetches, only return the conversation with this user
 
     Returns:
     str: JSON string containing the fetch request
     """
-    return json.dumps({
+    request = {
         "token": token,
         "fetch": fetch_type
+    }
+    optional = {"wait": wait, "since": since, "before": before,
+                "limit": limit, "order": order, "peer": peer}
+    for field, value in optional.items():
+        if value is not None:
+            request[field] = value
+    return json.dumps(request)
+
+
+def search_request(token: str,
+                   query: str,
+                   peer: Optional[str] = None,
+                   start: Optional[float] = None,
+                   end: Optional[float] = None,
+                   limit: Optional[int] = None) -> str:
+    """
+    Create a JSON search request string to find the user's messages
+    containing every word of a query. A word ending in '*' matches any
+    word starting with it.
+
+    Arguments:
+    token: the authentication token for the request
+    query: the words to look for
+    peer: only search the conversation with this user
+    start: only return messages with a timestamp of at least start
+    end: only return messages with a timestamp before end
+    limit: the largest number of messages to return
+
+    Returns:
+    str: JSON string containing the search request
+    """
+    request = {
+        "token": token,
+        "search": query
+    }
+    optional = {"peer": peer, "start": start, "end": end, "limit": limit}
+    for field, value in optional.items():
+        if value is not None:
+            request[field] = value
+    return json.dumps(request)
+
+
+def subscribe_request(token: str,
+                      event: str = "directmessage") -> str:
+    """
+    Create a JSON subscribe request string asking the server to push
+    new messages on the current connection instead of waiting for fetches.
+
+    Arguments:
+    token: the authentication token for the request
+    event: the type of event to subscribe to
+
+    Returns:
+    str: JSON string containing the subscribe request
+    """
+    return json.dumps({
+        "token": token,
+        "subscribe": event
     })
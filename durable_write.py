@@ -0,0 +1,322 @@
+# durable_write.py
+# Connor Ng
+# ngce@uci.edu
+# ngce
+
+"""
+Crash-safe file writes shared by the server store and the notebook.
+
+A file is replaced by writing the new contents to a temporary file in
+the same directory and renaming it over the old one, so a crash leaves
+either the old or the new file on disk, never a truncated one.
+
+How hard a write tries to reach the disk is set by an fsync policy:
+
+FSYNC_ALWAYS: every write is fsynced before it returns.
+FSYNC_BATCH: writes are queued and committed together by a background
+thread every commit_interval seconds (group commit). Repeated writes of
+the same file in one batch are only written once.
+FSYNC_NEVER: writes are still atomic but left to the operating system
+to flush, so they survive a crash of the program but not of the machine.
+"""
+
+import os
+import tempfile
+import threading
+from pathlib import Path
+from typing import List, Optional, Tuple, Union
+
+FSYNC_ALWAYS = 'always'
+FSYNC_BATCH = 'batch'
+FSYNC_NEVER = 'never'
+FSYNC_POLICIES = (FSYNC_ALWAYS, FSYNC_BATCH, FSYNC_NEVER)
+
+Data = Union[str, bytes]
+
+
+def _to_bytes(data: Data) -> bytes:
+    """
+    Encode text as UTF-8, leaving bytes untouched.
+
+    Arguments:
+    data: the text or bytes to encode
+
+    Returns:
+    bytes: the encoded data
+    """
+    return data.encode('utf-8') if isinstance(data, str) else data
+
+
+def fsync_directory(directory: Path) -> None:
+    """
+    Make renames and deletes inside a directory durable. Platforms that
+    cannot open a directory (Windows) are skipped.
+
+    Arguments:
+    directory: the directory to sync
+    """
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def atomic_write(path: Union[str, Path],
+                 data: Data,
+                 fsync: bool = True) -> None:
+    """
+    Replace a file with new contents in one step.
+
+    Arguments:
+    path: the file to write
+    data: the new contents of the file
+    fsync: whether to wait for the contents to reach the disk
+    """
+    path = Path(path)
+    _replace(path, _to_bytes(data), fsync)
+    if fsync:
+        fsync_directory(path.parent)
+
+
+def _replace(path: Path, data: bytes, fsync: bool) -> None:
+    """
+    Write data to a temporary file next to path and rename it over path.
+    The directory itself is not synced.
+
+    Arguments:
+    path: the file to write
+    data: the new contents of the file
+    fsync: whether to sync the temporary file before the rename
+    """
+    fd, tmp_name = tempfile.mkstemp(prefix=f'.{path.name}.',
+                                    suffix='.tmp', dir=path.parent)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            if fsync:
+                os.fsync(f.fileno())
+        os.replace(tmp_name, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_name)
+        except OSError:
+            pass
+        raise
+
+
+def durable_append(path: Union[str, Path],
+                   data: Data,
+                   fsync: bool = True) -> None:
+    """
+    Append data to the end of a file, creating it if needed.
+
+    Arguments:
+    path: the file to append to
+    data: the data to append
+    fsync: whether to wait for the data to reach the disk
+    """
+    with open(path, 'ab') as f:
+        f.write(_to_bytes(data))
+        f.flush()
+        if fsync:
+            os.fsync(f.fileno())
+
+
+def _remove(path: Union[str, Path]) -> None:
+    """
+    Delete a file if it exists.
+
+    Arguments:
+    path: the file to delete
+    """
+    Path(path).unlink(missing_ok=True)
+
+
+class DurableWriter:
+    """
+    Writes, appends to and removes files following an fsync policy.
+
+    Operations on the same writer are applied in the order they were
+    made. With FSYNC_BATCH they are applied by a background thread, and
+    errors it runs into are raised by the next call to flush or close.
+    """
+
+    def __init__(self,
+                 policy: str = FSYNC_ALWAYS,
+                 commit_interval: float = 0.5) -> None:
+        """
+        Create a new DurableWriter.
+
+        Arguments:
+        policy: one of FSYNC_ALWAYS, FSYNC_BATCH or FSYNC_NEVER
+        commit_interval: seconds between group commits with FSYNC_BATCH
+        """
+        if policy not in FSYNC_POLICIES:
+            raise ValueError(f"Unknown fsync policy: {policy}")
+        self.policy = policy
+        self.commit_interval = commit_interval
+        self._pending: List[Tuple[str, Path, Optional[bytes]]] = []
+        self._lock = threading.Lock()
+        self._commit_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._error: Optional[BaseException] = None
+        self._thread = None
+        if policy == FSYNC_BATCH:
+            self._thread = threading.Thread(target=self._commit_loop,
+                                            daemon=True)
+            self._thread.start()
+
+    def write(self, path: Union[str, Path], data: Data) -> None:
+        """
+        Atomically replace a file with new contents.
+
+        Arguments:
+        path: the file to write
+        data: the new contents of the file
+        """
+        self._submit('write', Path(path), _to_bytes(data))
+
+    def append(self, path: Union[str, Path], data: Data) -> None:
+        """
+        Append data to the end of a file.
+
+        Arguments:
+        path: the file to append to
+        data: the data to append
+        """
+        self._submit('append', Path(path), _to_bytes(data))
+
+    def remove(self, path: Union[str, Path]) -> None:
+        """
+        Delete a file if it exists.
+
+        Arguments:
+        path: the file to delete
+        """
+        self._submit('remove', Path(path), None)
+
+    def flush(self) -> None:
+        """
+        Commit every queued operation and wait until it is on disk.
+        Raises the first error met by a background commit, if any.
+        """
+        self._commit()
+        self._raise_error()
+
+    def close(self) -> None:
+        """
+        Stop the background thread, if any, and commit what is queued.
+        """
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+
+    def _submit(self, kind: str, path: Path, data: Optional[bytes]) -> None:
+        """
+        Apply an operation now, or queue it for the next group commit.
+
+        Arguments:
+        kind: 'write', 'append' or 'remove'
+        path: the file the operation applies to
+        data: the data to write or append
+        """
+        if self.policy != FSYNC_BATCH:
+            self._apply([(kind, path, data)], self.policy == FSYNC_ALWAYS)
+            return
+        with self._lock:
+            self._pending.append((kind, path, data))
+
+    def _commit_loop(self) -> None:
+        """
+        Commit the queued operations every commit_interval seconds.
+        """
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.commit_interval)
+            try:
+                self._commit()
+            except Exception as ex:  # pylint: disable=broad-except
+                self._error = self._error or ex
+
+    def _commit(self) -> None:
+        """
+        Take every queued operation and apply them as one batch.
+        """
+        with self._commit_lock:
+            with self._lock:
+                operations, self._pending = self._pending, []
+            if operations:
+                self._apply(_coalesce(operations), True)
+
+    def _raise_error(self) -> None:
+        """
+        Raise the error met by a background commit, if any.
+        """
+        error, self._error = self._error, None
+        if error is not None:
+            raise error
+
+    @staticmethod
+    def _apply(operations: List[Tuple[str, Path, Optional[bytes]]],
+               fsync: bool) -> None:
+        """
+        Apply operations in order, syncing each touched directory once
+        at the end.
+
+        Arguments:
+        operations: the (kind, path, data) operations to apply
+        fsync: whether to wait for the operations to reach the disk
+        """
+        directories = set()
+        for kind, path, data in operations:
+            if kind == 'write':
+                _replace(path, data, fsync)
+                directories.add(path.parent)
+            elif kind == 'append':
+                durable_append(path, data, fsync=fsync)
+            else:
+                _remove(path)
+                directories.add(path.parent)
+        if fsync:
+            for directory in directories:
+                fsync_directory(directory)
+
+
+def _coalesce(operations: List[Tuple[str, Path, Optional[bytes]]]
+              ) -> List[Tuple[str, Path, Optional[bytes]]]:
+    """
+    Drop the operations made moot by a later write or remove of the same
+    file and join consecutive appends to the same file.
+
+    Arguments:
+    operations: the (kind, path, data) operations in the order made
+
+    Returns:
+    list: the operations still needed, in the same order
+    """
+    replaced = set()
+    kept = []
+    for kind, path, data in reversed(operations):
+        if path in replaced:
+            continue
+        if kind in ('write', 'remove'):
+            replaced.add(path)
+        kept.append((kind, path, data))
+    kept.reverse()
+
+    merged = []
+    for kind, path, data in kept:
+        if merged and kind == 'append' and merged[-1][:2] == ('append', path):
+            merged[-1] = (kind, path, merged[-1][2] + data)
+        else:
+            merged.append((kind, path, data))
+    return merged
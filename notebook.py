@@ -2,9 +2,59 @@
 Data storage in order to store conversations between client and contacts.
 """
 import json
+import secrets
 import time
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Counter
+from collections.abc import Mapping, Sequence
 from pathlib import Path
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Iterator, Tuple, Union
+from durable_write import DurableWriter
+from text_index import InvertedIndex
+
+
+# Number of journal entries after which save rewrites the notebook file
+JOURNAL_COMPACT_THRESHOLD = 1000
+
+
+def journal_path(path: Path) -> Path:
+    """
+    Get the path of the journal file that belongs to a notebook file.
+
+    Arguments:
+    path: the path of the notebook file
+
+    Returns:
+    Path: the notebook path with a .journal suffix
+    """
+    return path.with_suffix('.journal')
+
+
+def index_path(path: Path) -> Path:
+    """
+    Get the path of the offset index file that belongs to a notebook file.
+
+    Arguments:
+    path: the path of the notebook file
+
+    Returns:
+    Path: the notebook path with a .index suffix
+    """
+    return path.with_suffix('.index')
+
+
+def search_index_path(path: Path) -> Path:
+    """
+    Get the path of the search index file that belongs to a notebook file.
+
+    Arguments:
+    path: the path of the notebook file
+
+    Returns:
+    Path: the notebook path with a .search suffix
+    """
+    return path.with_suffix('.search')
 
 
 class NotebookFileError(Exception):
@@ -180,36 +230,292 @@ class DirectMessage(Diary):
         raise ValueError
 
 
+def message_key(message: Dict[str, Any]) -> tuple:
+    """
+    Build the key identifying a message for duplicate detection.
+
+    Arguments:
+    message: the message (a DirectMessage or a dict loaded from file)
+
+    Returns:
+    tuple: the sender, timestamp and entry of the message
+    """
+    return (message.get('sender'), str(message['timestamp']),
+            message['entry'])
+
+
+# Marks a field the message does not have, so it is left out of its JSON
+_MISSING = object()
+
+# How ColumnarConversation rebuilds a timestamp from its float value
+_TIMESTAMP_FLOAT = 0
+_TIMESTAMP_STR = 1
+_TIMESTAMP_INT = 2
+_TIMESTAMP_INT_STR = 3
+# Kept unchanged in a dict, for timestamps that are not numbers
+_TIMESTAMP_RAW = 4
+
+
+class Message(Mapping):
+    """
+    Compact read-only form of a stored message. It keeps its fields in
+    slots instead of a dict, so it takes a fraction of the memory of a
+    DirectMessage, but reads like the message dict it was made from:
+    message['sender'], message.get('recipient'), dict(message).
+    """
+
+    __slots__ = ('entry', 'timestamp', 'sender', 'recipient')
+
+    def __init__(self,
+                 entry: Optional[str],
+                 timestamp: Any,
+                 sender: Any = _MISSING,
+                 recipient: Any = _MISSING) -> None:
+        """
+        Create a new Message. A sender or recipient that is not given
+        is left out of the message's keys.
+
+        Arguments:
+        entry: the message content
+        timestamp: the timestamp of the message
+        sender: the username of the message sender
+        recipient: the username of the message recipient
+        """
+        self.entry = entry
+        self.timestamp = timestamp
+        self.sender = sender
+        self.recipient = recipient
+
+    @classmethod
+    def from_mapping(cls,
+                     message: Dict[str, Any]) -> Union['Message', dict]:
+        """
+        Convert a message dict (or DirectMessage) to a Message. A dict
+        with fields a Message cannot hold is returned as a plain dict,
+        so it still saves to the same JSON.
+
+        Arguments:
+        message: the message to convert
+
+        Returns:
+        Message: the compact message, or a dict copy of it
+        """
+        if isinstance(message, cls):
+            return message
+        if ('entry' not in message or 'timestamp' not in message
+                or not set(message) <= set(cls.__slots__)):
+            return dict(message)
+        return cls(message['entry'], message['timestamp'],
+                   message.get('sender', _MISSING),
+                   message.get('recipient', _MISSING))
+
+    def __getitem__(self, key: str) -> Any:
+        if key in Message.__slots__:
+            value = getattr(self, key)
+            if value is not _MISSING:
+                return value
+        raise KeyError(key)
+
+    def __iter__(self) -> Iterator[str]:
+        return (key for key in Message.__slots__
+                if getattr(self, key) is not _MISSING)
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    def __repr__(self) -> str:
+        return f'Message({dict(self)!r})'
+
+
+def timestamp_value(timestamp: Any) -> float:
+    """
+    Convert a message timestamp to a float for sorting and range queries.
+    Timestamps that are not numbers count as 0.
+
+    Arguments:
+    timestamp: the timestamp as stored in the message
+
+    Returns:
+    float: the timestamp as a number
+    """
+    try:
+        return float(timestamp)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+class ConversationSlice:
+    """
+    The location of one conversation's messages inside a notebook file,
+    so they can be read without parsing the rest of the file.
+    """
+
+    def __init__(self, path: Path, offset: int, length: int) -> None:
+        """
+        Create a new ConversationSlice.
+
+        Arguments:
+        path: the notebook file
+        offset: the byte offset of the JSON list of messages
+        length: the length in bytes of the JSON list of messages
+        """
+        self.path = path
+        self.offset = offset
+        self.length = length
+
+    def read_raw(self) -> bytes:
+        """
+        Read the JSON text of the messages.
+
+        Returns:
+        bytes: the JSON list of messages as stored in the file
+        """
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            return f.read(self.length)
+
+    def read(self) -> List[Dict[str, Any]]:
+        """
+        Read and parse the messages.
+
+        Returns:
+        list: the messages as dicts
+        """
+        return json.loads(self.read_raw())
+
+
+class MessageView(Sequence):
+    """
+    Read-only list of the messages of a ColumnarConversation. Messages
+    are rebuilt from the columns as they are read, so changing the
+    list would be lost: it has no append, and setting an item raises
+    TypeError. Use add_message, or assign a new list to messages.
+    """
+
+    __slots__ = ('_conversation',)
+
+    def __init__(self, conversation: 'ColumnarConversation') -> None:
+        """
+        Create a view of the messages of a conversation.
+
+        Arguments:
+        conversation: the conversation to read from
+        """
+        self._conversation = conversation
+
+    def __getitem__(self, index: Union[int, slice]) -> Any:
+        if isinstance(index, slice):
+            return [self._conversation.message_at(i) for i
+                    in range(*index.indices(len(self._conversation)))]
+        return self._conversation.message_at(index)
+
+    def __len__(self) -> int:
+        return len(self._conversation)
+
+    def __eq__(self, other: Any) -> bool:
+        if isinstance(other, (list, MessageView)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def __repr__(self) -> str:
+        return f'MessageView({list(self)!r})'
+
+
 class Conversation:
     """
     Represents a conversation containing messages between users.
+    A conversation can be created from a ConversationSlice, in which
+    case its messages are only read from the notebook file when they
+    are first used.
     """
 
-    def __init__(self, recipient: str) -> None:
+    def __init__(self,
+                 recipient: str,
+                 source: Optional[ConversationSlice] = None) -> None:
         """
         Initialize a Conversation with a recipient.
 
         Arguments:
         recipient: the username of the conversation recipient
+        source: where to read the messages from when first needed
         """
         self.recipient = recipient
-        self.messages = []
+        self.source = source
+        self._messages = None if source is not None else []
+        # Keys of every message, so duplicates are found in O(1)
+        self._keys = set()
+
+    @property
+    def messages(self) -> List[Diary]:
+        """
+        The messages of the conversation, read from the notebook file
+        on first use. Add messages with add_message, so has_message
+        knows about them.
+        """
+        self._ensure_loaded()
+        return self._messages
+
+    @messages.setter
+    def messages(self, messages: List[Diary]) -> None:
+        self._messages = []
+        self._keys = set()
+        self.source = None
+        for message in messages:
+            self.add_message(message)
+
+    def _ensure_loaded(self) -> None:
+        """
+        Read the messages from the notebook file if not done yet.
+        """
+        if self._messages is None:
+            self._messages = []
+            for message in self.source.read():
+                message = Message.from_mapping(message)
+                self._messages.append(message)
+                self._keys.add(message_key(message))
+            self.source = None
+
+    def is_loaded(self) -> bool:
+        """
+        Check whether the messages have been read from the notebook file.
+
+        Returns:
+        bool: True if the messages are in memory
+        """
+        return self._messages is not None
 
     def add_message(self, message: Diary) -> None:
         """
-        Add a message to the conversation.
+        Add a message to the conversation. It is stored as a compact
+        Message.
 
         Arguments:
         message: the Diary message object to add
         """
+        message = Message.from_mapping(message)
         self.messages.append(message)
+        self._keys.add(message_key(message))
+
+    def has_message(self, message: Diary) -> bool:
+        """
+        Check whether the conversation already holds a message with the
+        same sender, timestamp and entry.
 
-    def get_message(self) -> List[Diary]:
+        Arguments:
+        message: the Diary message object to look for
+
+        Returns:
+        bool: True if an identical message is in the conversation
+        """
+        self._ensure_loaded()
+        return message_key(message) in self._keys
+
+    def get_message(self) -> List[Message]:
         """
         Get all messages in the conversation.
 
         Returns:
-        list: list of Diary objects representing the messages
+        list: list of Message objects representing the messages
         """
         return self.messages
 
@@ -222,6 +528,468 @@ class Conversation:
         """
         return self.recipient
 
+    def __len__(self) -> int:
+        return len(self.messages)
+
+    def message_at(self, index: int) -> Message:
+        """
+        Get the message at a position in the conversation.
+
+        Arguments:
+        index: the position of the message, 0 for the oldest
+
+        Returns:
+        Message: the message
+        """
+        return self.messages[index]
+
+    def message_range(self, start: int, stop: int) -> List[Message]:
+        """
+        Get the messages between two positions in the conversation.
+
+        Arguments:
+        start: the position of the first message, 0 for the oldest
+        stop: the position after the last message
+
+        Returns:
+        list: the messages, oldest first
+        """
+        return self.messages[start:stop]
+
+    def between(self, start: float, end: float) -> List[Message]:
+        """
+        Get the messages sent in a time range.
+
+        Arguments:
+        start: the earliest timestamp to include
+        end: the timestamp to stop before
+
+        Returns:
+        list: the messages with start <= timestamp < end
+        """
+        return [message for message in self.messages
+                if start <= timestamp_value(message.get('timestamp')) < end]
+
+    def search(self, text: str, case_sensitive: bool = False) -> List[Message]:
+        """
+        Get the messages whose entry contains some text.
+
+        Arguments:
+        text: the text to look for
+        case_sensitive: whether the case of the text must match
+
+        Returns:
+        list: the matching messages, oldest first
+        """
+        if not case_sensitive:
+            text = text.casefold()
+        matches = []
+        for message in self.messages:
+            entry = str(message.get('entry') or '')
+            if text in (entry if case_sensitive else entry.casefold()):
+                matches.append(message)
+        return matches
+
+    def sender_counts(self) -> Dict[Any, int]:
+        """
+        Count the messages sent by each user in the conversation.
+
+        Returns:
+        dict: the number of messages of each sender
+        """
+        return dict(Counter(message['sender'] for message in self.messages
+                            if 'sender' in message))
+
+
+class ColumnarConversation(Conversation):
+    """
+    Conversation that stores its messages column by column instead of
+    as one object per message, for very long histories:
+
+    - timestamps in a typed array of doubles, with one byte per message
+      telling whether it was a float, an int or a numeric string, so the
+      timestamp strings the server sends are not kept as objects,
+    - senders and recipients as ids into one list of interned names,
+    - entries packed one after the other in a UTF-8 buffer, with an
+      array of offsets marking where each entry starts.
+
+    Time range queries bisect the timestamp array (or a sorted copy of
+    it when messages arrived out of order), text search runs bytes.find
+    over the packed entries and sender counts are kept as messages are
+    added, so none of them build a Python object per message.
+    Messages are only rebuilt as Message objects when returned.
+    """
+
+    def __init__(self,
+                 recipient: str,
+                 source: Optional[ConversationSlice] = None) -> None:
+        """
+        Initialize a ColumnarConversation with a recipient.
+
+        Arguments:
+        recipient: the username of the conversation recipient
+        source: where to read the messages from when first needed
+        """
+        super().__init__(recipient, source)
+        self._messages = None
+        self._loaded = source is None
+        self._reset_columns()
+
+    def _reset_columns(self) -> None:
+        """
+        Empty every column.
+        """
+        self._timestamps = array('d')
+        self._timestamp_formats = array('b')
+        # Timestamps that are not numbers, so they save unchanged
+        self._raw_timestamps = {}
+        self._sorted = True
+        # Positions and timestamps in timestamp order, built when a range
+        # query needs them while the messages are out of order
+        self._order = None
+        self._ordered_timestamps = None
+        self._names = []
+        self._name_ids = {}
+        self._senders = array('l')
+        self._sender_counts = Counter()
+        self._recipients = array('l')
+        self._text = bytearray()
+        self._offsets = array('q', [0])
+        # Case-folded copy of the entries for case-insensitive search
+        self._folded = bytearray()
+        self._folded_offsets = array('q', [0])
+        self._none_entries = set()
+        # Messages with fields a Message cannot hold, by index
+        self._extra = {}
+        # Hash of each message key -> index of its first message
+        self._key_index = {}
+
+    @property
+    def messages(self) -> MessageView:
+        """
+        The messages of the conversation as a read-only MessageView,
+        rebuilt from the columns as they are read.
+        """
+        self._ensure_loaded()
+        return MessageView(self)
+
+    @messages.setter
+    def messages(self, messages: List[Diary]) -> None:
+        self._reset_columns()
+        self._loaded = True
+        self.source = None
+        for message in messages:
+            self._append(Message.from_mapping(message))
+
+    def get_message(self) -> List[Message]:
+        """
+        Get all messages in the conversation.
+
+        Returns:
+        list: list of Message objects representing the messages
+        """
+        self._ensure_loaded()
+        return [self._message_at(i) for i in range(len(self._timestamps))]
+
+    def _ensure_loaded(self) -> None:
+        """
+        Read the messages from the notebook file if not done yet.
+        """
+        if not self._loaded:
+            self._loaded = True
+            for message in self.source.read():
+                self._append(Message.from_mapping(message))
+            self.source = None
+
+    def is_loaded(self) -> bool:
+        """
+        Check whether the messages have been read from the notebook file.
+
+        Returns:
+        bool: True if the messages are in memory
+        """
+        return self._loaded
+
+    def add_message(self, message: Diary) -> None:
+        """
+        Add a message to the conversation.
+
+        Arguments:
+        message: the Diary message object to add
+        """
+        self._ensure_loaded()
+        self._append(Message.from_mapping(message))
+
+    def _append(self, message: Union[Message, dict]) -> None:
+        """
+        Add a message to the end of every column.
+
+        Arguments:
+        message: the message to add
+        """
+        index = len(self._timestamps)
+        if not isinstance(message, Message):
+            self._extra[index] = message
+
+        timestamp = message.get('timestamp')
+        value = timestamp_value(timestamp)
+        timestamp_format = self._timestamp_format(timestamp, value)
+        if timestamp_format == _TIMESTAMP_RAW:
+            self._raw_timestamps[index] = timestamp
+        if self._timestamps and value < self._timestamps[-1]:
+            self._sorted = False
+        self._timestamps.append(value)
+        self._timestamp_formats.append(timestamp_format)
+        self._order = self._ordered_timestamps = None
+
+        sender = self._name_id(message.get('sender', _MISSING))
+        self._senders.append(sender)
+        self._sender_counts[sender] += 1
+        self._recipients.append(
+            self._name_id(message.get('recipient', _MISSING)))
+
+        entry = message.get('entry')
+        if entry is None:
+            self._none_entries.add(index)
+            entry = ''
+        entry = str(entry)
+        self._text += entry.encode('utf-8')
+        self._offsets.append(len(self._text))
+        self._folded += entry.casefold().encode('utf-8')
+        self._folded_offsets.append(len(self._folded))
+
+        self._key_index.setdefault(hash(message_key(message)), index)
+
+    @staticmethod
+    def _timestamp_format(timestamp: Any, value: float) -> int:
+        """
+        Find how a timestamp can be rebuilt from its float value.
+
+        Arguments:
+        timestamp: the timestamp as stored in the message
+        value: the timestamp as a float
+
+        Returns:
+        int: one of the _TIMESTAMP_ formats
+        """
+        if type(timestamp) is float:
+            return _TIMESTAMP_FLOAT
+        if type(timestamp) is int:
+            if int(value) == timestamp:
+                return _TIMESTAMP_INT
+        elif type(timestamp) is str:
+            if str(value) == timestamp:
+                return _TIMESTAMP_STR
+            if value.is_integer() and str(int(value)) == timestamp:
+                return _TIMESTAMP_INT_STR
+        return _TIMESTAMP_RAW
+
+    def _timestamp_at(self, index: int) -> Any:
+        """
+        Rebuild the timestamp of the message at a position.
+
+        Arguments:
+        index: the position of the message
+
+        Returns:
+        the timestamp as it was stored in the message
+        """
+        value = self._timestamps[index]
+        timestamp_format = self._timestamp_formats[index]
+        if timestamp_format == _TIMESTAMP_FLOAT:
+            return value
+        if timestamp_format == _TIMESTAMP_STR:
+            return str(value)
+        if timestamp_format == _TIMESTAMP_INT:
+            return int(value)
+        if timestamp_format == _TIMESTAMP_INT_STR:
+            return str(int(value))
+        return self._raw_timestamps[index]
+
+    def _name_id(self, name: Any) -> int:
+        """
+        Get the id of an interned sender or recipient name.
+
+        Arguments:
+        name: the name, or _MISSING if the message has none
+
+        Returns:
+        int: the id of the name, -1 for _MISSING
+        """
+        if name is _MISSING:
+            return -1
+        name_id = self._name_ids.get(name)
+        if name_id is None:
+            name_id = self._name_ids[name] = len(self._names)
+            self._names.append(name)
+        return name_id
+
+    def _name(self, name_id: int) -> Any:
+        """
+        Get the name with an id.
+
+        Arguments:
+        name_id: the id of the name
+
+        Returns:
+        the name, or _MISSING for -1
+        """
+        return _MISSING if name_id < 0 else self._names[name_id]
+
+    def _message_at(self, index: int) -> Union[Message, dict]:
+        """
+        Rebuild the message at a position from the columns.
+
+        Arguments:
+        index: the position of the message
+
+        Returns:
+        Message: the message
+        """
+        if index in self._extra:
+            return self._extra[index]
+        if index in self._none_entries:
+            entry = None
+        else:
+            start, end = self._offsets[index], self._offsets[index + 1]
+            entry = self._text[start:end].decode('utf-8')
+        return Message(entry,
+                       self._timestamp_at(index),
+                       self._name(self._senders[index]),
+                       self._name(self._recipients[index]))
+
+    def has_message(self, message: Diary) -> bool:
+        """
+        Check whether the conversation already holds a message with the
+        same sender, timestamp and entry.
+
+        Arguments:
+        message: the Diary message object to look for
+
+        Returns:
+        bool: True if an identical message is in the conversation
+        """
+        self._ensure_loaded()
+        key = message_key(message)
+        index = self._key_index.get(hash(key))
+        if index is None:
+            return False
+        if message_key(self._message_at(index)) == key:
+            return True
+        # Another message has the same hash, so check them all
+        return any(message_key(self._message_at(i)) == key
+                   for i in range(len(self._timestamps)))
+
+    def __len__(self) -> int:
+        self._ensure_loaded()
+        return len(self._timestamps)
+
+    def message_at(self, index: int) -> Message:
+        """
+        Get the message at a position in the conversation.
+
+        Arguments:
+        index: the position of the message, 0 for the oldest
+
+        Returns:
+        Message: the message
+        """
+        self._ensure_loaded()
+        if index < 0:
+            index += len(self._timestamps)
+        if not 0 <= index < len(self._timestamps):
+            raise IndexError('message index out of range')
+        return self._message_at(index)
+
+    def message_range(self, start: int, stop: int) -> List[Message]:
+        """
+        Get the messages between two positions in the conversation,
+        rebuilding only those messages.
+
+        Arguments:
+        start: the position of the first message, 0 for the oldest
+        stop: the position after the last message
+
+        Returns:
+        list: the messages, oldest first
+        """
+        self._ensure_loaded()
+        return [self._message_at(i)
+                for i in range(*slice(start, stop).indices(len(self)))]
+
+    def between(self, start: float, end: float) -> List[Message]:
+        """
+        Get the messages sent in a time range.
+
+        Arguments:
+        start: the earliest timestamp to include
+        end: the timestamp to stop before
+
+        Returns:
+        list: the messages with start <= timestamp < end
+        """
+        self._ensure_loaded()
+        timestamps = self._timestamps
+        if self._sorted:
+            indices = range(bisect_left(timestamps, start),
+                            bisect_left(timestamps, end))
+        else:
+            if self._order is None:
+                self._order = array('q', sorted(range(len(timestamps)),
+                                                key=timestamps.__getitem__))
+                self._ordered_timestamps = array(
+                    'd', (timestamps[i] for i in self._order))
+            ordered = self._ordered_timestamps
+            indices = sorted(self._order[bisect_left(ordered, start):
+                                         bisect_left(ordered, end)])
+        return [self._message_at(i) for i in indices]
+
+    def search(self, text: str, case_sensitive: bool = False) -> List[Message]:
+        """
+        Get the messages whose entry contains some text.
+
+        Arguments:
+        text: the text to look for
+        case_sensitive: whether the case of the text must match
+
+        Returns:
+        list: the matching messages, oldest first
+        """
+        self._ensure_loaded()
+        if case_sensitive:
+            buffer, offsets = self._text, self._offsets
+        else:
+            buffer, offsets = self._folded, self._folded_offsets
+            text = text.casefold()
+        needle = text.encode('utf-8')
+        if not needle:
+            return self.get_message()
+
+        matches = []
+        position = buffer.find(needle)
+        while position != -1:
+            index = bisect_right(offsets, position) - 1
+            end = offsets[index + 1]
+            if position + len(needle) <= end:
+                matches.append(index)
+                position = buffer.find(needle, end)
+            else:
+                # The match runs into the next entry
+                position = buffer.find(needle, position + 1)
+        return [self._message_at(i) for i in matches]
+
+    def sender_counts(self) -> Dict[Any, int]:
+        """
+        Count the messages sent by each user in the conversation.
+
+        Returns:
+        dict: the number of messages of each sender
+        """
+        self._ensure_loaded()
+        return {self._names[name_id]: count
+                for name_id, count in self._sender_counts.items()
+                if name_id >= 0}
+
 
 class Notebook:
     """
@@ -232,22 +1000,58 @@ class Notebook:
                  username: str,
                  password: str,
                  host: str,
-                 path: str) -> None:
+                 path: str,
+                 journal: bool = False,
+                 writer: Optional[DurableWriter] = None,
+                 conversation_type: type = Conversation) -> None:
         """
         Creates a new Notebook object.
 
+        In journal mode, save appends the messages added since the last
+        save to a journal file next to the notebook instead of rewriting
+        the whole notebook. The journal is folded back into the notebook
+        file by compact, which save also runs once the journal holds
+        JOURNAL_COMPACT_THRESHOLD entries.
+
+        Files are written through a DurableWriter, so a crash during a
+        save never leaves a truncated notebook behind. Its fsync policy
+        decides how much durability is traded for speed.
+
         Arguments:
         username: The username of the user
         password: The password of the user
         host: The host server address
         path: The file path for the notebook
+        journal: Whether to save new messages to a journal file
+        writer: The DurableWriter used to write the notebook files,
+        by default one that syncs every write to disk
+        conversation_type: The Conversation class used to hold messages,
+        ColumnarConversation for very long histories
         """
         self.username = username
         self.password = password
         self.host = host
         self.path = path
+        self.journal = journal
+        self.writer = writer if writer is not None else DurableWriter()
+        self.conversation_type = conversation_type
         self._diaries = []
         self.conversations = {}
+        # Id of the last server message synced into the notebook
+        self.cursor = 0
+        # Changes not written to disk yet. Messages and the cursor can be
+        # journaled, any other change needs a full snapshot.
+        self._dirty = True
+        self._needs_snapshot = True
+        self._pending = []
+        self._journal_entries = 0
+        self._saved_path = None
+        # Full-text search index, built on the first search. It is saved
+        # next to the notebook file with a random stamp that the
+        # notebook file records, so an index that does not belong to it
+        # is never used.
+        self._search_stamp = None
+        self._reset_search_index()
 
     def add_diary(self, diary: Diary) -> None:
         """
@@ -263,6 +1067,7 @@ class Notebook:
         diary: the Diary object to add to the notebook
         """
         self._diaries.append(diary)
+        self._dirty = self._needs_snapshot = True
 
     def del_diary(self, index: int) -> bool:
         """
@@ -283,6 +1088,7 @@ class Notebook:
         """
         try:
             del self._diaries[index]
+            self._dirty = self._needs_snapshot = True
             return True
         except IndexError:
             return False
@@ -300,7 +1106,9 @@ class Notebook:
     def save(self, path: str) -> None:
         """
         Accepts an existing notebook file to save the current
-        instance of Notebook to the file system.
+        instance of Notebook to the file system. Nothing is written
+        if the notebook has not changed since it was last saved to or
+        loaded from the same path.
 
         Example usage:
 
@@ -319,32 +1127,178 @@ class Notebook:
         if p.suffix != '.json':
             raise NotebookFileError("Invalid notebook file path or type")
 
-    # Convert conversations dictionary into serializable form
-        conversations_serializable = {
-            recipient: conv.get_message()
-            for recipient, conv in self.conversations.items()
-        }
+        same_file = self._saved_path == p and p.exists()
+        if same_file and not self._dirty:
+            return
+
+        if (self.journal and same_file and not self._needs_snapshot
+                and self._journal_entries + len(self._pending)
+                < JOURNAL_COMPACT_THRESHOLD):
+            self._append_journal(p)
+        else:
+            self.compact(path)
 
-        notebook_dict = {
+    def compact(self, path: Optional[str] = None) -> None:
+        """
+        Write the whole notebook to its file and remove the journal.
+
+        Arguments:
+        path: the file path where to save the notebook,
+        defaults to the path the notebook was last saved to or loaded from
+
+        Raises NotebookFileError
+        """
+        p = Path(path) if path is not None else self._saved_path
+        if p is None:
+            p = Path(self.path)
+
+        if p.suffix != '.json':
+            raise NotebookFileError("Invalid notebook file path or type")
+
+        if self._search_index is not None:
+            if p != self._saved_path:
+                # The search index has to be saved next to the new file
+                self._search_changed = True
+        elif p != self._saved_path or self._unindexed:
+            # The saved search index would not cover the notebook. It is
+            # only rebuilt when searched, instead of reading every
+            # conversation here.
+            self._search_stamp = None
+            self._unindexed = []
+        search_data = None
+        if self._search_index is not None and self._search_changed:
+            self._search_stamp = secrets.token_hex(8)
+            search_data = json.dumps({
+                'stamp': self._search_stamp,
+                'docs': self._search_docs,
+                'index': self._search_index.to_dict()
+            })
+
+        data, index = self._serialize()
+        unloaded = [conv for conv in self.conversations.values()
+                    if not conv.is_loaded()]
+
+        try:
+            if search_data is not None:
+                # Written first, so the notebook never names an index
+                # that is not on disk
+                self.writer.write(search_index_path(p), search_data)
+            self.writer.write(p, data)
+            # Written after the notebook, so a crash in between leaves an
+            # index that no longer matches and is ignored
+            self.writer.write(index_path(p), json.dumps(index))
+            self.writer.remove(journal_path(p))
+            if unloaded:
+                # The conversations not read yet must be read from the
+                # new file from now on, so it has to be on disk
+                self.writer.flush()
+        except Exception as ex:
+            raise NotebookFileError(
+                "Error while attempting to process the notebook file.") from ex
+
+        for conv in unloaded:
+            offset, length = index['conversations'][conv.recipient]
+            conv.source = ConversationSlice(p, offset, length)
+
+        self._mark_saved(p)
+        self._journal_entries = 0
+        self._search_changed = False
+
+    def _serialize(self) -> Tuple[bytes, Dict[str, Any]]:
+        """
+        Convert the notebook to the JSON text of a notebook file along
+        with its offset index. Conversations that were never read are
+        copied from the current notebook file without being parsed.
+
+        Returns:
+        tuple: the file contents and the offset index
+        """
+        generation = secrets.token_hex(8)
+        header = {
             'username': self.username,
             'password': self.password,
             'host': self.host,
             '_diaries': [dict(diary) for diary in self._diaries],
-            'conversations': conversations_serializable
+            'cursor': self.cursor,
+            'search_stamp': self._search_stamp,
+            'generation': generation
+        }
+        # Drop the closing "\n}" so the conversations can follow
+        head = json.dumps(header, indent=4)[:-2].encode('utf-8')
+        chunks = [head, b',\n    "conversations": {']
+        size = sum(len(chunk) for chunk in chunks)
+
+        offsets = {}
+        for recipient, conv in self.conversations.items():
+            if conv.is_loaded():
+                body = json.dumps(conv.get_message(), indent=4,
+                                  default=dict)
+                body = body.replace('\n', '\n        ').encode('utf-8')
+            else:
+                body = conv.source.read_raw()
+            separator = ',' if offsets else ''
+            prefix = f'{separator}\n        {json.dumps(recipient)}: '
+            prefix = prefix.encode('utf-8')
+            offsets[recipient] = [size + len(prefix), len(body)]
+            chunks += [prefix, body]
+            size += len(prefix) + len(body)
+
+        chunks.append(b'\n    }\n}' if offsets else b'}\n}')
+        size += len(chunks[-1])
+
+        del header['generation']
+        index = {
+            'size': size,
+            'generation': generation,
+            'generation_offset': head.find(
+                json.dumps(generation).encode('utf-8')),
+            'header': header,
+            'conversations': offsets
         }
+        return b''.join(chunks), index
 
+    def _append_journal(self, p: Path) -> None:
+        """
+        Append the changes made since the last save to the journal.
+
+        Arguments:
+        p: the path of the notebook file the journal belongs to
+
+        Raises NotebookFileError
+        """
+        lines = ''.join(json.dumps(entry) + '\n' for entry in self._pending)
         try:
-            with open(p, 'w', encoding='utf-8') as f:
-                json.dump(notebook_dict, f, indent=4)
+            self.writer.append(journal_path(p), lines)
         except Exception as ex:
             raise NotebookFileError(
-                "Error while attempting to process the notebook file.") from ex
+                "Error while attempting to process the journal file.") from ex
+
+        self._journal_entries += len(self._pending)
+        self._mark_saved(p)
+
+    def _mark_saved(self, p: Path) -> None:
+        """
+        Record that every change up to now is stored at the given path.
 
-    def load(self, path: str) -> None:
+        Arguments:
+        p: the path of the notebook file
+        """
+        self._saved_path = p
+        self._dirty = self._needs_snapshot = False
+        self._pending = []
+
+    def load(self, path: str, lazy: bool = False) -> None:
         """
         Populates the current instance of
         Notebook with data stored in a notebook file.
 
+        In lazy mode only the header (username, host, diaries and the
+        list of contacts) is read, from the offset index saved next to
+        the notebook file. Each conversation's messages are then read
+        when the conversation is first used. If the index is missing or
+        out of date the whole file is read, and the next save writes a
+        new index.
+
         Example usage:
 
         ```
@@ -354,6 +1308,7 @@ class Notebook:
 
         Arguments:
         path: the file path of the notebook to load
+        lazy: whether to defer reading the conversations
 
         Raises NotebookFileError, IncorrectNotebookError
         """
@@ -363,33 +1318,268 @@ class Notebook:
             raise NotebookFileError()
 
         try:
-            with open(p, 'r', encoding='utf-8') as f:
-                obj = json.load(f)
+            index = self._read_index(p) if lazy else None
+            if index is not None:
+                obj = index['header']
+                self.conversations = {
+                    recipient: self.conversation_type(
+                        recipient, ConversationSlice(p, offset, length))
+                    for recipient, (offset, length)
+                    in index['conversations'].items()
+                }
+            else:
+                with open(p, 'r', encoding='utf-8') as f:
+                    obj = json.load(f)
+
+                self.conversations = {}
+                convs = obj.get('conversations', {})
+                for recipient, messages in convs.items():
+                    conv = self.conversation_type(recipient)
+                    for m in messages:
+                        conv.add_message(m)
+                    self.conversations[recipient] = conv
 
             self.username = obj['username']
             self.password = obj['password']
             self.host = obj['host']
+            self.cursor = obj.get('cursor', 0)
+            self._search_stamp = obj.get('search_stamp')
+            self._reset_search_index()
 
             self._diaries = [Diary(d['entry'], d['timestamp'])
                              for d in obj.get('_diaries', [])]
 
-            self.conversations = {}
-            convs = obj.get('conversations', {})
-            for recipient, messages in convs.items():
-                conv = Conversation(recipient)
-                for m in messages:
-                    conv.add_message(m)
-                self.conversations[recipient] = conv
+            self._journal_entries, complete = self._replay_journal(p)
 
         except Exception as ex:
             raise IncorrectNotebookError from ex
 
+        self._mark_saved(p)
+        # Rewrite the index that was out of date, or the journal whose
+        # torn last line would swallow the next appended entry
+        if (lazy and index is None) or not complete:
+            self._dirty = self._needs_snapshot = True
+
+    @staticmethod
+    def _read_index(p: Path) -> Optional[Dict[str, Any]]:
+        """
+        Read the offset index of a notebook file, checking that it was
+        written together with the current contents of the file.
+
+        Arguments:
+        p: the path of the notebook file
+
+        Returns:
+        dict: the index, or None if it is missing or out of date
+        """
+        try:
+            with open(index_path(p), 'r', encoding='utf-8') as f:
+                index = json.load(f)
+            if p.stat().st_size != index['size']:
+                return None
+            generation = json.dumps(index['generation']).encode('utf-8')
+            with open(p, 'rb') as f:
+                f.seek(index['generation_offset'])
+                if f.read(len(generation)) != generation:
+                    return None
+            return index
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def _replay_journal(self, p: Path) -> Tuple[int, bool]:
+        """
+        Apply the journal entries saved after the notebook file was
+        last written. A partly written last line is ignored, as are
+        messages the notebook file already holds.
+
+        Arguments:
+        p: the path of the notebook file the journal belongs to
+
+        Returns:
+        tuple: the number of entries replayed, and False if the journal
+        ended with a partly written line
+        """
+        jp = journal_path(p)
+        if not jp.exists():
+            return 0, True
+
+        count = 0
+        with open(jp, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    return count, False
+                if 'cursor' in entry:
+                    self.cursor = entry['cursor']
+                else:
+                    # Skip entries already compacted into the notebook
+                    recipient = entry['recipient']
+                    conv = self.conversations.get(recipient)
+                    if conv is None or not conv.has_message(entry['message']):
+                        self._add_to_conversation(recipient, entry['message'])
+                count += 1
+                if not line.endswith('\n'):
+                    # Written whole but cut off before its newline
+                    return count, False
+        return count, True
+
+    def add_message(self, recipient: str, message: Diary) -> None:
+        """
+        Add a message to the conversation with a recipient, creating
+        the conversation if needed. Messages should be added through
+        the Notebook so the next save knows about them.
+
+        Arguments:
+        recipient: the username of the conversation recipient
+        message: the message to add
+        """
+        self._add_to_conversation(recipient, message)
+        self._pending.append({'recipient': recipient,
+                              'message': dict(message)})
+        self._dirty = True
+
+    def _add_to_conversation(self, recipient: str, message: Diary) -> None:
+        """
+        Add a message to a conversation without recording it as a change.
+
+        Arguments:
+        recipient: the username of the conversation recipient
+        message: the message to add
+        """
+        if recipient not in self.conversations:
+            self.conversations[recipient] = self.conversation_type(recipient)
+        conversation = self.conversations[recipient]
+        conversation.add_message(message)
+
+        position = len(conversation) - 1
+        if self._search_index is not None:
+            self._index_message(recipient, position)
+        elif self._search_stamp is not None:
+            self._unindexed.append((recipient, position))
+
+    def search(self,
+               query: str,
+               limit: Optional[int] = 50,
+               recipient: Optional[str] = None) -> List[Tuple[str, Message]]:
+        """
+        Search the messages of every conversation. Every word of the
+        query must appear in a message, and a word ending in '*' matches
+        any word starting with it.
+
+        Example usage:
+
+        ```
+        for recipient, message in notebook.search('lunch tomorr*'):
+            print(recipient, message['entry'])
+        ```
+
+        Arguments:
+        query: the words to look for
+        limit: the largest number of results to return
+        recipient: if given, only search the conversation with this user
+
+        Returns:
+        list: (recipient, message) pairs, newest message first
+        """
+        self._ensure_search_index()
+        results = []
+        for doc_id in self._search_index.search(query):
+            doc_recipient, position = self._search_docs[doc_id]
+            if recipient is not None and doc_recipient != recipient:
+                continue
+            conversation = self.conversations[doc_recipient]
+            results.append((doc_recipient, conversation.message_at(position)))
+            if limit is not None and len(results) >= limit:
+                break
+        return results
+
+    def _reset_search_index(self) -> None:
+        """
+        Forget the search index, so it is read or rebuilt when needed.
+        """
+        self._search_index = None
+        # Document id -> (recipient, position of the message)
+        self._search_docs = []
+        # Messages added while the index was not in memory
+        self._unindexed = []
+        self._search_changed = False
+
+    def _ensure_search_index(self) -> None:
+        """
+        Read the search index saved next to the notebook file, or build
+        it from every conversation if there is no usable one, then index
+        the messages added since.
+        """
+        if self._search_index is not None:
+            return
+
+        saved = self._read_search_index()
+        if saved is not None:
+            self._search_index = InvertedIndex.from_dict(saved['index'])
+            self._search_docs = [tuple(doc) for doc in saved['docs']]
+            for recipient, position in self._unindexed:
+                self._index_message(recipient, position)
+            self._search_changed = bool(self._unindexed)
+        else:
+            self._search_index = InvertedIndex()
+            for recipient, conversation in self.conversations.items():
+                for position in range(len(conversation)):
+                    self._index_message(recipient, position)
+            self._search_changed = True
+        self._unindexed = []
+
+    def _read_search_index(self) -> Optional[Dict[str, Any]]:
+        """
+        Read the search index saved for the notebook file.
+
+        Returns:
+        dict: the saved index, or None if there is none for this notebook
+        """
+        if self._search_stamp is None or self._saved_path is None:
+            return None
+        try:
+            with open(search_index_path(self._saved_path), 'r',
+                      encoding='utf-8') as f:
+                saved = json.load(f)
+            if saved['stamp'] == self._search_stamp:
+                return saved
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        return None
+
+    def _index_message(self, recipient: str, position: int) -> None:
+        """
+        Add a message to the search index.
+
+        Arguments:
+        recipient: the username of the conversation recipient
+        position: the position of the message in the conversation
+        """
+        message = self.conversations[recipient].message_at(position)
+        self._search_index.add(message.get('entry'),
+                               timestamp_value(message.get('timestamp')))
+        self._search_docs.append((recipient, position))
+        self._search_changed = True
+
+    def set_cursor(self, cursor: int) -> None:
+        """
+        Set the id of the last server message synced into the notebook.
+
+        Arguments:
+        cursor: the message id
+        """
+        if cursor != self.cursor:
+            self.cursor = cursor
+            self._pending.append({'cursor': cursor})
+            self._dirty = True
+
     def add_unique_message(self,
                            sender: str,
                            message: DirectMessage) -> bool:
         """
         Add a message to conversations if it doesn't already
-        exist based on content and timestamp.
+        exist based on sender, content and timestamp.
 
         Arguments:
         sender: the username of the message sender
@@ -399,13 +1589,10 @@ class Notebook:
         bool: True if message was added (unique), False if duplicate found
         """
         if sender not in self.conversations:
-            self.conversations[sender] = Conversation(sender)
+            self.conversations[sender] = self.conversation_type(sender)
 
-        existing = self.conversations[sender].get_message()
-        for msg in existing:
-            if msg['entry'] == message.entry:
-                if msg['timestamp'] == message.timestamp:
-                    return False
+        if self.conversations[sender].has_message(message):
+            return False
 
-        self.conversations[sender].add_message(message)
+        self.add_message(sender, message)
         return True
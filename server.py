@@ -2,17 +2,38 @@ import socket
 import threading
 import json
 from pathlib import Path
-import sys
+import argparse
+import math
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import string
 import secrets
+from contextlib import contextmanager
+from collections import OrderedDict, deque
+from server_store import SqliteStore, CachedStore
+from durable_write import FSYNC_ALWAYS, FSYNC_NEVER, FSYNC_POLICIES
 
 USERS_PATH = 'users.json'
+USERS_DB_PATH = 'users.db'
 STORE_DIR_PATH = 'store'
 DEBUG = True ##SET THIS TO FALSE IF YOU DONT WANT DEBUGGING OUTPUT
+FLUSH_INTERVAL = 1.0 ##seconds between writes of the in-memory user table to disk
+MAX_MESSAGE_SIZE = 1024 * 1024 ##largest command (in bytes) a client may send
+LISTEN_BACKLOG = 1024
+EXECUTOR_WORKERS = 32 ##threads running commands for the asyncio server
+MAX_FETCH_WAIT = 60 ##longest time (in seconds) an unread fetch may wait for new messages
+SEARCH_LIMIT = 50 ##results returned by a search command that does not give a limit
+MAX_SEARCH_LIMIT = 1000 ##most results a search command may ask for
+PUSH_QUEUE_SIZE = 1000 ##pushes that may wait for a slow subscriber before it is disconnected
+PUSH_FLUSH_TIMEOUT = 5 ##longest time (in seconds) an unread fetch waits for the session's pending pushes
+MAX_RECIPIENTS = 100 ##most recipients a single directmessage command may have
+SENT_IDS = 256 ##directmessage ids remembered per sender, so a command sent again after a dropped connection is stored once
+MAX_ID_LENGTH = 64 ##longest directmessage id a client may give
 
-##The server uses a json files to store data:
+##The server stores data through a pluggable backend (see server_store.py), by default an sqlite database:
 ##users - bio's, posts
+##users.json is only used to import/export the store
 
 ##user schema:
 #{user_name: {'password', messages[{'entry','from/recipient', 'timestamp','status'}]
@@ -28,299 +49,698 @@ def _generate_random_string(n:int) -> str:
     alphanums = string.ascii_letters + string.digits
     return ''.join(secrets.choice(alphanums) for _ in range(n))
 
-users_file_lock = threading.Lock()
+def _is_count(value, minimum = 0):
+    '''Checks that a command field is an integer of at least minimum'''
+    return isinstance(value, int) and not isinstance(value, bool) and value >= minimum
+
+def _is_number(value):
+    '''Checks that a command field is an integer or a float'''
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+class UserLocks:
+    '''Hands out one lock per user so requests for unrelated users never wait on each other.
+    Several users are always locked in sorted username order, so an A->B send and a B->A send
+    cannot deadlock. A lock only exists while someone holds or waits for it, so the table does
+    not grow with every username ever seen.'''
+    def __init__(self):
+        self._locks = {} ##username -> [lock, number of holders and waiters]
+        self._guard = threading.Lock()
+
+    def _acquire_entries(self, usernames):
+        '''Returns the locks of the users, counting the caller as one more holder of each'''
+        with self._guard:
+            locks = []
+            for username in usernames:
+                entry = self._locks.get(username)
+                if entry is None:
+                    entry = self._locks[username] = [threading.Lock(), 0]
+                entry[1] += 1
+                locks.append(entry[0])
+            return locks
+
+    def _release_entries(self, usernames):
+        '''Forgets the locks nobody holds or waits for anymore'''
+        with self._guard:
+            for username in usernames:
+                entry = self._locks[username]
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._locks[username]
+
+    def __len__(self):
+        return len(self._locks)
+
+    @contextmanager
+    def hold(self, *usernames):
+        '''Context manager locking every given user for the duration of the block'''
+        usernames = sorted(set(usernames), key=str)
+        locks = self._acquire_entries(usernames)
+        acquired = []
+        try:
+            for lock in locks:
+                lock.acquire()
+                acquired.append(lock)
+            yield
+        finally:
+            for lock in reversed(acquired):
+                lock.release()
+            self._release_entries(usernames)
+
+def _shutdown(client_socket):
+    '''Closes both directions of a socket from any thread, so the thread reading it sees the end of the connection'''
+    try:
+        client_socket.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+class MessageTooLargeError(Exception):
+    '''Raised when a client sends a command longer than the configured limit'''
+
+##sent before closing a connection whose command is longer than max_message_size
+MESSAGE_TOO_LARGE_RESPONSE = json.dumps({'response': {'type': 'error', 'message': 'Message too large'}}).encode() + b'\r\n'
+
+def read_lines(client_socket, max_size = None, chunk_size = 4096):
+    '''Yields every CRLF (or LF) terminated command received on the socket, without the line ending.
+    Commands may span several recv calls and one recv may hold several commands.
+    A final unterminated command is yielded when the client closes the connection.'''
+    if max_size is None:
+        max_size = MAX_MESSAGE_SIZE
+    buffer = bytearray()
+    while True:
+        data = client_socket.recv(chunk_size)
+        if not data:
+            break
+        start = len(buffer) ##everything before start was already searched for a line ending
+        buffer += data
+        end = 0
+        newline = buffer.find(b'\n', start)
+        while newline != -1:
+            yield bytes(buffer[end:newline]).rstrip(b'\r')
+            end = newline + 1
+            newline = buffer.find(b'\n', end)
+        del buffer[:end]
+        if len(buffer) > max_size:
+            raise MessageTooLargeError(f'message exceeds {max_size} bytes')
+    if buffer.strip():
+        yield bytes(buffer)
+
+class ClientSession:
+    '''State of a single client connection'''
+    def __init__(self, address, send = None):
+        self.address = address
+        self.token = None ##token of the user authenticated on this connection
+        self.send = send ##callable writing a framed message to the client, safe to call from any thread
+        self.long_poll = None ##(user, seconds) of an empty unread fetch still waiting for new messages
+        self.pushes = PushQueue() ##pushes waiting to be written to the client once it subscribed
+        self.push_lock = threading.Lock()
+        self.push_cursor = 0 ##id of the newest message queued for push on this session
+        self.start_pushing = None ##callable starting the writer of self.pushes, set by the connection handler
+        self.disconnect = None ##callable closing the connection, safe to call from any thread
+
+class PushQueue:
+    '''Bounded queue of (data, username, message id) pushes waiting to be written to one subscribed client.
+    A push counts as pending until task_done is called for it, after it was written and marked read.'''
+    def __init__(self, maxsize = PUSH_QUEUE_SIZE):
+        self.maxsize = maxsize
+        self.wake = None ##called after every put and on close, for writers that do not block in get
+        self.closed = False
+        self._items = deque()
+        self._pending = 0
+        self._condition = threading.Condition()
+
+    def put(self, item):
+        '''Queues a push. Returns False if the queue is full or closed'''
+        with self._condition:
+            if self.closed or self._pending >= self.maxsize:
+                return False
+            self._items.append(item)
+            self._pending += 1
+            self._condition.notify_all()
+        if self.wake:
+            self.wake()
+        return True
+
+    def get(self, block = True):
+        '''Takes the next push, waiting for one if block is set. Returns None once the queue is closed (or empty when not blocking)'''
+        with self._condition:
+            while block and not self._items and not self.closed:
+                self._condition.wait()
+            if self.closed or not self._items:
+                return None
+            return self._items.popleft()
+
+    def task_done(self):
+        with self._condition:
+            self._pending = max(0, self._pending - 1)
+            self._condition.notify_all()
+
+    def join(self, timeout = None):
+        '''Waits until every queued push was written and marked read'''
+        with self._condition:
+            self._condition.wait_for(lambda: self._pending == 0 or self.closed, timeout)
+
+    def close(self):
+        '''Drops the waiting pushes, which stay unread in the store'''
+        with self._condition:
+            self.closed = True
+            self._items.clear()
+            self._pending = 0
+            self._condition.notify_all()
+        if self.wake:
+            self.wake()
+
 class DSUServer:
-    def __init__(self, host = '127.0.0.1', port = 3001):
+    def __init__(self, host = '127.0.0.1', port = 3001, store = None, flush_interval = FLUSH_INTERVAL, max_message_size = MAX_MESSAGE_SIZE, fsync_policy = FSYNC_ALWAYS):
         self.host = host
         self.port = port
+        self.store = store ##storage backend, created by _create_storage_system if not provided
+        self.flush_interval = flush_interval
+        self.max_message_size = max_message_size
+        self.fsync_policy = fsync_policy ##how hard writes to the store files try to reach the disk, see durable_write
+        self.user_locks = UserLocks()
         self.sessions = {} ##token -> user
+        self.subscribers = {} ##user -> sessions subscribed to push delivery of their direct messages
+        self.subscribers_lock = threading.Lock()
+        self.waiters = {} ##user -> callables to wake up long polling fetches when a message arrives
+        self.waiters_lock = threading.Lock()
+        self.sent_ids = {} ##user -> ids of their last SENT_IDS directmessage commands -> result, only used with the user locked
         self.clients = []
     
     def handle_client(self, client_socket, client_address):
 
         '''Handle requests from a single client'''
-        current_user_token = None   
+        send_lock = threading.Lock()
+        def send(data):
+            with send_lock:
+                client_socket.sendall(data)
+        session = ClientSession(client_address, send)
+        session.start_pushing = lambda: threading.Thread(target = self._push_loop, args = (session,), daemon = True).start()
+        session.disconnect = lambda: _shutdown(client_socket)
         self.clients.append(client_socket)
         try:
-            while True:
-                data = client_socket.recv(4096)
+            for data in read_lines(client_socket, self.max_message_size):
                 if DEBUG:
                     print(f"Message received by server: {repr(data)}")
-                direct_message_read = False
-                direct_message_sent = False
                 msg = data.decode().strip() 
                 if not msg:
-                    if DEBUG:
-                        print("Connection closed.")
-                    break
-                try:
-                    command = json.loads(msg.strip())
-                except json.JSONDecodeError:
-                    message = 'Incorrectly formatted JSON message.'
-                    status = 'error'
-                else: 
-                    message = ""
+                    continue ##blank line between commands
+                resp = self._handle_request(msg, session)
+                if session.long_poll:
+                    resp = self._finish_long_poll(session)
+                json_response = json.dumps(resp).encode()
+                session.send(json_response + b'\r\n')
+            if DEBUG:
+                print("Connection closed.")
+        except MessageTooLargeError as e:
+            print(f"Error handling client {client_address}: {e}")
+            try:
+                session.send(MESSAGE_TOO_LARGE_RESPONSE)
+            except OSError:
+                pass
+        except Exception as e:
+            print(f"Error handling client {client_address}: {e}")
+        finally:
+            self._end_session(session)
+            client_socket.close()
+            self.clients.remove(client_socket)
+
+    def _end_session(self, session):
+        '''Forget the token and subscriptions of a client that disconnected'''
+        session.pushes.close()
+        if session.token and session.token in self.sessions:
+            self._unsubscribe(self.sessions[session.token], session)
+            del self.sessions[session.token]
+
+    def _subscribe(self, username, session):
+        '''Registers a session for push delivery of the user's direct messages'''
+        with self.subscribers_lock:
+            self.subscribers.setdefault(username, []).append(session)
+
+    def _is_subscribed(self, username, session):
+        with self.subscribers_lock:
+            return session in self.subscribers.get(username, [])
+
+    def _unsubscribe(self, username, session):
+        with self.subscribers_lock:
+            sessions = self.subscribers.get(username, [])
+            if session in sessions:
+                sessions.remove(session)
+            if not sessions:
+                self.subscribers.pop(username, None)
+
+    def _add_waiter(self, username, wake):
+        '''Registers a callable that is called once a new message arrives for the user'''
+        with self.waiters_lock:
+            self.waiters.setdefault(username, []).append(wake)
+
+    def _remove_waiter(self, username, wake):
+        with self.waiters_lock:
+            waiters = self.waiters.get(username, [])
+            if wake in waiters:
+                waiters.remove(wake)
+            if not waiters:
+                self.waiters.pop(username, None)
+
+    def _wake_waiters(self, username):
+        with self.waiters_lock:
+            waiters = list(self.waiters.get(username, []))
+        for wake in waiters:
+            wake()
+
+    def _long_poll_response(self, username):
+        '''Builds the response of a long polling unread fetch once it stopped waiting'''
+        messages = self._read_unread_messages(username)
+        if DEBUG:
+            print(f'Server sending the following message: "{messages}"')
+        return {'response': {'type': 'ok', 'messages': messages}}
+
+    def _finish_long_poll(self, session):
+        '''Blocks until a message arrives for the long polling session's user or its wait expires, then answers the fetch'''
+        username, timeout = session.long_poll
+        session.long_poll = None
+        arrived = threading.Event()
+        self._add_waiter(username, arrived.set)
+        try:
+            ##a message may have arrived between the first read and registering the waiter
+            if not self.store.has_unread(username):
+                arrived.wait(timeout)
+        finally:
+            self._remove_waiter(username, arrived.set)
+        return self._long_poll_response(username)
+
+    def _push_unread(self, username):
+        '''Queues the user's unread messages for every subscribed session of that user. A message is marked as read
+        once it was written to a client, so a client never receives the same message from a push and an unread fetch,
+        and a push that could not be written stays unread. A session whose queue is full is disconnected.'''
+        with self.subscribers_lock:
+            sessions = list(self.subscribers.get(username, []))
+        if not sessions:
+            return
+        with self.user_locks.hold(username):
+            messages = self.store.read_unread_messages(username, mark = False) or []
+        for session in sessions:
+            with session.push_lock:
+                for message in messages:
+                    if message['id'] <= session.push_cursor:
+                        continue ##already queued for this session
+                    push = json.dumps({'push': {'type': 'directmessage', 'message': message}}).encode() + b'\r\n'
+                    if not session.pushes.put((push, username, message['id'])):
+                        print(f"Push queue of client {session.address} is full, disconnecting it")
+                        self._unsubscribe(username, session)
+                        session.pushes.close()
+                        session.disconnect()
+                        break
+                    session.push_cursor = message['id']
+
+    def _push_start(self, username):
+        '''Returns the message id pushes to a new subscription start after: just before the oldest unread message, or
+        the newest message when none is unread. A client whose connection drops before its pushes arrive fetches every
+        message since this id, because a push counts as read once it is written.'''
+        with self.user_locks.hold(username):
+            unread = self.store.read_unread_messages(username, mark = False) or []
+            if unread:
+                return min(message['id'] for message in unread) - 1
+            newest = self.store.read_all_messages(username, limit = 1, descending = True) or [] ##nothing is unread, so nothing is marked
+            return newest[0]['id'] if newest else 0
+
+    def _mark_pushed(self, username, message_id):
+        '''Marks a message as read once its push was written'''
+        with self.user_locks.hold(username):
+            self.store.mark_read(username, message_id, message_id)
+
+    def _push_loop(self, session):
+        '''Writes the pushes of a subscribed session on its own thread, so a slow client never holds up senders'''
+        while True:
+            item = session.pushes.get()
+            if item is None:
+                return
+            data, username, message_id = item
+            try:
+                session.send(data)
+            except OSError as e:
+                print(f"Error pushing to client {session.address}: {e}")
+                session.pushes.close()
+                session.disconnect()
+                return
+            self._mark_pushed(username, message_id)
+            session.pushes.task_done()
+
+    def _handle_request(self, msg, session):
+        '''Executes one JSON command sent on a client session and returns the response object'''
+        direct_message_read = False
+        direct_message_sent = False
+        recipient_results = None ##per-recipient status of a directmessage with a recipients list
+        searched = False
+        subscribed = False
+        next_page = None
+        try:
+            command = json.loads(msg.strip())
+        except json.JSONDecodeError:
+            message = 'Incorrectly formatted JSON message.'
+            status = 'error'
+        else: 
+            message = ""
+            status = "error"
+            
+            if 'authenticate' in command:
+                
+                if len(command) != 1: 
                     status = "error"
+                    message = "Incorrectly formatted authenticate command."
+                elif len(command['authenticate']) > 2:
+                    status = "error"
+                    message = "Extra fields provided to authenticate command object."
+                elif not all(field in command['authenticate'] for field in ['username', 'password']):
+                    status = "error"
+                    message = "Missing required fields for authenticate command object."
+                elif session.token:
+                    status = "error"
+                    message = "User already authenticated on the active session."
+                else:
+                    ##execute authenticate command
+                    
+                    uname = command['authenticate']['username']
+                    password = command['authenticate']['password']
+                    
                     
-                    if 'authenticate' in command:
+                    fetched_user = self._get_or_create_new_user(uname, password)
+
+                    session.token = generate_token()
+                    if not fetched_user:
+                        message = f'Welcome to ICS32 Distributed Social, {uname}!'
+                        status = 'ok'
+                        self.sessions[session.token] = uname
+
                         
-                        if len(command) != 1: 
-                            status = "error"
-                            message = "Incorrectly formatted authenticate command."
-                        elif len(command['authenticate']) > 2:
-                            status = "error"
-                            message = "Extra fields provided to authenticate command object."
-                        elif not all(field in command['authenticate'] for field in ['username', 'password']):
-                            status = "error"
-                            message = "Missing required fields for authenticate command object."
-                        elif current_user_token:
+                    else:
+                        if fetched_user['password'] != password:
                             status = "error"
-                            message = "User already authenticated on the active session."
-                        else:
-                            ##execute authenticate command
-                            
-                            uname = command['authenticate']['username']
-                            password = command['authenticate']['password']
+                            message = f'Incorrect password for the user {uname}'
+                            session.token = None
                             
-                            
-                            fetched_user = self._get_or_create_new_user(uname, password)
-
-                            current_user_token = generate_token()
-                            if not fetched_user:
-                                message = f'Welcome to ICS32 Distributed Social, {uname}!'
-                                status = 'ok'
-                                self.sessions[current_user_token] = uname
-
-                                
-                            else:
-                                if fetched_user['password'] != password:
-                                    status = "error"
-                                    message = f'Incorrect password for the user {uname}'
-                                    current_user_token = None
-                                    
-                                else:
-                                    status = "ok"
-                                    message = f'Welcome back, {uname}!'
-                                    self.sessions[current_user_token] = uname
-                    
-                    ###direct message handling
-                    elif 'directmessage' in command:
-                        
-                        args = command['directmessage']
-
-                        if 'token' not in command:
-                            message = 'Missing token.'
-                            status = 'error'
-                        elif len(command) != 2:
-                            message = "Incorrectly formatted directmessage command."
-                            status = 'error'
-                        elif args not in ['all', 'unread'] and not (isinstance(args, dict) and len(args) == 3):
-                            message = "Incorrect fields provided to directmessage command object."
-                            status = 'error'
-                        elif isinstance(args, dict) and not all(field in command['directmessage'] for field in ['entry', 'timestamp', 'recipient']):
-                            message = "Missing required fields for directmessage command."
-                            status = 'error'
                         else:
-                            token = command['token']
-                            recipient = args['recipient']
-                            #timestamp = args['timestamp']
-                            timestamp = str((datetime.now().timestamp()))
-                            entry = args['entry']
-                            if token == current_user_token and token in self.sessions:
-                                current_user = self.sessions[token]
-                                direct_message_sent = True
-                                    
-                                if self._send_message(entry,current_user, recipient, timestamp):
-                                    message = f'Direct message sent'
-                                    status = 'ok'
-                                else:
-                                    message = f'Unable to send direct message'
-                                    status = 'error'
-                            else:
-                                message = 'Invalid user token.'
-                                status = 'error'
-                            
-                    elif 'fetch' in command:
-                        args = command['fetch']
-                        token = command['token']
-                        if args == 'all':
-                            if token == current_user_token and token in self.sessions:
-                                current_user = self.sessions[token]
-                                direct_message_read = True
-                                message = self._read_all_messages(current_user)
-                                status = 'ok'
-                            else:
-                                message = f'Invalid user token.'
-                                status = 'error'
-                        elif args == 'unread':
-                            if token == current_user_token and token in self.sessions:
-                                current_user = self.sessions[token]
-                                direct_message_read = True
-                                message = self._read_unread_messages(current_user)
-                                status = 'ok'
-                            else:
-                                message = f'Invalid user token.'
-                                status = 'error'
+                            status = "ok"
+                            message = f'Welcome back, {uname}!'
+                            self.sessions[session.token] = uname
+            
+            ###direct message handling
+            elif 'directmessage' in command:
+                
+                args = command['directmessage']
 
+                if 'token' not in command:
+                    message = 'Missing token.'
+                    status = 'error'
+                elif len(command) != 2:
+                    message = "Incorrectly formatted directmessage command."
+                    status = 'error'
+                elif args not in ['all', 'unread'] and not (isinstance(args, dict) and len(args) == 3 + ('id' in args)):
+                    message = "Incorrect fields provided to directmessage command object."
+                    status = 'error'
+                elif isinstance(args, dict) and 'id' in args and not (isinstance(args['id'], str) and 0 < len(args['id']) <= MAX_ID_LENGTH):
+                    message = f"id must be a string of at most {MAX_ID_LENGTH} characters."
+                    status = 'error'
+                elif isinstance(args, dict) and not (all(field in args for field in ['entry', 'timestamp']) and ('recipient' in args or 'recipients' in args)):
+                    message = "Missing required fields for directmessage command."
+                    status = 'error'
+                elif 'recipients' in args and not (isinstance(args['recipients'], list) and args['recipients'] and all(isinstance(r, str) for r in args['recipients'])):
+                    message = "recipients must be a non-empty list of usernames."
+                    status = 'error'
+                elif 'recipients' in args and len(args['recipients']) > MAX_RECIPIENTS:
+                    message = f"A directmessage command may have at most {MAX_RECIPIENTS} recipients."
+                    status = 'error'
+                else:
+                    token = command['token']
+                    #timestamp = args['timestamp']
+                    timestamp = str((datetime.now().timestamp()))
+                    entry = args['entry']
+                    request_id = args.get('id', None) ##lets a client send the command again without the message being stored twice
+                    if token == session.token and token in self.sessions and 'recipients' in args:
+                        ##one message to many users: stored in one transaction, answered with a status per recipient
+                        current_user = self.sessions[token]
+                        direct_message_sent = True
+                        recipients = list(dict.fromkeys(args['recipients']))
+                        sent = self._send_messages(entry, current_user, recipients, timestamp, request_id)
+                        recipient_results = {recipient: 'ok' if ok else 'error' for recipient, ok in sent.items()}
+                        delivered = sum(sent.values())
+                        message = f'Direct message sent to {delivered} of {len(recipients)} recipients'
+                        status = 'ok' if delivered == len(recipients) else 'error'
+                    elif token == session.token and token in self.sessions:
+                        current_user = self.sessions[token]
+                        recipient = args['recipient']
+                        direct_message_sent = True
+                            
+                        if self._send_message(entry,current_user, recipient, timestamp, request_id):
+                            message = f'Direct message sent'
+                            status = 'ok'
                         else:
-                            message = 'Invalid argument for fetch field.'
+                            message = f'Unable to send direct message'
                             status = 'error'
-
                     else:
-                        message = 'Invalid command.'
+                        message = 'Invalid user token.'
                         status = 'error'
-                if DEBUG:
-                    print(f'Server sending the following message: "{message}"')
-                if direct_message_read:
-                    resp = {'response': {'type':status, 'messages': message} }
-                elif direct_message_sent:
-                    resp = {'response': {'type':status, 'message': message} }
-                elif status == 'ok':
-                    resp = {'response': {'type':status, 'message': message, 'token': current_user_token} }
+                    
+            elif 'fetch' in command:
+                args = command['fetch']
+                token = command['token']
+                wait = command.get('wait', 0) ##long poll: seconds an empty unread fetch may wait for new messages
+                since = command.get('since', 0) ##cursor: only return messages with a greater id
+                before = command.get('before', None) ##only return messages with a smaller id
+                limit = command.get('limit', None) ##page size, the response carries 'next' when more messages remain
+                order = command.get('order', 'asc')
+                peer = command.get('peer', None) ##only return the conversation with this user
+                if not _is_number(wait) or not math.isfinite(wait) or wait < 0:
+                    message = 'Invalid wait for fetch field.'
+                    status = 'error'
+                elif not _is_count(since):
+                    message = 'Invalid since for fetch field.'
+                    status = 'error'
+                elif before is not None and not _is_count(before, 1):
+                    message = 'Invalid before for fetch field.'
+                    status = 'error'
+                elif limit is not None and not _is_count(limit, 1):
+                    message = 'Invalid limit for fetch field.'
+                    status = 'error'
+                elif order not in ['asc', 'desc']:
+                    message = 'Invalid order for fetch field.'
+                    status = 'error'
+                elif peer is not None and not isinstance(peer, str):
+                    message = 'Invalid peer for fetch field.'
+                    status = 'error'
+                elif args == 'all':
+                    if token == session.token and token in self.sessions:
+                        current_user = self.sessions[token]
+                        direct_message_read = True
+                        message = self._read_all_messages(current_user, since, before, limit, order == 'desc', peer)
+                        if limit and message and len(message) == limit:
+                            next_page = message[-1]['id'] ##a full page, more messages may follow
+                        status = 'ok'
+                    else:
+                        message = f'Invalid user token.'
+                        status = 'error'
+                elif args == 'unread':
+                    if token == session.token and token in self.sessions:
+                        current_user = self.sessions[token]
+                        direct_message_read = True
+                        session.pushes.join(PUSH_FLUSH_TIMEOUT) ##messages already pushed to this session are not returned again
+                        message = self._read_unread_messages(current_user)
+                        status = 'ok'
+                        if not message and wait:
+                            session.long_poll = (current_user, min(wait, MAX_FETCH_WAIT)) ##answered by the connection handler
+                    else:
+                        message = f'Invalid user token.'
+                        status = 'error'
+
                 else:
-                    resp = {'response': {'type':status, 'message': message}}
-                json_response = json.dumps(resp).encode()
-                client_socket.sendall(json_response + b'\r\n')
-            if current_user_token and current_user_token in self.sessions:
-                del self.sessions[current_user_token]
-        except Exception as e:
-            print(f"Error handling client {client_address}: {e}")
-        finally:
-            client_socket.close()
-            self.clients.remove(client_socket)
-            
-    def _send_message(self, entry, username, recipient, timestamp = ''):
-        '''Sends a message from one user (username) to another (recipient). Creates the message in the user's associated object'''
-        with users_file_lock:
-            users_path = Path('.') / STORE_DIR_PATH / Path(USERS_PATH)
-            existing_users = None
-            with users_path.open('r') as user_file:
-                existing_users = json.load(user_file)
-            
-            fetched_sender = existing_users.get(username, None)
-            fetched_user = existing_users.get(recipient, None)
-            if not fetched_sender:
-                return False
-            if not fetched_user:
-                return False
-            
-            else:
-                with users_path.open('w') as user_file:
-                    fetched_sender['messages'].append({'message': entry, 'recipient': recipient, 'timestamp': timestamp, 'status': 'sent'})
-                    fetched_user['messages'].append({'message': entry, 'from': username, 'timestamp': timestamp, 'status': 'unread'})
-                    existing_users[recipient] = fetched_user
-                    existing_users[username] = fetched_sender
-                    json.dump(existing_users, user_file)
-        return True
+                    message = 'Invalid argument for fetch field.'
+                    status = 'error'
 
-    def _read_all_messages(self, username):
-        '''Retrieves all messages associated with a user'''
-        with users_file_lock:
-            users_path = Path('.') / STORE_DIR_PATH / Path(USERS_PATH)
-            existing_users = None
-            with users_path.open('r') as user_file:
-                existing_users = json.load(user_file)
-
-            fetched_user = existing_users.get(username, None)
-            if not fetched_user:
-                return False ##double check that user exists
-            result = []
-            for message in fetched_user['messages']:
-                if 'from' in message:
-                    mod_message = {'from': message['from'], 'message': message['message'], 'timestamp': message['timestamp']}
+            ###search: the user's messages containing every word of the query, newest first, from the store's search index
+            elif 'search' in command:
+                query = command['search']
+                token = command.get('token', None)
+                peer = command.get('peer', None) ##only search the conversation with this user
+                start = command.get('start', None) ##only messages with start <= timestamp < end
+                end = command.get('end', None)
+                limit = command.get('limit', SEARCH_LIMIT)
+                if not isinstance(query, str) or not query.strip():
+                    message = 'Invalid argument for search field.'
+                    status = 'error'
+                elif peer is not None and not isinstance(peer, str):
+                    message = 'Invalid peer for search field.'
+                    status = 'error'
+                elif (start is not None and not _is_number(start)) or (end is not None and not _is_number(end)):
+                    message = 'Invalid time range for search field.'
+                    status = 'error'
+                elif not _is_count(limit, 1):
+                    message = 'Invalid limit for search field.'
+                    status = 'error'
+                elif token == session.token and token in self.sessions:
+                    current_user = self.sessions[token]
+                    searched = True
+                    message = self._search_messages(current_user, query, peer, start, end, min(limit, MAX_SEARCH_LIMIT))
+                    status = 'ok'
                 else:
-                    mod_message = {'recipient': message['recipient'], 'message': message['message'], 'timestamp': message['timestamp']}
-                result.append(mod_message)
-                if message['status'] == 'unread':
-                    message['status'] = 'read'
+                    message = 'Invalid user token.'
+                    status = 'error'
+
+            ###push delivery: after subscribing, new direct messages are sent as {'push': {'type': 'directmessage', 'message': ...}}
+            elif 'subscribe' in command:
+                token = command.get('token', None)
+                if command['subscribe'] != 'directmessage':
+                    message = 'Invalid argument for subscribe field.'
+                    status = 'error'
+                elif token == session.token and token in self.sessions and session.start_pushing:
+                    current_user = self.sessions[token]
+                    subscribed = True
+                    next_page = self._push_start(current_user) ##pass as since to catch up on pushes lost with the connection
+                    if not self._is_subscribed(current_user, session):
+                        session.start_pushing()
+                        self._subscribe(current_user, session)
+                    self._push_unread(current_user) ##deliver whatever arrived before the subscription
+                    message = 'Subscribed to directmessage.'
+                    status = 'ok'
+                else:
+                    message = f'Invalid user token.'
+                    status = 'error'
 
             else:
-                with users_path.open('w') as user_file:
-                    
-                    existing_users[username] = fetched_user
-                    json.dump(existing_users, user_file)
-            
-            return sorted(result, key=lambda x: float(x["timestamp"]))
+                message = 'Invalid command.'
+                status = 'error'
+        if DEBUG:
+            print(f'Server sending the following message: "{message}"')
+        if direct_message_read or searched:
+            resp = {'response': {'type':status, 'messages': message} }
+            if next_page is not None:
+                resp['response']['next'] = next_page ##pass as since (or before for order desc) to get the next page
+        elif direct_message_sent or subscribed:
+            resp = {'response': {'type':status, 'message': message} }
+            if recipient_results is not None:
+                resp['response']['results'] = recipient_results
+            if next_page is not None:
+                resp['response']['next'] = next_page
+        elif status == 'ok':
+            resp = {'response': {'type':status, 'message': message, 'token': session.token} }
+        else:
+            resp = {'response': {'type':status, 'message': message}}
+        return resp
+
+    def _send_message(self, entry, username, recipient, timestamp = '', request_id = None):
+        '''Sends a message from one user (username) to another (recipient). Creates the message in the user's associated object.
+        A message with the id of one the user already sent is not stored again, the first result is returned instead.'''
+        with self.user_locks.hold(username, recipient):
+            sent = self._sent_before(username, request_id)
+            if sent is not None:
+                return sent
+            sent = self.store.add_message(entry, username, recipient, timestamp)
+            self._remember_sent(username, request_id, sent)
+        if sent:
+            self._push_unread(recipient)
+            self._wake_waiters(recipient)
+        return sent
+
+    def _send_messages(self, entry, username, recipients, timestamp = '', request_id = None):
+        '''Sends one message from a user to several recipients with a single store write.
+        Returns {recipient: True if the message was sent to that recipient}. Like _send_message, an id already used is not sent again.
+        Only recipients with an account are locked, so made-up usernames never reach the lock table.'''
+        existing = [recipient for recipient in recipients if self.store.get_user(recipient) is not None]
+        with self.user_locks.hold(username, *existing):
+            results = self._sent_before(username, request_id)
+            if results is not None:
+                return results
+            results = dict.fromkeys(recipients, False)
+            if existing:
+                results.update(self.store.add_messages(entry, username, existing, timestamp))
+            self._remember_sent(username, request_id, results)
+        for recipient, sent in results.items():
+            if sent:
+                self._push_unread(recipient)
+                self._wake_waiters(recipient)
+        return results
+
+    def _sent_before(self, username, request_id):
+        '''Returns the result of the user's earlier directmessage with this id, None if there is none. The user must be locked.'''
+        if request_id is None:
+            return None
+        return self.sent_ids.get(username, {}).get(request_id, None)
+
+    def _remember_sent(self, username, request_id, result):
+        '''Records the result of a directmessage with an id, forgetting the oldest past SENT_IDS. The user must be locked.'''
+        if request_id is None:
+            return
+        sent_ids = self.sent_ids.setdefault(username, OrderedDict())
+        sent_ids[request_id] = result
+        if len(sent_ids) > SENT_IDS:
+            sent_ids.popitem(last = False)
+
+    def _read_all_messages(self, username, since = 0, before = None, limit = None, descending = False, peer = None):
+        '''Retrieves all messages associated with a user, or one page of them between the message ids since and before.
+        If peer is given only the conversation between the user and peer is retrieved.'''
+        with self.user_locks.hold(username):
+            return self.store.read_all_messages(username, since, before, limit, descending, peer)
 
     
+    def _search_messages(self, username, query, peer = None, start = None, end = None, limit = None):
+        '''Searches the messages of a user without marking them as read'''
+        with self.user_locks.hold(username):
+            return self.store.search_messages(username, query, peer, start, end, limit)
+
     def _read_unread_messages(self, username):
         '''Retrieves unread messages associated with the user'''
-        with users_file_lock:
-            users_path = Path('.') / STORE_DIR_PATH / Path(USERS_PATH)
-            existing_users = None
-            with users_path.open('r') as user_file:
-                existing_users = json.load(user_file)
-
-            fetched_user = existing_users.get(username, None)
-            if not fetched_user:
-                return False ##double check that user exists
-            result = []
-            for message in fetched_user['messages']:
-                if message['status'] == 'unread':
-                    mod_message = {'from': message['from'], 'message': message['message'], 'timestamp': message['timestamp']}
-                    result.append(mod_message)
-                    message['status'] = 'read'
-            
-            
-            else:
-                with users_path.open('w') as user_file:
-                    existing_users[username] = fetched_user
-                    
-                    json.dump(existing_users, user_file)
-            
-            return sorted(result, key=lambda x: float(x["timestamp"]))
+        with self.user_locks.hold(username):
+            return self.store.read_unread_messages(username)
 
     def _get_user(self, username):
 
         '''Gets the user object associated with the username. This function is never called.'''
-        with users_file_lock:
-            users_path = Path('.') / STORE_DIR_PATH / Path(USERS_PATH)
-            with users_path.open('r') as user_file:
-                existing_users = json.load(user_file)
-                fetched_user = existing_users.get(username, None)
-                return fetched_user
+        with self.user_locks.hold(username):
+            return self.store.get_user(username)
     
 
 
     def _get_or_create_new_user(self, username, password):
 
-        '''Read from the user file and get the username associated with the username. If it doesnt exist, create a new user.'''
-        with users_file_lock:
-            users_path = Path('.') / STORE_DIR_PATH / Path(USERS_PATH)
-            existing_users = None
-            with users_path.open('r') as user_file:
-                existing_users = json.load(user_file)
-
-            fetched_user = existing_users.get(username, None)
+        '''Get the user associated with the username. If it doesnt exist, create a new user.'''
+        with self.user_locks.hold(username):
+            fetched_user = self.store.get_user(username)
             if fetched_user:
                 return fetched_user
-            else:
-                with users_path.open('w') as user_file:
-                    
-                    fetched_user = existing_users.get(username, None)
-                    if fetched_user: ##double check that no user exists
-                        return False
-                    else:
-                        existing_users.update({username: {'password': password, 'bio': {"entry": "", "timestamp": ""}, 'posts': [], 'messages':[]}})
-                    json.dump(existing_users, user_file)
+            if not self.store.create_user(username, password):
+                return self.store.get_user(username) ##created by someone else in the meantime
             
         
     def _create_storage_system(self):
-        '''Creates the local storage system if it doesnt already exist. Will create a directory called "store" with two files posts.json and users.json'''
+        '''Creates the local storage system if it doesnt already exist. Will create a directory called "store" holding the users database.
+        An existing users.json from older versions of the server is imported the first time the database is created.
+        The user table is then held in memory and written behind to the database every flush_interval seconds.'''
         users_path = Path('.') / STORE_DIR_PATH / Path(USERS_PATH)
+        db_path = Path('.') / STORE_DIR_PATH / Path(USERS_DB_PATH)
         store_path = Path('.') / Path(STORE_DIR_PATH)
         store_path.mkdir(exist_ok=True)
-        if not users_path.exists():
-            with users_path.open('w') as json_file:
-                json.dump({}, json_file, indent=4)
+        if self.store is None:
+            import_users = not db_path.exists() and users_path.exists()
+            backend = SqliteStore(db_path, self.fsync_policy)
+            if import_users:
+                if DEBUG:
+                    print(f'Importing {users_path} into {db_path}')
+                backend.import_json(users_path)
+            self.store = CachedStore(backend, self.flush_interval)
+
+    def export_users(self, path = None):
+        '''Writes the whole store to a file in the users.json format (store/users.json by default)'''
+        if path is None:
+            path = Path('.') / STORE_DIR_PATH / Path(USERS_PATH)
+        self.store.export_json(path, fsync = self.fsync_policy != FSYNC_NEVER)
 
     def start_server(self):
         '''Starts the server (hence the name of the method :))'''
         self._create_storage_system() #does nothing if the server store files exists already
         try:
             with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as srv:
+                ## lets a restarted server bind while connections of the old one linger, so clients can reconnect
+                srv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
                 srv.bind((self.host, self.port))
-                srv.listen(5)
+                srv.listen(LISTEN_BACKLOG)
                 if DEBUG:
                     print("DSUserver is listening on port", self.port)
                 while True:
@@ -336,22 +756,155 @@ class DSUServer:
             self.clients = []
             if DEBUG:
                 print('Disconnected all clients.')
+            self.store.close()
+
+
+class AsyncDSUServer(DSUServer):
+    '''Same protocol as DSUServer, but every connection is served by one asyncio event loop instead of a thread per client.
+    Commands still touch the store and the per-user locks, so they run on a bounded thread pool executor.'''
+    def __init__(self, host = '127.0.0.1', port = 3001, store = None, flush_interval = FLUSH_INTERVAL, max_message_size = MAX_MESSAGE_SIZE, max_workers = EXECUTOR_WORKERS, fsync_policy = FSYNC_ALWAYS):
+        super().__init__(host, port, store, flush_interval, max_message_size, fsync_policy)
+        self.max_workers = max_workers
+        self.executor = None
+
+    async def handle_client_async(self, reader, writer):
+        '''Handle requests from a single client connection on the event loop'''
+        client_address = writer.get_extra_info('peername')
+        loop = asyncio.get_running_loop()
+        session = ClientSession(client_address, lambda data: loop.call_soon_threadsafe(writer.write, data))
+        pushers = []
+        session.start_pushing = lambda: loop.call_soon_threadsafe(lambda: pushers.append(loop.create_task(self._push_loop_async(session, writer))))
+        session.disconnect = lambda: loop.call_soon_threadsafe(writer.close)
+        try:
+            while True:
+                try:
+                    data = await reader.readuntil(b'\n')
+                except asyncio.IncompleteReadError as e:
+                    data = e.partial ##client closed the connection, possibly after an unterminated command
+                if DEBUG:
+                    print(f"Message received by server: {repr(data)}")
+                if not data:
+                    if DEBUG:
+                        print("Connection closed.")
+                    break
+                msg = data.decode().strip()
+                if not msg:
+                    continue ##blank line between commands
+                resp = await loop.run_in_executor(self.executor, self._handle_request, msg, session)
+                if session.long_poll:
+                    resp = await self._finish_long_poll_async(session)
+                writer.write(json.dumps(resp).encode() + b'\r\n')
+                await writer.drain()
+        except asyncio.LimitOverrunError:
+            print(f"Error handling client {client_address}: message exceeds {self.max_message_size} bytes")
+            try:
+                writer.write(MESSAGE_TOO_LARGE_RESPONSE)
+                await writer.drain()
+            except OSError:
+                pass
+        except Exception as e:
+            print(f"Error handling client {client_address}: {e}")
+        finally:
+            self._end_session(session)
+            writer.close()
+
+    async def _push_loop_async(self, session, writer):
+        '''Writes the pushes of a subscribed session, waiting for the client to read them without blocking the loop'''
+        loop = asyncio.get_running_loop()
+        ready = asyncio.Event()
+        session.pushes.wake = lambda: loop.call_soon_threadsafe(ready.set)
+        while True:
+            item = session.pushes.get(block = False)
+            if item is None:
+                if session.pushes.closed:
+                    return
+                await ready.wait()
+                ready.clear()
+                continue
+            data, username, message_id = item
+            try:
+                writer.write(data)
+                await writer.drain()
+            except (OSError, RuntimeError) as e:
+                print(f"Error pushing to client {session.address}: {e}")
+                session.pushes.close()
+                writer.close()
+                return
+            await loop.run_in_executor(self.executor, self._mark_pushed, username, message_id)
+            session.pushes.task_done()
+
+    async def _finish_long_poll_async(self, session):
+        '''Waits on the event loop, instead of an executor thread, until a message arrives for the long polling
+        session's user or its wait expires, then answers the fetch'''
+        loop = asyncio.get_running_loop()
+        username, timeout = session.long_poll
+        session.long_poll = None
+        arrived = asyncio.Event()
+        wake = lambda: loop.call_soon_threadsafe(arrived.set)
+        self._add_waiter(username, wake)
+        try:
+            if not self.store.has_unread(username):
+                await asyncio.wait_for(arrived.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            self._remove_waiter(username, wake)
+        return await loop.run_in_executor(self.executor, self._long_poll_response, username)
+
+    async def _serve(self):
+        srv = await asyncio.start_server(self.handle_client_async, self.host, self.port,
+                                         limit = self.max_message_size, backlog = LISTEN_BACKLOG)
+        if DEBUG:
+            print("DSUserver (asyncio) is listening on port", self.port)
+        async with srv:
+            await srv.serve_forever()
+
+    def start_server(self):
+        '''Starts the server on an asyncio event loop'''
+        self._create_storage_system()
+        self.executor = ThreadPoolExecutor(max_workers = self.max_workers)
+        try:
+            asyncio.run(self._serve())
+        except KeyboardInterrupt as e:
+            if DEBUG:
+                print(f'Server shutting down...')
+        finally:
+            self.executor.shutdown()
+            self.store.close()
 
         
-def run_server(host = '127.0.0.1', port1 = 3001):
+def run_server(host = '127.0.0.1', port1 = 3001, flush_interval = FLUSH_INTERVAL, use_asyncio = False, max_message_size = MAX_MESSAGE_SIZE, fsync_policy = FSYNC_ALWAYS, export_path = None):
+    '''Serves clients, or if export_path is given writes the store to that file in the users.json format and exits'''
     try:
-        server = DSUServer(host, port1)
+        server_class = AsyncDSUServer if use_asyncio else DSUServer
+        server = server_class(host, port1, flush_interval = flush_interval, max_message_size = max_message_size, fsync_policy = fsync_policy)
+        if export_path is not None:
+            server._create_storage_system()
+            server.export_users(export_path)
+            server.store.close()
+            if DEBUG:
+                print(f'Exported the store to {export_path}')
+            return
         server.start_server()
     except Exception as e:
         print(f'Server raised the following error:{e}')
     
 if __name__ == '__main__':
     host = '127.0.0.1'
-    port1 = 3001
-    port2 = 3002
-    if len(sys.argv) >= 2:
-        port1 = int(sys.argv[1])
+    parser = argparse.ArgumentParser(description='ICS32 Distributed Social server')
+    parser.add_argument('port', nargs='?', type=int, default=3001)
+    parser.add_argument('--flush-interval', type=float, default=FLUSH_INTERVAL,
+                        help='seconds between writes of the in-memory user table to disk')
+    parser.add_argument('--asyncio', action='store_true',
+                        help='serve all clients from one asyncio event loop instead of a thread per client')
+    parser.add_argument('--max-message-size', type=int, default=MAX_MESSAGE_SIZE,
+                        help='largest command (in bytes) a client may send')
+    parser.add_argument('--fsync', choices=FSYNC_POLICIES, default=FSYNC_ALWAYS,
+                        help='always: sync every write to disk, batch: sync in groups, never: leave it to the OS')
+    parser.add_argument('--export', metavar='PATH', nargs='?', const=str(Path(STORE_DIR_PATH) / USERS_PATH), default=None,
+                        help='write the store to a users.json file (store/users.json if no path is given) and exit')
+    args = parser.parse_args()
    
-    run_server(host,port1)
+    run_server(host, args.port, args.flush_interval, args.asyncio, args.max_message_size, args.fsync, args.export)
 
 
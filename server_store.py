@@ -0,0 +1,897 @@
+# server_store.py
+# Connor Ng
+# ngce@uci.edu
+# ngce
+
+"""
+Storage backends for DSUServer.
+
+A backend owns the user table and every user's message list. The server
+only talks to the Store interface below, so backends can be swapped
+without touching the protocol code.
+
+Messages are returned to the server as
+{'id', 'from' or 'recipient', 'message', 'timestamp'}. The id is the
+position (starting at 1) of the message in the user's own message list,
+so it only ever grows and a client can use the last id it has seen as a
+cursor. The status of a message is tracked by the backend and can be
+"unread", "read" or "sent".
+"""
+
+import json
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from bisect import bisect_left, bisect_right
+from pathlib import Path
+from durable_write import atomic_write, FSYNC_ALWAYS, FSYNC_BATCH, FSYNC_NEVER
+from text_index import parse_query, tokenize
+
+# Upper bound for message ids in queries without one
+_NO_LIMIT = 2 ** 62
+
+
+class Store(ABC):
+    """
+    Interface implemented by every DSUServer storage backend.
+    """
+
+    @abstractmethod
+    def get_user(self, username):
+        """
+        Get a user.
+
+        Arguments:
+        username: the username of the user
+
+        Returns:
+        dict: {'password', 'bio', 'posts'}, or None if the user does
+        not exist
+        """
+
+    @abstractmethod
+    def create_user(self, username, password):
+        """
+        Create a new user.
+
+        Arguments:
+        username: the username of the new user
+        password: the password of the new user
+
+        Returns:
+        bool: False if the user already exists
+        """
+
+    @abstractmethod
+    def add_message(self, entry, sender, recipient, timestamp):
+        """
+        Store a message for both the sender and the recipient.
+
+        Arguments:
+        entry: the message text
+        sender: the username of the sender
+        recipient: the username of the recipient
+        timestamp: the timestamp of the message
+
+        Returns:
+        bool: False if either user does not exist
+        """
+
+    def add_messages(self, entry, sender, recipients, timestamp):
+        """
+        Store the same message for the sender and each of the
+        recipients, in one transaction where the backend has them.
+
+        Arguments:
+        entry: the message text
+        sender: the username of the sender
+        recipients: the usernames of the recipients
+        timestamp: the timestamp of the message
+
+        Returns:
+        dict: recipient -> True if the message was stored for them
+        """
+        return {recipient: self.add_message(entry, sender, recipient,
+                                            timestamp)
+                for recipient in recipients}
+
+    @abstractmethod
+    def read_all_messages(self, username, since=0, before=None, limit=None,
+                          descending=False, peer=None):
+        """
+        Get the messages of a user with since < id < before, in
+        timestamp order, and mark the returned messages as read.
+
+        Arguments:
+        username: the username of the user
+        since: only return messages with a greater id
+        before: only return messages with a smaller id
+        limit: the largest number of messages to return
+        descending: return the newest messages first
+        peer: only return the conversation with this user
+
+        Returns:
+        list: the messages, or False if the user does not exist
+        """
+
+    @abstractmethod
+    def read_unread_messages(self, username, mark=True):
+        """
+        Get the unread messages of a user in timestamp order.
+
+        Arguments:
+        username: the username of the user
+        mark: whether to mark the returned messages as read
+
+        Returns:
+        list: the messages, or False if the user does not exist
+        """
+
+    @abstractmethod
+    def has_unread(self, username):
+        """
+        Check whether a user has unread messages.
+
+        Arguments:
+        username: the username of the user
+
+        Returns:
+        bool: True if the user has unread messages
+        """
+
+    @abstractmethod
+    def mark_read(self, username, first=1, last=None, peer=None):
+        """
+        Mark the unread messages of a user with first <= id <= last as
+        read.
+
+        Arguments:
+        username: the username of the user
+        first: the id of the first message to mark
+        last: the id of the last message to mark, None for no bound
+        peer: only mark the messages from this user
+        """
+
+    @abstractmethod
+    def search_messages(self, username, query, peer=None, start=None,
+                        end=None, limit=None):
+        """
+        Get the messages of a user containing every word of a query, a
+        word ending in * matching any word starting with it. Nothing is
+        marked as read.
+
+        Arguments:
+        username: the username of the user
+        query: the words to look for
+        peer: only search the conversation with this user
+        start: only return messages with start <= timestamp
+        end: only return messages with timestamp < end
+        limit: the largest number of messages to return
+
+        Returns:
+        list: the messages, newest first, or False if the user does not
+        exist
+        """
+
+    def apply(self, operations):
+        """
+        Replay a batch of write operations against the store.
+
+        Arguments:
+        operations: (method name, *args) tuples
+        """
+        for name, *args in operations:
+            getattr(self, name)(*args)
+
+    @abstractmethod
+    def import_users(self, users):
+        """
+        Load users into the store.
+
+        Arguments:
+        users: a users dictionary in the users.json format
+        """
+
+    @abstractmethod
+    def export_users(self):
+        """
+        Get the whole store.
+
+        Returns:
+        dict: the users in the users.json format
+        """
+
+    def close(self):
+        """
+        Release any resources held by the store.
+        """
+
+    def import_json(self, path):
+        """
+        Import a users.json file into the store.
+
+        Arguments:
+        path: the path of the file
+        """
+        with Path(path).open('r') as user_file:
+            self.import_users(json.load(user_file))
+
+    def export_json(self, path, fsync=True):
+        """
+        Write the whole store to a users.json file. The file is replaced
+        in one step, so a crash during the export leaves the previous
+        file intact.
+
+        Arguments:
+        path: the path of the file
+        fsync: whether to wait for the file to reach the disk
+        """
+        atomic_write(path, json.dumps(self.export_users()), fsync=fsync)
+
+
+def _timestamp_key(timestamp):
+    """
+    Sort key for timestamps loaded from users.json, bad timestamps sort
+    first.
+
+    Arguments:
+    timestamp: the timestamp of a message
+
+    Returns:
+    float: the timestamp as a number
+    """
+    try:
+        return float(timestamp)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def _peer_of(message):
+    """
+    Get the other user of a message in the users.json format.
+
+    Arguments:
+    message: the message
+
+    Returns:
+    str: the username of the other user
+    """
+    return message['from'] if 'from' in message else message['recipient']
+
+
+def _message_rows(rows):
+    """
+    Convert (seq, direction, peer, message, timestamp) rows to messages.
+
+    Arguments:
+    rows: the rows read from the messages table
+
+    Returns:
+    list: the messages
+    """
+    return [{'id': seq, direction: peer, 'message': message,
+             'timestamp': timestamp}
+            for seq, direction, peer, message, timestamp in rows]
+
+
+class SqliteStore(Store):
+    """
+    Incremental SQLite backend. Every message is one row, so sending or
+    reading only touches the rows involved instead of rewriting the
+    whole store. Rows are inserted in timestamp order, so the primary
+    key doubles as the sort order.
+    """
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS users (
+            username TEXT PRIMARY KEY,
+            password TEXT,
+            bio TEXT NOT NULL DEFAULT '{"entry": "", "timestamp": ""}',
+            posts TEXT NOT NULL DEFAULT '[]'
+        );
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT NOT NULL,
+            peer TEXT NOT NULL,
+            direction TEXT NOT NULL,
+            message TEXT NOT NULL,
+            timestamp TEXT NOT NULL,
+            status TEXT NOT NULL,
+            seq INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS unread_by_user
+            ON messages (username, id) WHERE status = 'unread';
+        CREATE TABLE IF NOT EXISTS terms (
+            username TEXT NOT NULL,
+            term TEXT NOT NULL,
+            seq INTEGER NOT NULL,
+            PRIMARY KEY (username, term, seq)
+        ) WITHOUT ROWID;
+    '''
+    INDEXES = '''
+        CREATE UNIQUE INDEX IF NOT EXISTS messages_by_user_seq
+            ON messages (username, seq);
+        CREATE INDEX IF NOT EXISTS messages_by_conversation
+            ON messages (username, peer, seq);
+    '''
+
+    # fsync policy -> sqlite synchronous setting. In WAL mode NORMAL only
+    # syncs at checkpoints, so a power loss can drop the last few commits
+    # but never corrupts the database
+    SYNCHRONOUS = {FSYNC_ALWAYS: 'FULL', FSYNC_BATCH: 'NORMAL',
+                   FSYNC_NEVER: 'OFF'}
+
+    def __init__(self, path, fsync_policy=FSYNC_ALWAYS):
+        """
+        Open (or create) the database.
+
+        Arguments:
+        path: the path of the database file
+        fsync_policy: how hard commits try to reach the disk
+        """
+        self.path = str(path)
+        # sqlite serializes writers anyway, so one shared connection is
+        # enough
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(self.path, timeout=30,
+                                     check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            f'PRAGMA synchronous={self.SYNCHRONOUS[fsync_policy]}')
+        self._conn.executescript(self.SCHEMA)
+        self._migrate()
+        self._conn.executescript(self.INDEXES)
+
+    def _migrate(self):
+        """
+        Number the messages of databases created before messages had a
+        per-user seq, and fill the search terms of databases created
+        before the terms table.
+        """
+        with self._lock, self._conn as conn:
+            columns = [row[1] for row in conn.execute(
+                'PRAGMA table_info(messages)').fetchall()]
+            if 'seq' not in columns:
+                conn.execute('ALTER TABLE messages ADD COLUMN seq INTEGER')
+            conn.execute('DROP INDEX IF EXISTS messages_by_user')
+            rows = conn.execute('SELECT id, username FROM messages '
+                                'WHERE seq IS NULL ORDER BY id').fetchall()
+            counters = {}
+            updates = []
+            for message_id, username in rows:
+                counters[username] = counters.get(username, 0) + 1
+                updates.append((counters[username], message_id))
+            conn.executemany('UPDATE messages SET seq = ? WHERE id = ?',
+                             updates)
+            if self._query_one('PRAGMA user_version', ())[0] < 1:
+                conn.execute('DELETE FROM terms')
+                self._index_terms(conn, conn.execute(
+                    'SELECT username, seq, message FROM messages').fetchall())
+                conn.execute('PRAGMA user_version = 1')
+
+    def _index_terms(self, conn, rows):
+        """
+        Add the words of messages to the search terms table.
+
+        Arguments:
+        conn: the connection of the current transaction
+        rows: (username, seq, message) tuples
+        """
+        conn.executemany(
+            'INSERT OR IGNORE INTO terms (username, term, seq) '
+            'VALUES (?, ?, ?)',
+            ((username, term, seq) for username, seq, entry in rows
+             for term in set(tokenize(entry))))
+
+    def _query_one(self, sql, params):
+        """
+        Run a query and return its first row. The cursor is drained so
+        the statement does not keep a read snapshot open.
+
+        Arguments:
+        sql: the query
+        params: the query parameters
+
+        Returns:
+        tuple: the first row, or None if there is none
+        """
+        rows = self._conn.execute(sql, params).fetchall()
+        return rows[0] if rows else None
+
+    def _user_exists(self, username):
+        """
+        Check whether a user exists. The lock must be held.
+
+        Arguments:
+        username: the username of the user
+
+        Returns:
+        bool: True if the user exists
+        """
+        return self._query_one('SELECT 1 FROM users WHERE username = ?',
+                               (username,)) is not None
+
+    def get_user(self, username):
+        with self._lock:
+            row = self._query_one('SELECT password, bio, posts FROM users '
+                                  'WHERE username = ?', (username,))
+        if not row:
+            return None
+        return {'password': row[0], 'bio': json.loads(row[1]),
+                'posts': json.loads(row[2])}
+
+    def create_user(self, username, password):
+        with self._lock, self._conn as conn:
+            return self._create_user(conn, username, password)
+
+    def add_message(self, entry, sender, recipient, timestamp):
+        with self._lock, self._conn as conn:
+            return self._add_message(conn, entry, sender, recipient,
+                                     timestamp)
+
+    def add_messages(self, entry, sender, recipients, timestamp):
+        with self._lock, self._conn as conn:
+            return self._add_messages(conn, entry, sender, recipients,
+                                      timestamp)
+
+    def has_unread(self, username):
+        with self._lock:
+            return self._query_one(
+                "SELECT 1 FROM messages WHERE username = ? "
+                "AND status = 'unread' LIMIT 1", (username,)) is not None
+
+    def mark_read(self, username, first=1, last=None, peer=None):
+        with self._lock, self._conn as conn:
+            self._mark_read(conn, username, first, last, peer)
+
+    def apply(self, operations):
+        """
+        Replay the whole batch in a single transaction, so it costs one
+        commit.
+
+        Arguments:
+        operations: (method name, *args) tuples
+        """
+        writers = {'create_user': self._create_user,
+                   'add_message': self._add_message,
+                   'add_messages': self._add_messages,
+                   'mark_read': self._mark_read}
+        with self._lock, self._conn as conn:
+            for name, *args in operations:
+                writers[name](conn, *args)
+
+    def _create_user(self, conn, username, password):
+        cursor = conn.execute('INSERT OR IGNORE INTO users '
+                              '(username, password) VALUES (?, ?)',
+                              (username, password))
+        return cursor.rowcount == 1
+
+    def _add_message(self, conn, entry, sender, recipient, timestamp):
+        found = self._query_one('SELECT COUNT(*) FROM users '
+                                'WHERE username IN (?, ?)',
+                                (sender, recipient))[0]
+        if found != len({sender, recipient}):
+            return False
+        self._insert_message(conn, sender, recipient, 'recipient', entry,
+                             timestamp, 'sent')
+        self._insert_message(conn, recipient, sender, 'from', entry,
+                             timestamp, 'unread')
+        return True
+
+    def _add_messages(self, conn, entry, sender, recipients, timestamp):
+        if not self._user_exists(sender):
+            return {recipient: False for recipient in recipients}
+        results = {}
+        for recipient in recipients:
+            if recipient == sender or self._user_exists(recipient):
+                self._insert_message(conn, sender, recipient, 'recipient',
+                                     entry, timestamp, 'sent')
+                self._insert_message(conn, recipient, sender, 'from',
+                                     entry, timestamp, 'unread')
+                results[recipient] = True
+            else:
+                results[recipient] = False
+        return results
+
+    def _insert_message(self, conn, username, peer, direction, entry,
+                        timestamp, status):
+        seq = self._query_one('SELECT COALESCE(MAX(seq), 0) + 1 '
+                              'FROM messages WHERE username = ?',
+                              (username,))[0]
+        conn.execute('INSERT INTO messages (username, peer, direction, '
+                     'message, timestamp, status, seq) '
+                     'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                     (username, peer, direction, entry, timestamp, status,
+                      seq))
+        self._index_terms(conn, [(username, seq, entry)])
+
+    def _mark_read(self, conn, username, first=1, last=None, peer=None):
+        conditions = ("username = ? AND status = 'unread' "
+                      "AND seq BETWEEN ? AND ?")
+        params = [username, first, last if last is not None else _NO_LIMIT]
+        if peer is not None:
+            conditions += ' AND peer = ?'
+            params.append(peer)
+        conn.execute(f"UPDATE messages SET status = 'read' "
+                     f"WHERE {conditions}", params)
+
+    def read_all_messages(self, username, since=0, before=None, limit=None,
+                          descending=False, peer=None):
+        with self._lock, self._conn as conn:
+            if not self._user_exists(username):
+                return False
+            # Served straight from the (username, seq) or
+            # (username, peer, seq) index, so a page costs O(limit)
+            # whatever the history size
+            conditions = 'username = ? AND seq > ? AND seq < ?'
+            params = [username, since,
+                      before if before is not None else _NO_LIMIT]
+            if peer is not None:
+                conditions += ' AND peer = ?'
+                params.append(peer)
+            order = 'DESC' if descending else 'ASC'
+            rows = conn.execute(
+                f'SELECT seq, direction, peer, message, timestamp '
+                f'FROM messages WHERE {conditions} '
+                f'ORDER BY seq {order} LIMIT ?',
+                params + [limit if limit is not None else -1]).fetchall()
+            if rows:
+                seqs = [row[0] for row in rows]
+                self._mark_read(conn, username, min(seqs), max(seqs), peer)
+        return _message_rows(rows)
+
+    def read_unread_messages(self, username, mark=True):
+        with self._lock, self._conn as conn:
+            if not self._user_exists(username):
+                return False
+            rows = conn.execute(
+                "SELECT seq, peer, message, timestamp FROM messages "
+                "WHERE username = ? AND status = 'unread' ORDER BY seq",
+                (username,)).fetchall()
+            if mark:
+                self._mark_read(conn, username)
+        return [{'id': seq, 'from': peer, 'message': message,
+                 'timestamp': timestamp}
+                for seq, peer, message, timestamp in rows]
+
+    def search_messages(self, username, query, peer=None, start=None,
+                        end=None, limit=None):
+        words = parse_query(query)
+        with self._lock:
+            if not self._user_exists(username):
+                return False
+            if not words:
+                return []
+            # One lookup in the terms primary key per word, a word ending
+            # in * is a range of terms
+            matches = []
+            params = []
+            for word in words:
+                if word.endswith('*'):
+                    matches.append('SELECT seq FROM terms WHERE username = ? '
+                                   'AND term >= ? AND term < ?')
+                    params += [username, word[:-1], word[:-1] + '\U0010ffff']
+                else:
+                    matches.append('SELECT seq FROM terms WHERE username = ? '
+                                   'AND term = ?')
+                    params += [username, word]
+            conditions = (f'username = ? AND seq IN '
+                          f'({" INTERSECT ".join(matches)})')
+            params.insert(0, username)
+            if peer is not None:
+                conditions += ' AND peer = ?'
+                params.append(peer)
+            if start is not None:
+                conditions += ' AND CAST(timestamp AS REAL) >= ?'
+                params.append(start)
+            if end is not None:
+                conditions += ' AND CAST(timestamp AS REAL) < ?'
+                params.append(end)
+            rows = self._conn.execute(
+                f'SELECT seq, direction, peer, message, timestamp '
+                f'FROM messages WHERE {conditions} '
+                f'ORDER BY CAST(timestamp AS REAL) DESC, seq DESC LIMIT ?',
+                params + [limit if limit is not None else -1]).fetchall()
+        return _message_rows(rows)
+
+    def import_users(self, users):
+        with self._lock, self._conn as conn:
+            for username, user in users.items():
+                bio = user.get('bio', {'entry': '', 'timestamp': ''})
+                conn.execute('INSERT OR REPLACE INTO users '
+                             '(username, password, bio, posts) '
+                             'VALUES (?, ?, ?, ?)',
+                             (username, user['password'], json.dumps(bio),
+                              json.dumps(user.get('posts', []))))
+                seq = self._query_one('SELECT COALESCE(MAX(seq), 0) '
+                                      'FROM messages WHERE username = ?',
+                                      (username,))[0]
+                rows = []
+                messages = sorted(
+                    user.get('messages', []),
+                    key=lambda message: _timestamp_key(message['timestamp']))
+                for message in messages:
+                    direction = 'from' if 'from' in message else 'recipient'
+                    seq += 1
+                    rows.append((username, message[direction], direction,
+                                 message['message'], message['timestamp'],
+                                 message['status'], seq))
+                conn.executemany('INSERT INTO messages (username, peer, '
+                                 'direction, message, timestamp, status, '
+                                 'seq) VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+                self._index_terms(conn, [(username, row[6], row[3])
+                                         for row in rows])
+
+    def export_users(self):
+        users = {}
+        with self._lock:
+            for username, password, bio, posts in self._conn.execute(
+                    'SELECT username, password, bio, posts FROM users'
+            ).fetchall():
+                users[username] = {'password': password,
+                                   'bio': json.loads(bio),
+                                   'posts': json.loads(posts),
+                                   'messages': []}
+            rows = self._conn.execute(
+                'SELECT username, peer, direction, message, timestamp, '
+                'status FROM messages ORDER BY username, seq').fetchall()
+        for username, peer, direction, message, timestamp, status in rows:
+            if username in users:
+                users[username]['messages'].append(
+                    {'message': message, direction: peer,
+                     'timestamp': timestamp, 'status': status})
+        return users
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class CachedStore(Store):
+    """
+    Keeps the whole user table in memory and serves every request but
+    searches from it. Searches flush the queued changes and are answered
+    from the terms table of the backing store, so no word index is kept
+    in memory. Changes are queued and written behind to the backing
+    store by a background thread every flush_interval seconds, and once
+    more when the store is closed.
+
+    Callers must serialize operations on the same user (DSUServer does
+    this with its UserLocks).
+    """
+
+    def __init__(self, backend, flush_interval=1.0):
+        """
+        Load the backing store into memory and start writing behind.
+
+        Arguments:
+        backend: the Store changes are written to
+        flush_interval: seconds between writes to the backend
+        """
+        self.backend = backend
+        self.flush_interval = flush_interval
+        # username -> user object in the users.json format
+        self._users = {}
+        # username -> (id, message object) of unread messages, so unread
+        # fetches never scan the history
+        self._unread = {}
+        # username -> peer -> ids of the messages exchanged with that
+        # peer, in order
+        self._conversations = {}
+        # Write operations not yet applied to the backend
+        self._pending = []
+        self._pending_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._closed = threading.Event()
+        self._load(backend.export_users())
+        self._flusher = threading.Thread(target=self._flush_loop,
+                                         daemon=True)
+        self._flusher.start()
+
+    def _load(self, users):
+        """
+        Index users in the users.json format.
+
+        Arguments:
+        users: the users dictionary
+        """
+        for username, user in users.items():
+            self._users[username] = user
+            self._unread[username] = [
+                (seq, message)
+                for seq, message in enumerate(user['messages'], 1)
+                if message['status'] == 'unread']
+            conversations = self._conversations[username] = {}
+            for seq, message in enumerate(user['messages'], 1):
+                conversations.setdefault(_peer_of(message), []).append(seq)
+
+    def _queue(self, *operation):
+        with self._pending_lock:
+            self._pending.append(operation)
+
+    def _flush_loop(self):
+        while not self._closed.wait(self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        """
+        Write every queued change to the backing store.
+        """
+        with self._flush_lock:
+            with self._pending_lock:
+                operations, self._pending = self._pending, []
+            if not operations:
+                return
+            try:
+                self.backend.apply(operations)
+            except Exception as e:  # pylint: disable=broad-except
+                print(f'Unable to flush {len(operations)} changes to the '
+                      f'store: {e}')
+                with self._pending_lock:
+                    # Kept for the next attempt
+                    self._pending[:0] = operations
+
+    def get_user(self, username):
+        user = self._users.get(username, None)
+        if not user:
+            return None
+        return {'password': user['password'], 'bio': user['bio'],
+                'posts': user['posts']}
+
+    def create_user(self, username, password):
+        if username in self._users:
+            return False
+        self._users[username] = {'password': password,
+                                 'bio': {'entry': '', 'timestamp': ''},
+                                 'posts': [], 'messages': []}
+        self._unread[username] = []
+        self._conversations[username] = {}
+        self._queue('create_user', username, password)
+        return True
+
+    def add_message(self, entry, sender, recipient, timestamp):
+        fetched_sender = self._users.get(sender, None)
+        fetched_user = self._users.get(recipient, None)
+        if not fetched_sender or not fetched_user:
+            return False
+        self._append_message(entry, sender, recipient, timestamp)
+        self._queue('add_message', entry, sender, recipient, timestamp)
+        return True
+
+    def add_messages(self, entry, sender, recipients, timestamp):
+        """
+        Store the message in memory for every recipient and queue a
+        single write for all of them.
+
+        Arguments:
+        entry: the message text
+        sender: the username of the sender
+        recipients: the usernames of the recipients
+        timestamp: the timestamp of the message
+
+        Returns:
+        dict: recipient -> True if the message was stored for them
+        """
+        results = {}
+        for recipient in recipients:
+            results[recipient] = (sender in self._users
+                                  and recipient in self._users)
+            if results[recipient]:
+                self._append_message(entry, sender, recipient, timestamp)
+        sent = [recipient for recipient, ok in results.items() if ok]
+        if sent:
+            self._queue('add_messages', entry, sender, sent, timestamp)
+        return results
+
+    def _append_message(self, entry, sender, recipient, timestamp):
+        """
+        Add a message to the in-memory history of both users.
+
+        Arguments:
+        entry: the message text
+        sender: the username of the sender
+        recipient: the username of the recipient
+        timestamp: the timestamp of the message
+        """
+        sent_messages = self._users[sender]['messages']
+        received_messages = self._users[recipient]['messages']
+        sent_messages.append({'message': entry, 'recipient': recipient,
+                              'timestamp': timestamp, 'status': 'sent'})
+        self._conversations[sender].setdefault(recipient, []).append(
+            len(sent_messages))
+        received = {'message': entry, 'from': sender,
+                    'timestamp': timestamp, 'status': 'unread'}
+        received_messages.append(received)
+        self._conversations[recipient].setdefault(sender, []).append(
+            len(received_messages))
+        self._unread[recipient].append((len(received_messages), received))
+
+    def has_unread(self, username):
+        return bool(self._unread.get(username, None))
+
+    def mark_read(self, username, first=1, last=None, peer=None):
+        unread = self._unread.get(username, None)
+        if not unread:
+            return
+        remaining = []
+        for seq, message in unread:
+            if (seq >= first and (last is None or seq <= last)
+                    and (peer is None or message['from'] == peer)):
+                message['status'] = 'read'
+            else:
+                remaining.append((seq, message))
+        if len(remaining) != len(unread):
+            self._unread[username] = remaining
+            self._queue('mark_read', username, first, last, peer)
+
+    def read_all_messages(self, username, since=0, before=None, limit=None,
+                          descending=False, peer=None):
+        fetched_user = self._users.get(username, None)
+        if not fetched_user:
+            return False
+        messages = fetched_user['messages']
+        if peer is None:
+            # Ids are list positions, so the selected ids are a range
+            end = len(messages) + 1
+            if before is not None:
+                end = min(before, end)
+            seqs = range(since + 1, end)
+        else:
+            # The conversation index is sorted, so the bounds are found
+            # by bisection
+            conversation = self._conversations[username].get(peer, [])
+            end = len(conversation)
+            if before is not None:
+                end = bisect_left(conversation, before)
+            seqs = conversation[bisect_right(conversation, since):end]
+        if limit is not None:
+            seqs = seqs[-limit:] if descending else seqs[:limit]
+        if descending:
+            seqs = seqs[::-1]
+        result = []
+        for seq in seqs:
+            message = messages[seq - 1]
+            direction = 'from' if 'from' in message else 'recipient'
+            result.append({'id': seq, direction: message[direction],
+                           'message': message['message'],
+                           'timestamp': message['timestamp']})
+        if result:
+            self.mark_read(username, min(seqs), max(seqs), peer)
+        return result
+
+    def read_unread_messages(self, username, mark=True):
+        if username not in self._users:
+            return False
+        result = [{'id': seq, 'from': message['from'],
+                   'message': message['message'],
+                   'timestamp': message['timestamp']}
+                  for seq, message in self._unread[username]]
+        if mark:
+            self.mark_read(username)
+        return result
+
+    def search_messages(self, username, query, peer=None, start=None,
+                        end=None, limit=None):
+        if username not in self._users:
+            return False
+        # The backend has to hold every message before its terms table is
+        # searched
+        self.flush()
+        return self.backend.search_messages(username, query, peer, start,
+                                            end, limit)
+
+    def import_users(self, users):
+        self.flush()
+        self.backend.import_users(users)
+        self._load(self.backend.export_users())
+
+    def export_users(self):
+        return {username: dict(user, messages=[
+                    dict(message) for message in user['messages']])
+                for username, user in list(self._users.items())}
+
+    def close(self):
+        self._closed.set()
+        self._flusher.join()
+        self.flush()
+        self.backend.close()
@@ -10,8 +10,13 @@ import unittest
 from ds_protocol import (extract_json,
                          authenticate_request,
                          direct_message_request,
+                         broadcast_request,
                          fetch_request,
-                         DSPResponse)
+                         search_request,
+                         subscribe_request,
+                         extract_push,
+                         DSPResponse,
+                         DSPPush)
 
 
 class TestProtocol(unittest.TestCase):
@@ -86,6 +91,34 @@ class TestProtocol(unittest.TestCase):
         }
         self.assertEqual(parsed, expected)
 
+        parsed = json.loads(direct_message_request(
+            "token123", "Hello!", "recipient", 123.45, "abc"))
+        expected["directmessage"]["id"] = "abc"
+        self.assertEqual(parsed, expected)
+
+    def test_broadcast_request(self):
+        """
+        Test multi-recipient direct message request generation and the
+        per-recipient results of its response.
+        """
+        dm_msg = broadcast_request(
+            "token123", "Hello all!", ["alice", "bob"], 123.45)
+        parsed = json.loads(dm_msg)
+        expected = {
+            "token": "token123",
+            "directmessage": {
+                "entry": "Hello all!",
+                "recipients": ["alice", "bob"],
+                "timestamp": "123.45"
+            }
+        }
+        self.assertEqual(parsed, expected)
+
+        response = extract_json('{"response": {"type": "error", '
+                                '"results": {"alice": "ok", '
+                                '"bob": "error"}}}')
+        self.assertEqual(response.results, {"alice": "ok", "bob": "error"})
+
     def test_fetch(self):
         """
         Test fetch request generation.
@@ -95,6 +128,94 @@ class TestProtocol(unittest.TestCase):
         expected = {"token": "token123", "fetch": "all"}
         self.assertEqual(parsed, expected)
 
+    def test_fetch_wait(self):
+        """
+        Test long polling fetch request generation.
+        """
+        fetch_msg = fetch_request("token123", "unread", 30)
+        parsed = json.loads(fetch_msg)
+        expected = {"token": "token123", "fetch": "unread", "wait": 30}
+        self.assertEqual(parsed, expected)
+
+    def test_fetch_since(self):
+        """
+        Test incremental fetch request generation.
+        """
+        fetch_msg = fetch_request("token123", "all", since=42)
+        parsed = json.loads(fetch_msg)
+        expected = {"token": "token123", "fetch": "all", "since": 42}
+        self.assertEqual(parsed, expected)
+
+    def test_extract_json_next(self):
+        """
+        Test extraction of the next page cursor from a paged response.
+        """
+        paged = '{"response": {"type": "ok", "messages": [], "next": 7}}'
+        self.assertEqual(extract_json(paged).next, 7)
+        self.assertIsNone(extract_json(
+            '{"response": {"type": "ok", "messages": []}}').next)
+
+    def test_fetch_page(self):
+        """
+        Test paged fetch request generation.
+        """
+        fetch_msg = fetch_request("token123", "all", before=10,
+                                  limit=5, order="desc")
+        parsed = json.loads(fetch_msg)
+        expected = {"token": "token123", "fetch": "all", "before": 10,
+                    "limit": 5, "order": "desc"}
+        self.assertEqual(parsed, expected)
+
+    def test_fetch_conversation(self):
+        """
+        Test conversation fetch request generation.
+        """
+        fetch_msg = fetch_request("token123", "all", peer="bob")
+        parsed = json.loads(fetch_msg)
+        expected = {"token": "token123", "fetch": "all", "peer": "bob"}
+        self.assertEqual(parsed, expected)
+
+    def test_search(self):
+        """
+        Test search request generation.
+        """
+        search_msg = search_request("token123", "lunch tomorr*",
+                                    peer="bob", start=10, limit=5)
+        parsed = json.loads(search_msg)
+        expected = {"token": "token123", "search": "lunch tomorr*",
+                    "peer": "bob", "start": 10, "limit": 5}
+        self.assertEqual(parsed, expected)
+
+    def test_subscribe(self):
+        """
+        Test subscribe request generation.
+        """
+        subscribe_msg = subscribe_request("token123")
+        parsed = json.loads(subscribe_msg)
+        expected = {"token": "token123", "subscribe": "directmessage"}
+        self.assertEqual(parsed, expected)
+
+    def test_extract_push(self):
+        """
+        Test extraction of a pushed message.
+        """
+        push_msg = json.dumps({"push": {
+            "type": "directmessage",
+            "message": {"from": "user1", "message": "Hi",
+                        "timestamp": "1.5"}}})
+        expected = DSPPush(
+            type='directmessage',
+            message={'from': 'user1', 'message': 'Hi', 'timestamp': '1.5'})
+        self.assertEqual(extract_push(push_msg), expected)
+
+    def test_extract_push_not_push(self):
+        """
+        Test that responses and malformed JSON are not treated as pushes.
+        """
+        response = '{"response": {"type": "ok", "message": "Success"}}'
+        self.assertIsNone(extract_push(response))
+        self.assertIsNone(extract_push('{"push": '))
+
 
 if __name__ == '__main__':
     unittest.main()
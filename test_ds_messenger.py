@@ -5,9 +5,22 @@ This module contains test cases for the DirectMessenger class including
 authentication, message sending, and message retrieval functionality.
 """
 
+import asyncio
+import json
+import queue
+import socket
+import threading
+import time
 import unittest
+import uuid
 from unittest.mock import patch
-from ds_messenger import DirectMessenger
+from ds_messenger import (
+    AsyncDirectMessenger,
+    DirectMessenger,
+    DirectMessengerPool
+)
+from ds_protocol import fetch_request
+from notebook import DirectMessageError
 
 
 class TestMessenger(unittest.TestCase):
@@ -34,7 +47,7 @@ class TestMessenger(unittest.TestCase):
         """
         Test that invalid credentials raise an exception.
         """
-        with self.assertRaises(Exception):
+        with self.assertRaises(DirectMessageError):
             DirectMessenger(
                 dsuserver='localhost',
                 username='testuser',
@@ -102,6 +115,36 @@ class TestMessenger(unittest.TestCase):
         self.assertEqual(len(msgs), 1)
         self.assertEqual(msgs[0].message, "msg 2")
 
+    def test_retrieve_new_wait(self):
+        """
+        Test that a long polling retrieve_new returns as soon as a
+        message arrives, and returns empty once the wait expires.
+        """
+        dm10 = DirectMessenger(dsuserver='localhost', username='test_user_10')
+        dm10.retrieve_new()
+        self.assertEqual(dm10.retrieve_new(wait=0.2), [])
+
+        timer = threading.Timer(0.2, self.dm5.send, ('waited', 'test_user_10'))
+        timer.start()
+        started = time.time()
+        msgs = dm10.retrieve_new(wait=5)
+        timer.join()
+        self.assertLess(time.time() - started, 4)
+        self.assertEqual([msg.message for msg in msgs], ['waited'])
+
+    def test_fetch_invalid_fields(self):
+        """
+        Test that fetches with invalid fields are answered with an error.
+        """
+        for wait in (-1, 'soon', True, float('nan'), float('inf')):
+            parsed = self.dm.parse_message(
+                fetch_request(self.dm.token, 'unread', wait))
+            self.assertEqual(parsed.type, 'error', wait)
+        for since in (-1, 1.5):
+            parsed = self.dm.parse_message(
+                fetch_request(self.dm.token, 'all', since=since))
+            self.assertEqual(parsed.type, 'error', since)
+
     def test_retrieve_all(self):
         """
         Test that retrieve_all method returns a list of all messages.
@@ -131,6 +174,97 @@ class TestMessenger(unittest.TestCase):
         self.assertGreater(len(msgs), old_len)
         self.assertEqual(msgs[old_len].message, "Hi")
 
+    def test_retrieve_since(self):
+        """
+        Test that retrieve_since only returns messages after the cursor.
+        """
+        dm11 = DirectMessenger(dsuserver='localhost', username='test_user_11')
+        self.dm.send('old', 'test_user_11')
+        dm11.retrieve_all()
+        cursor = dm11.cursor
+        self.assertGreater(cursor, 0)
+
+        self.dm.send('new', 'test_user_11')
+        msgs = dm11.retrieve_since(cursor)
+        self.assertEqual([msg.message for msg in msgs], ['new'])
+        self.assertEqual(dm11.cursor, msgs[0].message_id)
+        self.assertEqual(dm11.retrieve_since(dm11.cursor), [])
+
+    def test_retrieve_since_sent(self):
+        """
+        Test that messages the user sent come back with their recipient
+        and no sender.
+        """
+        dm23 = DirectMessenger(dsuserver='localhost', username='test_user_23')
+        dm23.send('outgoing', 'testuser')
+        self.dm.send('incoming', 'test_user_23')
+
+        msgs = dm23.retrieve_since(0)[-2:]
+        self.assertEqual([(m.message, m.sender, m.recipient) for m in msgs],
+                         [('outgoing', None, 'testuser'),
+                          ('incoming', 'testuser', 'test_user_23')])
+
+    def test_iter_all(self):
+        """
+        Test that iter_all walks every page in both directions.
+        """
+        dm12 = DirectMessenger(dsuserver='localhost', username='test_user_12')
+        sent = [f'page {i}' for i in range(5)]
+        self.dm.send_many([(msg, 'test_user_12') for msg in sent])
+
+        oldest_first = [msg.message for msg in dm12.iter_all(page_size=2)]
+        self.assertEqual(oldest_first[-5:], sent)
+        self.assertEqual(len(oldest_first), len(dm12.retrieve_all()))
+
+        newest_first = dm12.iter_all(page_size=2, newest_first=True)
+        self.assertEqual([next(newest_first).message for _ in range(3)],
+                         ['page 4', 'page 3', 'page 2'])
+
+    def test_retrieve_conversation(self):
+        """
+        Test that retrieve_conversation only returns one conversation.
+        """
+        dm13 = DirectMessenger(dsuserver='localhost', username='test_user_13')
+        self.dm.send('from testuser', 'test_user_13')
+        self.dm5.send('from testuser5', 'test_user_13')
+        dm13.send('reply', 'testuser')
+
+        msgs = dm13.retrieve_conversation('testuser')
+        self.assertEqual([msg.message for msg in msgs][-2:],
+                         ['from testuser', 'reply'])
+        self.assertTrue(all('testuser' in (msg.sender, msg.recipient)
+                            for msg in msgs))
+        self.assertEqual(msgs[-1].sender, 'test_user_13')
+
+        latest = dm13.retrieve_conversation('testuser', limit=1)
+        self.assertEqual([msg.message for msg in latest], ['reply'])
+
+    def test_search(self):
+        """
+        Test that search finds matching messages, newest first.
+        """
+        # A word of its own, so messages left by earlier runs against the
+        # same server never match
+        word = 'lunch' + uuid.uuid4().hex[:8]
+        dm14 = DirectMessenger(dsuserver='localhost', username='test_user_14')
+        self.dm.send(f'{word.upper()} tomorrow at noon?', 'test_user_14')
+        self.dm5.send(f'{word} was great', 'test_user_14')
+        dm14.send(f'see you at {word}time', 'testuser')
+
+        found = dm14.search(word)
+        self.assertEqual([msg.message for msg in found],
+                         [f'{word} was great',
+                          f'{word.upper()} tomorrow at noon?'])
+        self.assertEqual(found[0].sender, 'testuser5')
+
+        self.assertEqual(len(dm14.search(word + '*')), 3)
+        self.assertEqual([msg.message for msg in dm14.search(
+            word + '*', peer='testuser')],
+            [f'see you at {word}time', f'{word.upper()} tomorrow at noon?'])
+        self.assertEqual(len(dm14.search(word + '*', limit=1)), 1)
+        self.assertEqual(dm14.search(word, end=0), [])
+        self.assertEqual(dm14.search(f'{word} dinner'), [])
+
     def test_retrieve_all_empty(self):
         """
         Test retrieve_all method with empty message response.
@@ -141,6 +275,344 @@ class TestMessenger(unittest.TestCase):
         messages = self.dm.retrieve_all()
         self.assertEqual(len(messages), 0)
 
+    def test_send_many(self):
+        """
+        Test that send_many pipelines several messages in order.
+        """
+        dm6 = DirectMessenger(dsuserver='localhost', username='test_user_6')
+        dm6.retrieve_new()
+
+        sent = self.dm.send_many([('first', 'test_user_6'),
+                                  ('second', 'test_user_6'),
+                                  ('third', 'no_such_user_123')])
+        self.assertEqual(sent, [True, True, False])
+
+        msgs = dm6.retrieve_new()
+        self.assertEqual([msg.message for msg in msgs], ['first', 'second'])
+
+    def test_send_many_not_token(self):
+        """
+        Test send_many behavior when no authentication token is present.
+        """
+        self.dm.token = None
+        self.assertEqual(self.dm.send_many([('a', 'b'), ('c', 'd')]),
+                         [False, False])
+
+    def test_retrieve_many(self):
+        """
+        Test that retrieve_many returns one result list per fetch type.
+        """
+        dm7 = DirectMessenger(dsuserver='localhost', username='test_user_7')
+        self.dm.send('batched', 'test_user_7')
+
+        unread, everything = dm7.retrieve_many(['unread', 'all'])
+        self.assertEqual(unread[-1].message, 'batched')
+        self.assertEqual(everything[-1].message, 'batched')
+        self.assertEqual(everything[-1].recipient, 'test_user_7')
+
+    def test_subscribe_push(self):
+        """
+        Test that a subscribed messenger receives pushed messages,
+        including ones sent before it subscribed.
+        """
+        dm8 = DirectMessenger(dsuserver='localhost', username='test_user_8')
+        dm8.retrieve_new()
+        self.dm.send('before', 'test_user_8')
+
+        self.assertTrue(dm8.subscribe())
+        self.assertTrue(dm8.subscribed)
+        self.dm.send('after', 'test_user_8')
+
+        pushed = [msg.message for msg in dm8.incoming(timeout=2)]
+        self.assertEqual(pushed, ['before', 'after'])
+        self.assertEqual(dm8.retrieve_new(), [])
+
+    def test_subscribe_callback(self):
+        """
+        Test that pushed messages are passed to the subscribe callback.
+        """
+        dm9 = DirectMessenger(dsuserver='localhost', username='test_user_9')
+        dm9.retrieve_new()
+        received = queue.Queue()
+        self.assertTrue(dm9.subscribe(received.put))
+
+        self.dm.send('pushed', 'test_user_9')
+        msg = received.get(timeout=2)
+        self.assertEqual(msg.message, 'pushed')
+        self.assertEqual(msg.sender, 'testuser')
+
+    def test_message_too_large(self):
+        """
+        Test that the server answers a command over its size limit with
+        an error before closing the connection.
+        """
+        with socket.create_connection(('localhost', 3001)) as sock:
+            # One byte over the default limit, so the server has read all
+            # of it when it answers
+            sock.sendall(b'x' * (1024 * 1024 + 1))
+            reply = sock.makefile('r').readline()
+        self.assertEqual(json.loads(reply),
+                         {"response": {"type": "error",
+                                       "message": "Message too large"}})
+
+    def test_subscribe_callback_error(self):
+        """
+        Test that a failing push callback neither stops later pushes nor
+        blocks requests on the connection.
+        """
+        dm20 = DirectMessenger(dsuserver='localhost', username='test_user_20')
+        dm20.retrieve_new()
+        received = queue.Queue()
+
+        def callback(msg):
+            received.put(msg)
+            raise ValueError('callback failed')
+
+        self.assertTrue(dm20.subscribe(callback))
+        self.dm.send('first', 'test_user_20')
+        self.dm.send('second', 'test_user_20')
+        self.assertEqual(received.get(timeout=2).message, 'first')
+        self.assertEqual(received.get(timeout=2).message, 'second')
+        self.assertTrue(dm20.subscribed)
+        self.assertTrue(dm20.send('still works', 'testuser'))
+        dm20.close()
+
+    def test_reconnect(self):
+        """
+        Test that a dropped connection is replaced transparently, keeping
+        the cursor and the subscription.
+        """
+        dm16 = DirectMessenger(dsuserver='localhost',
+                               username='test_user_16', port=3001)
+        self.dm.send('first', 'test_user_16')
+        dm16.retrieve_all()
+        cursor, token = dm16.cursor, dm16.token
+
+        dm16.socket.shutdown(socket.SHUT_RDWR)
+        self.dm.send('second', 'test_user_16')
+        msgs = dm16.retrieve_since(dm16.cursor)
+        self.assertEqual([msg.message for msg in msgs], ['second'])
+        self.assertNotEqual(dm16.token, token)
+        self.assertGreater(dm16.cursor, cursor)
+
+        received = queue.Queue()
+        self.assertTrue(dm16.subscribe(received.put))
+        dm16.socket.shutdown(socket.SHUT_RDWR)
+        self.dm.send('pushed', 'test_user_16')
+        self.assertEqual(received.get(timeout=2).message, 'pushed')
+        self.assertTrue(dm16.send('still here', 'testuser'))
+        dm16.close()
+
+    def test_reconnect_subscribed(self):
+        """
+        Test that messages sent while a subscription's connection is
+        dropped are each passed on exactly once, for a messenger that
+        had not fetched anything before subscribing.
+        """
+        dm24 = DirectMessenger(dsuserver='localhost', username='test_user_24')
+        self.dm.send('before subscribing', 'test_user_24')
+        received = queue.Queue()
+        self.assertTrue(dm24.subscribe(received.put))
+
+        sent = [f'dropped {i}' for i in range(5)]
+        for _ in range(2):
+            dm24.socket.shutdown(socket.SHUT_RDWR)
+            for message in sent:
+                self.assertTrue(self.dm.send(message, 'test_user_24'))
+        self.assertTrue(dm24.send('reply', 'testuser'))
+
+        expected = ['before subscribing'] + sent * 2
+        got = []
+        while len(got) < len(expected):
+            got.append(received.get(timeout=2).message)
+        self.assertEqual(sorted(got), sorted(expected))
+        time.sleep(0.2)
+        self.assertTrue(received.empty())
+        dm24.close()
+
+    def test_lost_response(self):
+        """
+        Test that a direct message whose response was lost is sent again
+        but delivered once, and that an unread fetch whose response was
+        lost raises ConnectionError instead of being sent again.
+        """
+        dm22 = DirectMessenger(dsuserver='localhost', username='test_user_22')
+        dm22.retrieve_new()
+
+        generation = self.dm._generation
+        self.dm.reader.readline = lambda: ''
+        self.assertTrue(self.dm.send('once', 'test_user_22'))
+        self.assertNotEqual(self.dm._generation, generation)
+        msgs = dm22.retrieve_new()
+        self.assertEqual([msg.message for msg in msgs], ['once'])
+
+        self.dm.send('fetched', 'test_user_22')
+        dm22.reader.readline = lambda: ''
+        with self.assertRaises(ConnectionError):
+            dm22.retrieve_new()
+        msgs = dm22.retrieve_all()
+        self.assertEqual([msg.message for msg in msgs][-2:],
+                         ['once', 'fetched'])
+
+    def test_reconnect_rejected(self):
+        """
+        Test that a reconnect the server does not authenticate raises
+        DirectMessageError instead of being retried.
+        """
+        self.dm.password = 'testpass2'
+        self.dm.socket.shutdown(socket.SHUT_RDWR)
+        with self.assertRaises(DirectMessageError):
+            self.dm.retrieve_all()
+
+    def test_broadcast(self):
+        """
+        Test that broadcast sends one message to several recipients and
+        reports the recipients it could not be sent to.
+        """
+        dm18 = DirectMessenger(dsuserver='localhost', username='test_user_18')
+        dm19 = DirectMessenger(dsuserver='localhost', username='test_user_19')
+        dm18.retrieve_new()
+        dm19.retrieve_new()
+
+        results = self.dm.broadcast(
+            'announcement', ['test_user_18', 'no_such_user_123',
+                             'test_user_19', 'test_user_18'])
+        self.assertEqual(results, {'test_user_18': True,
+                                   'no_such_user_123': False,
+                                   'test_user_19': True})
+        for dm in (dm18, dm19):
+            msgs = dm.retrieve_new()
+            self.assertEqual([msg.message for msg in msgs], ['announcement'])
+            self.assertEqual(msgs[0].sender, 'testuser')
+
+        self.assertEqual(self.dm.broadcast('again', ['test_user_18']),
+                         {'test_user_18': True})
+        dm18.retrieve_new()
+
+        too_many = ['test_user_18'] + [f'no_such_user_{i}'
+                                       for i in range(100)]
+        self.assertFalse(any(self.dm.broadcast('too many',
+                                               too_many).values()))
+        self.assertEqual(dm18.retrieve_new(), [])
+
+    def test_pool(self):
+        """
+        Test that the pool reuses connections, stays within its size,
+        evicts the least recently used one and replaces dead ones.
+        """
+        pool = DirectMessengerPool(max_connections=2)
+        dm17 = DirectMessenger(dsuserver='localhost', username='test_user_17')
+        dm17.retrieve_new()
+
+        with pool.connection('localhost', 'testuser', 'testpass') as dm:
+            self.assertTrue(dm.send('pooled', 'test_user_17'))
+        with pool.connection('localhost', 'testuser', 'testpass') as again:
+            self.assertIs(again, dm)
+        with pool.connection('localhost', 'testuser5', 'testpass5') as dm5:
+            self.assertIsNot(dm5, dm)
+        self.assertEqual(len(pool), 2)
+
+        self.assertTrue(pool.send('localhost', 'test_user_16', None,
+                                  'evicts testuser', 'test_user_17'))
+        self.assertEqual(len(pool), 2)
+        with pool.connection('localhost', 'testuser', 'testpass') as new:
+            self.assertIsNot(new, dm)
+
+        new.socket.shutdown(socket.SHUT_RDWR)
+        with pool.connection('localhost', 'testuser', 'testpass') as dm:
+            self.assertIsNot(dm, new)
+            self.assertTrue(dm.send('healthy', 'test_user_17'))
+        pool.close()
+        self.assertEqual(len(pool), 0)
+
+        msgs = dm17.retrieve_new()
+        self.assertEqual([msg.message for msg in msgs],
+                         ['pooled', 'evicts testuser', 'healthy'])
+
+    def test_async_messenger(self):
+        """
+        Test that concurrent requests on one AsyncDirectMessenger each
+        get their own response, and that pushes reach the subscriber.
+        """
+        async def run():
+            async with AsyncDirectMessenger(
+                    'localhost', 'test_user_15') as dm15, \
+                    AsyncDirectMessenger(
+                        'localhost', 'testuser', 'testpass') as sender:
+                await dm15.retrieve_new()
+                sent = await asyncio.gather(
+                    *(sender.send(f'async {i}', 'test_user_15')
+                      for i in range(5)),
+                    sender.send('lost', 'no_such_user_123'))
+                self.assertEqual(sent, [True] * 5 + [False])
+
+                unread, conversation = await asyncio.gather(
+                    dm15.retrieve_new(),
+                    dm15.retrieve_conversation('testuser', limit=2))
+                self.assertEqual(len(unread), 5)
+                self.assertEqual([msg.message for msg in conversation],
+                                 ['async 3', 'async 4'])
+
+                self.assertTrue(await dm15.subscribe())
+                await sender.send('pushed', 'test_user_15')
+                pushed = await asyncio.wait_for(
+                    dm15.incoming().__anext__(), 2)
+                self.assertEqual(pushed.message, 'pushed')
+                self.assertEqual(pushed.sender, 'testuser')
+
+        asyncio.run(run())
+
+    def test_async_invalid_user(self):
+        """
+        Test that invalid credentials raise the same exception as
+        DirectMessenger, and that connect reports them.
+        """
+        async def run():
+            with self.assertRaises(DirectMessageError):
+                async with AsyncDirectMessenger(
+                        'localhost', 'testuser', 'testpass2'):
+                    pass
+            dm = AsyncDirectMessenger('localhost', 'testuser', 'testpass2')
+            self.assertFalse(await dm.connect())
+            await dm.close()
+
+        asyncio.run(run())
+
+    def test_async_reader_errors(self):
+        """
+        Test that a failing push callback does not stop the reader of an
+        AsyncDirectMessenger, and that waiting requests fail when the
+        reader stops for any reason.
+        """
+        async def run():
+            received = []
+
+            async def callback(msg):
+                received.append(msg.message)
+                raise ValueError('callback failed')
+
+            async with AsyncDirectMessenger(
+                    'localhost', 'test_user_21') as dm21:
+                await dm21.retrieve_new()
+                self.assertTrue(await dm21.subscribe(callback))
+                self.dm.send('first', 'test_user_21')
+                self.dm.send('second', 'test_user_21')
+                for _ in range(200):
+                    if len(received) == 2:
+                        break
+                    await asyncio.sleep(0.01)
+                self.assertEqual(received, ['first', 'second'])
+                self.assertTrue(await dm21.send('still works', 'testuser'))
+
+                with patch('ds_messenger.extract_push',
+                           side_effect=RuntimeError('reader failed')):
+                    with self.assertRaises(ConnectionError):
+                        await asyncio.wait_for(dm21.retrieve_new(), 2)
+                with self.assertRaises(ConnectionError):
+                    await dm21.retrieve_new()
+
+        asyncio.run(run())
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,139 @@
+"""
+Unit tests for the durable_write module.
+
+This module contains test cases for atomic file replacement, appends and
+the DurableWriter fsync policies.
+"""
+
+import os
+import tempfile
+import time
+import unittest
+from pathlib import Path
+from unittest.mock import patch
+import durable_write
+from durable_write import (atomic_write,
+                           durable_append,
+                           DurableWriter,
+                           FSYNC_ALWAYS,
+                           FSYNC_BATCH,
+                           FSYNC_NEVER)
+
+
+class TestDurableWrite(unittest.TestCase):
+    """
+    Test cases for the durable_write module.
+    """
+
+    def setUp(self):
+        """
+        Create a temporary directory for the written files.
+        """
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dir = Path(self.tmp.name)
+        self.path = self.dir / 'data.json'
+
+    def tearDown(self):
+        """
+        Remove the temporary directory.
+        """
+        self.tmp.cleanup()
+
+    def test_atomic_write(self):
+        """
+        Test that atomic_write replaces the file through a temporary file
+        that is renamed over it.
+        """
+        self.path.write_text('old')
+        with patch('durable_write.os.replace',
+                   wraps=os.replace) as replace:
+            atomic_write(self.path, 'new')
+        tmp_name, target = replace.call_args[0]
+        self.assertEqual(Path(target), self.path)
+        self.assertEqual(Path(tmp_name).parent, self.dir)
+        self.assertEqual(self.path.read_text(), 'new')
+        self.assertEqual(os.listdir(self.dir), ['data.json'])
+
+    def test_atomic_write_failure(self):
+        """
+        Test that a failed write leaves the old file and no temporary file.
+        """
+        self.path.write_text('old')
+        with patch('durable_write.os.replace', side_effect=OSError('full')):
+            with self.assertRaises(OSError):
+                atomic_write(self.path, 'new')
+        self.assertEqual(self.path.read_text(), 'old')
+        self.assertEqual(os.listdir(self.dir), ['data.json'])
+
+    def test_durable_append(self):
+        """
+        Test that durable_append creates the file and appends to it.
+        """
+        durable_append(self.path, 'a\n')
+        durable_append(self.path, b'b\n', fsync=False)
+        self.assertEqual(self.path.read_text(), 'a\nb\n')
+
+    def test_writer_always(self):
+        """
+        Test that FSYNC_ALWAYS and FSYNC_NEVER writes are applied at once.
+        """
+        for policy in (FSYNC_ALWAYS, FSYNC_NEVER):
+            writer = DurableWriter(policy)
+            writer.write(self.path, policy)
+            self.assertEqual(self.path.read_text(), policy)
+            writer.remove(self.path)
+            self.assertFalse(self.path.exists())
+            writer.close()
+
+    def test_writer_batch(self):
+        """
+        Test that FSYNC_BATCH queues writes until flush and applies them
+        as one coalesced batch.
+        """
+        writer = DurableWriter(FSYNC_BATCH, commit_interval=60)
+        journal = self.dir / 'journal'
+        writer.write(self.path, 'first')
+        writer.write(self.path, 'second')
+        writer.append(journal, 'a\n')
+        writer.append(journal, 'b\n')
+        self.assertFalse(self.path.exists())
+        self.assertFalse(journal.exists())
+
+        with patch('durable_write._replace',
+                   wraps=durable_write._replace) as replace:
+            writer.flush()
+        self.assertEqual(replace.call_count, 1)
+        self.assertEqual(self.path.read_text(), 'second')
+        self.assertEqual(journal.read_text(), 'a\nb\n')
+
+        writer.append(journal, 'c\n')
+        writer.remove(journal)
+        writer.close()
+        self.assertFalse(journal.exists())
+
+    def test_writer_batch_background(self):
+        """
+        Test that the background thread commits FSYNC_BATCH writes and
+        that its errors are raised by the next flush.
+        """
+        writer = DurableWriter(FSYNC_BATCH, commit_interval=0.01)
+        writer.write(self.path, 'committed')
+        writer.write(self.dir / 'missing' / 'file', 'fails')
+        for _ in range(200):
+            if self.path.exists():
+                break
+            time.sleep(0.01)
+        self.assertEqual(self.path.read_text(), 'committed')
+        with self.assertRaises(OSError):
+            writer.close()
+
+    def test_unknown_policy(self):
+        """
+        Test that an unknown fsync policy is rejected.
+        """
+        with self.assertRaises(ValueError):
+            DurableWriter('sometimes')
+
+
+if __name__ == '__main__':
+    unittest.main()
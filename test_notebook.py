@@ -0,0 +1,431 @@
+"""
+Unit tests for the notebook module.
+
+This module contains test cases for saving and loading a Notebook,
+including duplicate detection across reloads, journal replay, lazy
+loading through the offset index and the columnar conversation backend.
+"""
+
+import json
+import tempfile
+import unittest
+from pathlib import Path
+from notebook import (Notebook, DirectMessage, ColumnarConversation,
+                      Conversation, index_path, journal_path, message_key)
+
+
+class TestNotebookDedup(unittest.TestCase):
+    """
+    Test cases for duplicate detection in a Notebook.
+    """
+
+    def setUp(self):
+        """
+        Create a temporary notebook path.
+        """
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = Path(self.tmp.name) / 'notebook.json'
+
+    def tearDown(self):
+        """
+        Remove the temporary directory.
+        """
+        self.tmp.cleanup()
+
+    def load(self, lazy=False):
+        """
+        Load the saved notebook.
+
+        Arguments:
+        lazy: whether to load the notebook lazily
+
+        Returns:
+        Notebook: the loaded notebook
+        """
+        notebook = Notebook('', '', '', str(self.path))
+        notebook.load(self.path, lazy=lazy)
+        return notebook
+
+    def test_message_key(self):
+        """
+        Test that the key of a message does not depend on how its
+        timestamp was stored.
+        """
+        message = DirectMessage('hi', 'bob', None, 1.5)
+        self.assertEqual(message_key(message),
+                         message_key({'entry': 'hi', 'sender': 'bob',
+                                      'timestamp': '1.5'}))
+        self.assertNotEqual(message_key(message),
+                            message_key(DirectMessage('hi', 'amy', None,
+                                                      1.5)))
+
+    def test_unique_across_reloads(self):
+        """
+        Test that a message already saved is not added again after the
+        notebook is loaded, whether loaded fully or lazily.
+        """
+        notebook = Notebook('user', 'pw', 'localhost', str(self.path))
+        message = DirectMessage('hi', 'bob', None, '1.5')
+        self.assertTrue(notebook.add_unique_message('bob', message))
+        self.assertFalse(notebook.add_unique_message('bob', message))
+        notebook.save(self.path)
+
+        for lazy in (False, True):
+            notebook = self.load(lazy)
+            again = DirectMessage('hi', 'bob', None, '1.5')
+            self.assertFalse(notebook.add_unique_message('bob', again))
+            self.assertTrue(notebook.add_unique_message(
+                'bob', DirectMessage('hi', 'bob', None, '2.5')))
+            self.assertEqual(len(notebook.conversations['bob']), 2)
+
+
+class TestNotebookJournal(unittest.TestCase):
+    """
+    Test cases for a Notebook saved in journal mode.
+    """
+
+    def setUp(self):
+        """
+        Save a notebook, then journal one more message without
+        compacting, as if the program stopped right after.
+        """
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = Path(self.tmp.name) / 'notebook.json'
+        notebook = Notebook('user', 'pw', 'localhost', str(self.path),
+                            journal=True)
+        notebook.add_message('bob', DirectMessage('first', 'bob', None, 1))
+        notebook.save(self.path)
+        notebook.add_message('bob', DirectMessage('second', 'bob', None, 2))
+        notebook.set_cursor(7)
+        notebook.save(self.path)
+
+    def tearDown(self):
+        """
+        Remove the temporary directory.
+        """
+        self.tmp.cleanup()
+
+    def load(self, lazy=False):
+        """
+        Load the saved notebook in journal mode.
+
+        Arguments:
+        lazy: whether to load the notebook lazily
+
+        Returns:
+        Notebook: the loaded notebook
+        """
+        notebook = Notebook('', '', '', str(self.path), journal=True)
+        notebook.load(self.path, lazy=lazy)
+        return notebook
+
+    def entries(self, notebook):
+        """
+        Get the entries of the conversation with bob.
+
+        Arguments:
+        notebook: the notebook to read
+
+        Returns:
+        list: the message entries, oldest first
+        """
+        return [m['entry'] for m in notebook.conversations['bob'].messages]
+
+    def test_replay(self):
+        """
+        Test that journaled changes are replayed on load, fully or
+        lazily, without having been compacted.
+        """
+        self.assertTrue(journal_path(self.path).exists())
+        for lazy in (False, True):
+            notebook = self.load(lazy)
+            self.assertEqual(self.entries(notebook), ['first', 'second'])
+            self.assertEqual(notebook.cursor, 7)
+
+    def test_replay_after_compact(self):
+        """
+        Test that a journal left behind by an interrupted compact does
+        not add its messages twice.
+        """
+        journal = journal_path(self.path).read_bytes()
+        notebook = self.load()
+        notebook.compact()
+        self.assertFalse(journal_path(self.path).exists())
+        journal_path(self.path).write_bytes(journal)
+
+        notebook = self.load()
+        self.assertEqual(self.entries(notebook), ['first', 'second'])
+
+    def test_torn_last_line(self):
+        """
+        Test that a partly written last journal line is ignored and
+        the next save still produces a readable journal.
+        """
+        with open(journal_path(self.path), 'a', encoding='utf-8') as f:
+            f.write('{"recipient": "bob", "message": {"entr')
+
+        notebook = self.load()
+        self.assertEqual(self.entries(notebook), ['first', 'second'])
+        notebook.add_message('bob', DirectMessage('third', 'bob', None, 3))
+        notebook.save(self.path)
+
+        notebook = self.load()
+        self.assertEqual(self.entries(notebook),
+                         ['first', 'second', 'third'])
+
+    def test_missing_last_newline(self):
+        """
+        Test that a last journal line cut off right before its newline
+        is replayed, and that the next entry is not appended onto it.
+        """
+        journal = journal_path(self.path)
+        journal.write_bytes(journal.read_bytes().rstrip(b'\n'))
+
+        notebook = self.load()
+        self.assertEqual(notebook.cursor, 7)
+        notebook.add_message('bob', DirectMessage('third', 'bob', None, 3))
+        notebook.save(self.path)
+
+        notebook = self.load()
+        self.assertEqual(self.entries(notebook),
+                         ['first', 'second', 'third'])
+        self.assertEqual(notebook.cursor, 7)
+
+
+class TestNotebookIndex(unittest.TestCase):
+    """
+    Test cases for lazy loading through the offset index.
+    """
+
+    def setUp(self):
+        """
+        Create a temporary notebook path.
+        """
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = Path(self.tmp.name) / 'notebook.json'
+
+    def tearDown(self):
+        """
+        Remove the temporary directory.
+        """
+        self.tmp.cleanup()
+
+    def save(self, entry, cursor):
+        """
+        Save a notebook holding one message to bob.
+
+        Arguments:
+        entry: the entry of the message
+        cursor: the cursor of the notebook
+        """
+        notebook = Notebook('user', 'pw', 'localhost', str(self.path))
+        notebook.add_message('bob', DirectMessage(entry, 'bob', None, 1))
+        notebook.set_cursor(cursor)
+        notebook.save(self.path)
+
+    def load(self):
+        """
+        Load the saved notebook lazily.
+
+        Returns:
+        Notebook: the loaded notebook
+        """
+        notebook = Notebook('', '', '', str(self.path))
+        notebook.load(self.path, lazy=True)
+        return notebook
+
+    def test_lazy_load(self):
+        """
+        Test that a matching index defers reading the conversations.
+        """
+        self.save('aaaa', 1)
+        notebook = self.load()
+        self.assertEqual(notebook.cursor, 1)
+        self.assertFalse(notebook.conversations['bob'].is_loaded())
+        self.assertEqual(notebook.conversations['bob'].message_at(0)['entry'],
+                         'aaaa')
+
+    def test_stale_generation(self):
+        """
+        Test that an index left over from an earlier save of a file of
+        the same size is ignored, the whole file is read and the next
+        save writes a new index.
+        """
+        self.save('aaaa', 1)
+        stale = index_path(self.path).read_bytes()
+        size = self.path.stat().st_size
+        self.path.unlink()
+        self.save('bbbb', 2)
+        self.assertEqual(self.path.stat().st_size, size)
+        index_path(self.path).write_bytes(stale)
+
+        notebook = self.load()
+        self.assertEqual(notebook.cursor, 2)
+        self.assertTrue(notebook.conversations['bob'].is_loaded())
+        self.assertEqual(notebook.conversations['bob'].message_at(0)['entry'],
+                         'bbbb')
+
+        notebook.save(self.path)
+        self.assertNotEqual(index_path(self.path).read_bytes(), stale)
+        self.assertEqual(self.load().cursor, 2)
+        self.assertFalse(self.load().conversations['bob'].is_loaded())
+
+    def test_missing_or_broken_index(self):
+        """
+        Test that a missing or unreadable index falls back to reading
+        the whole file.
+        """
+        self.save('aaaa', 1)
+        for contents in (None, '{"size": ', '[]'):
+            if contents is None:
+                index_path(self.path).unlink()
+            else:
+                index_path(self.path).write_text(contents)
+            notebook = self.load()
+            self.assertEqual(notebook.cursor, 1)
+            self.assertTrue(notebook.conversations['bob'].is_loaded())
+
+
+class TestColumnarConversation(unittest.TestCase):
+    """
+    Test cases for the ColumnarConversation backend, checked against
+    the results of a plain Conversation.
+    """
+
+    def setUp(self):
+        """
+        Create a notebook of each kind holding the same messages, with
+        timestamps stored in every format and out of order.
+        """
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = Path(self.tmp.name) / 'notebook.json'
+        self.messages = [
+            {'entry': 'Lunch tomorrow?', 'sender': 'bob',
+             'timestamp': '1700000000.25'},
+            {'entry': 'sure', 'recipient': 'bob', 'timestamp': 1700000005.5},
+            {'entry': 'Late reply', 'sender': 'bob', 'timestamp': 1699999990},
+            {'entry': 'no lunch today', 'sender': 'bob',
+             'timestamp': '1700000010'},
+            {'entry': None, 'sender': 'bob', 'timestamp': 'yesterday'},
+            {'entry': 'ünïcode lunch', 'recipient': 'bob',
+             'timestamp': '1700000020.0', 'read': True},
+        ]
+        self.notebooks = {}
+        for conversation_type in (Conversation, ColumnarConversation):
+            notebook = Notebook('user', 'pw', 'localhost', str(self.path),
+                                conversation_type=conversation_type)
+            for message in self.messages:
+                notebook.add_message('bob', message)
+            self.notebooks[conversation_type] = notebook
+
+    def tearDown(self):
+        """
+        Remove the temporary directory.
+        """
+        self.tmp.cleanup()
+
+    def conversations(self):
+        """
+        Get the conversation with bob from each notebook.
+
+        Returns:
+        tuple: the plain and the columnar conversation
+        """
+        return (self.notebooks[Conversation].conversations['bob'],
+                self.notebooks[ColumnarConversation].conversations['bob'])
+
+    def test_messages(self):
+        """
+        Test that messages come back with their fields and timestamps
+        exactly as they were added.
+        """
+        plain, columnar = self.conversations()
+        self.assertIsInstance(columnar, ColumnarConversation)
+        self.assertEqual([dict(m) for m in columnar.messages], self.messages)
+        self.assertEqual(columnar.messages, plain.messages)
+        self.assertEqual(columnar.get_message(), plain.get_message())
+        self.assertEqual(columnar.messages[1:3], self.messages[1:3])
+        self.assertEqual(dict(columnar.messages[-1]), self.messages[-1])
+        self.assertEqual(len(columnar), 6)
+        self.assertEqual(columnar.sender_counts(), {'bob': 4})
+
+    def test_round_trip(self):
+        """
+        Test that a columnar notebook saves the same file as a plain
+        one and loads back unchanged, fully or lazily.
+        """
+        self.notebooks[Conversation].save(self.path)
+        plain = json.loads(self.path.read_text())['conversations']
+        self.notebooks[ColumnarConversation].save(self.path)
+        saved = json.loads(self.path.read_text())['conversations']
+        self.assertEqual(saved, plain)
+        self.assertEqual(saved['bob'], self.messages)
+
+        for lazy in (False, True):
+            notebook = Notebook('', '', '', str(self.path),
+                                conversation_type=ColumnarConversation)
+            notebook.load(self.path, lazy=lazy)
+            conversation = notebook.conversations['bob']
+            self.assertIsInstance(conversation, ColumnarConversation)
+            self.assertEqual([dict(m) for m in conversation.messages],
+                             self.messages)
+            self.assertFalse(notebook.add_unique_message(
+                'bob', self.messages[0]))
+
+    def test_search(self):
+        """
+        Test that text search matches a plain conversation, including
+        case folding and matches that must not run across entries.
+        """
+        plain, columnar = self.conversations()
+        for text, case_sensitive in (('lunch', False), ('Lunch', True),
+                                     ('ÜNÏ', False), ('?sure', False),
+                                     ('', False), ('dinner', False)):
+            self.assertEqual(columnar.search(text, case_sensitive),
+                             plain.search(text, case_sensitive), text)
+
+    def test_between(self):
+        """
+        Test that time range queries match a plain conversation while
+        the messages are out of order, and after more are added.
+        """
+        plain, columnar = self.conversations()
+        ranges = ((1700000000, 1700000010), (0, 2e9), (1699999990,
+                  1699999991), (1700000030, 1700000040))
+        for start, end in ranges:
+            self.assertEqual(columnar.between(start, end),
+                             plain.between(start, end), (start, end))
+
+        message = {'entry': 'later', 'sender': 'bob',
+                   'timestamp': '1700000001'}
+        plain.add_message(message)
+        columnar.add_message(message)
+        for start, end in ranges:
+            self.assertEqual(columnar.between(start, end),
+                             plain.between(start, end), (start, end))
+
+    def test_messages_read_only(self):
+        """
+        Test that changing the messages list of a columnar conversation
+        fails instead of being silently lost, and that assigning a new
+        list replaces the messages of either kind of conversation.
+        """
+        plain, columnar = self.conversations()
+        with self.assertRaises(AttributeError):
+            columnar.messages.append(self.messages[0])
+        with self.assertRaises(TypeError):
+            columnar.messages[0] = self.messages[0]
+        self.assertEqual(len(columnar), 6)
+
+        for conversation in (plain, columnar):
+            conversation.messages = self.messages[:2]
+            self.assertEqual([dict(m) for m in conversation.messages],
+                             self.messages[:2])
+            self.assertTrue(conversation.has_message(self.messages[1]))
+            self.assertFalse(conversation.has_message(self.messages[2]))
+            self.assertEqual(conversation.between(0, 2e9),
+                             conversation.messages[:])
+
+
+if __name__ == '__main__':
+    unittest.main()
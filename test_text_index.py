@@ -0,0 +1,167 @@
+"""
+Unit tests for the text_index module.
+
+This module contains test cases for tokenizing, exact and prefix queries
+and persistence of the InvertedIndex, and for the search index file saved
+next to a notebook.
+"""
+
+import json
+import tempfile
+import unittest
+from pathlib import Path
+from notebook import Notebook, DirectMessage, search_index_path
+from text_index import InvertedIndex, parse_query, tokenize
+
+
+class TestInvertedIndex(unittest.TestCase):
+    """
+    Test cases for the InvertedIndex class.
+    """
+
+    def setUp(self):
+        """
+        Create an index of a few messages.
+        """
+        self.index = InvertedIndex()
+        self.index.add('Lunch tomorrow at noon?', 1)
+        self.index.add('lunch was great', 5)
+        self.index.add('see you at lunchtime', 3)
+        self.index.add('Tomorrowland tickets', 4)
+
+    def test_tokenize(self):
+        """
+        Test that text and queries are split into lower-cased words.
+        """
+        self.assertEqual(tokenize('Lunch, tomorrow?'), ['lunch', 'tomorrow'])
+        self.assertEqual(tokenize(None), [])
+        self.assertEqual(parse_query('Lunch tomorr*'), ['lunch', 'tomorr*'])
+
+    def test_exact_query(self):
+        """
+        Test that every word must match and results are newest first.
+        """
+        self.assertEqual(self.index.search('lunch'), [1, 0])
+        self.assertEqual(self.index.search('LUNCH noon'), [0])
+        self.assertEqual(self.index.search('lunch dinner'), [])
+        self.assertEqual(self.index.search(''), [])
+
+    def test_prefix_query(self):
+        """
+        Test that a word ending in '*' matches every word starting with it.
+        """
+        self.assertEqual(self.index.search('lunch*'), [1, 2, 0])
+        self.assertEqual(self.index.search('tomorrow*'), [3, 0])
+        self.assertEqual(self.index.search('lunch* at'), [2, 0])
+        self.assertEqual(self.index.search('lunch*', limit=1), [1])
+        self.assertEqual(self.index.search('zzz*'), [])
+
+        # Words added later are found by prefix queries too
+        self.index.add('lunchbox', 6)
+        self.assertEqual(self.index.search('lunch*', limit=2), [4, 1])
+
+    def test_candidates(self):
+        """
+        Test that only candidate documents are returned.
+        """
+        self.assertEqual(self.index.search('lunch*', candidates=[0, 2]),
+                         [2, 0])
+
+    def test_dict_round_trip(self):
+        """
+        Test that an index survives to_dict and from_dict.
+        """
+        restored = InvertedIndex.from_dict(
+            json.loads(json.dumps(self.index.to_dict())))
+        self.assertEqual(len(restored), 4)
+        self.assertEqual(restored.search('lunch*'), [1, 2, 0])
+        self.assertEqual(restored.search('tomorrow*'), [3, 0])
+        self.assertEqual(restored.add('lunch again', 7), 4)
+
+
+class TestSearchIndexFile(unittest.TestCase):
+    """
+    Test cases for the search index saved next to a notebook file.
+    """
+
+    def setUp(self):
+        """
+        Save a notebook with a search index.
+        """
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = Path(self.tmp.name) / 'notebook.json'
+        notebook = Notebook('user', 'pw', 'localhost', str(self.path))
+        notebook.add_message(
+            'bob', DirectMessage('Lunch tomorrow?', 'bob', 'user', 1))
+        notebook.add_message(
+            'amy', DirectMessage('lunch was great', 'amy', 'user', 5))
+        notebook.search('lunch')
+        notebook.save(self.path)
+
+    def tearDown(self):
+        """
+        Remove the temporary directory.
+        """
+        self.tmp.cleanup()
+
+    def load(self):
+        """
+        Load the saved notebook lazily.
+
+        Returns:
+        Notebook: the loaded notebook
+        """
+        notebook = Notebook('', '', '', str(self.path))
+        notebook.load(self.path, lazy=True)
+        return notebook
+
+    def test_saved_index_is_used(self):
+        """
+        Test that a matching saved index is read instead of rebuilt.
+        """
+        self.assertTrue(search_index_path(self.path).exists())
+        notebook = self.load()
+        results = notebook.search('lunch')
+        self.assertEqual([m['entry'] for _, m in results],
+                         ['lunch was great', 'Lunch tomorrow?'])
+        self.assertIsNotNone(notebook._read_search_index())
+        self.assertFalse(notebook._search_changed)
+
+    def test_stale_stamp(self):
+        """
+        Test that a saved index whose stamp does not match the notebook
+        is ignored and rebuilt.
+        """
+        sidecar = search_index_path(self.path)
+        saved = json.loads(sidecar.read_text())
+        saved['stamp'] = 'stale'
+        saved['index'] = InvertedIndex().to_dict()
+        saved['docs'] = []
+        sidecar.write_text(json.dumps(saved))
+
+        notebook = self.load()
+        self.assertIsNone(notebook._read_search_index())
+        self.assertEqual(len(notebook.search('lunch')), 2)
+        self.assertTrue(notebook._search_changed)
+
+    def test_compact_without_index(self):
+        """
+        Test that saving messages added while the index is not loaded
+        does not build it, and that it is rebuilt on the next search.
+        """
+        notebook = self.load()
+        notebook.add_message(
+            'bob', DirectMessage('lunch again', 'bob', 'user', 9))
+        notebook.compact()
+        self.assertIsNone(notebook._search_index)
+        self.assertFalse(notebook.conversations['amy'].is_loaded())
+
+        notebook = self.load()
+        self.assertIsNone(notebook._read_search_index())
+        self.assertEqual([m['entry'] for _, m in notebook.search('lunch')],
+                         ['lunch again', 'lunch was great',
+                          'Lunch tomorrow?'])
+
+
+if __name__ == '__main__':
+    unittest.main()
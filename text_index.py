@@ -0,0 +1,186 @@
+# text_index.py
+# Connor Ng
+# ngce@uci.edu
+# ngce
+
+"""
+Inverted index for full-text search over messages.
+
+Each indexed message is a document with an integer id (the order it was
+added in) and a timestamp. The index maps every word to the ids of the
+documents containing it, so a query only looks at the documents that
+share its words instead of scanning all text.
+
+A query is a list of words. Every word must appear in a result, and a
+word ending in '*' matches any word starting with it. Results are
+ranked newest first.
+"""
+
+import re
+from array import array
+from bisect import bisect_left
+from typing import Any, Dict, Iterable, List, Optional, Set
+
+TOKEN_PATTERN = re.compile(r'\w+')
+QUERY_PATTERN = re.compile(r'\w+\*?')
+
+
+def tokenize(text: Any) -> List[str]:
+    """
+    Split text into the lower-cased words the index is made of.
+
+    Arguments:
+    text: the text to split
+
+    Returns:
+    list: the words of the text, in order
+    """
+    return TOKEN_PATTERN.findall(str(text or '').casefold())
+
+
+def parse_query(query: str) -> List[str]:
+    """
+    Split a query into words, keeping the '*' that marks a prefix.
+
+    Arguments:
+    query: the query typed by the user
+
+    Returns:
+    list: the lower-cased words of the query
+    """
+    return QUERY_PATTERN.findall(query.casefold())
+
+
+class InvertedIndex:
+    """
+    Maps words to the documents containing them. Documents are only
+    appended, so the lists of ids of every word stay sorted.
+    """
+
+    def __init__(self) -> None:
+        """
+        Create an empty InvertedIndex.
+        """
+        self.postings: Dict[str, array] = {}
+        self.timestamps = array('d')
+        # Sorted words for prefix queries, rebuilt after new words
+        self._terms: Optional[List[str]] = None
+
+    def __len__(self) -> int:
+        return len(self.timestamps)
+
+    def add(self, text: Any, timestamp: float) -> int:
+        """
+        Index a document.
+
+        Arguments:
+        text: the text of the document
+        timestamp: the time of the document, used for ranking
+
+        Returns:
+        int: the id of the document
+        """
+        doc_id = len(self.timestamps)
+        self.timestamps.append(timestamp)
+        for term in set(tokenize(text)):
+            postings = self.postings.get(term)
+            if postings is None:
+                postings = self.postings[term] = array('q')
+                self._terms = None
+            postings.append(doc_id)
+        return doc_id
+
+    def _terms_with_prefix(self, prefix: str) -> Iterable[str]:
+        """
+        Get every indexed word starting with a prefix.
+
+        Arguments:
+        prefix: the start of the words
+
+        Returns:
+        iterable: the matching words
+        """
+        if self._terms is None:
+            self._terms = sorted(self.postings)
+        start = bisect_left(self._terms, prefix)
+        for term in self._terms[start:]:
+            if not term.startswith(prefix):
+                break
+            yield term
+
+    def _matching(self, word: str) -> Set[int]:
+        """
+        Get the documents matching one query word.
+
+        Arguments:
+        word: the query word, ending in '*' for a prefix
+
+        Returns:
+        set: the ids of the matching documents
+        """
+        if word.endswith('*'):
+            matches = set()
+            for term in self._terms_with_prefix(word[:-1]):
+                matches.update(self.postings[term])
+            return matches
+        return set(self.postings.get(word, ()))
+
+    def search(self, query: str, limit: Optional[int] = None,
+               candidates: Optional[Iterable[int]] = None) -> List[int]:
+        """
+        Find the documents matching every word of a query.
+
+        Arguments:
+        query: the words to look for, '*' at the end of a word for a prefix
+        limit: the largest number of results to return
+        candidates: if given, only these documents can match
+
+        Returns:
+        list: the ids of the matching documents, newest first
+        """
+        words = parse_query(query)
+        if not words:
+            return []
+
+        matches = set(candidates) if candidates is not None else None
+        # Exact words usually match fewer documents, so start with them
+        for word in sorted(words, key=lambda w: w.endswith('*')):
+            found = self._matching(word)
+            matches = found if matches is None else matches & found
+            if not matches:
+                return []
+
+        timestamps = self.timestamps
+        ranked = sorted(matches, key=lambda d: (timestamps[d], d),
+                        reverse=True)
+        return ranked if limit is None else ranked[:limit]
+
+    def to_dict(self) -> Dict[str, Any]:
+        """
+        Convert the index to a JSON serializable dictionary.
+
+        Returns:
+        dict: the timestamps and postings of the index
+        """
+        return {
+            'timestamps': self.timestamps.tolist(),
+            'postings': {term: ids.tolist()
+                         for term, ids in self.postings.items()}
+        }
+
+    @classmethod
+    def from_dict(cls, d: Dict[str, Any]) -> 'InvertedIndex':
+        """
+        Create an index from a dictionary made by to_dict.
+
+        Arguments:
+        d: the dictionary
+
+        Returns:
+        InvertedIndex: the index
+        """
+        index = cls()
+        index.timestamps = array('d', d['timestamps'])
+        index.postings = {term: array('q', ids)
+                          for term, ids in d['postings'].items()}
+        return index